@@ -1 +1,2 @@
 from _appifier import Appifier
+from _archive import FORMATS as ARCHIVE_FORMATS
@@ -6,6 +6,10 @@ import chromeless
 from string import Template
 import simplejson as json
 from _relpath import relpath
+from _output import DirectoryOutput, IncrementalOutput, output_intact
+from _archive import ArchiveOutput, archive_directory
+from _cache import BuildCache
+from _copy import CopyEngine
 
 class Appifier(object):
     def __init__(self):
@@ -21,20 +25,23 @@ class Appifier(object):
         self.osappifier = osappifier.OSAppifier()
         self.dirs = chromeless.Dirs()
 
-    def _sub_and_copy(self, src, dst, mapping):
+    def _substitute(self, src, mapping):
         template_content = ""
         with open(src, 'r') as f:
             template_content = f.read()
         s = Template(template_content)
-        final_contents = s.substitute(mapping)
-        with open(dst, 'w') as f:
-            f.write(final_contents)
+        return s.substitute(mapping)
 
     # generate a complete standalone application (inside of a folder)
-    # the output will be placed in build/ directory and the path to the
-    # application will be returned
+    # the output will be placed in build/ directory (or in build_dir, if
+    # given) and the path to the application will be returned.  with
+    # archive set to one of ARCHIVE_FORMATS, the application is also packed
+    # into a single archive beside it, and the path to that is returned
+    # instead.
     def output_application(self, browser_code, harness_options, dev_mode,
-                           verbose=True):
+                           verbose=True, incremental=False, hardlink=False,
+                           archive=None, generated=None, omit=None,
+                           rewritten=None, build_dir=None):
         browser_code_dir = browser_code
         browser_code_main = "index.html"
         if not os.path.isdir(browser_code_dir):
@@ -45,22 +52,49 @@ class Appifier(object):
         # (like, the directory it was output into, and where inside that bundle the
         # xulrunner application files should be put)
         params = self.osappifier.output_app_shell(browser_code_dir=browser_code_dir,
-                                                  dev_mode=dev_mode)
+                                                  dev_mode=dev_mode,
+                                                  hardlink=hardlink,
+                                                  build_dir=build_dir,
+                                                  incremental=incremental)
 
         # now generate the xulrunner app, outputing inside the shell generated above
         self.output_xul_app(browser_code=browser_code,
                             dev_mode=dev_mode,
                             harness_options=harness_options,
-                            output_dir=params["xulrunner_app_dir"])
+                            output_dir=params["xulrunner_app_dir"],
+                            incremental=incremental,
+                            hardlink=hardlink,
+                            generated=generated,
+                            omit=omit,
+                            rewritten=rewritten)
+
+        if archive:
+            output_dir = params['output_dir']
+            archive_path = output_dir + "." + archive
+            if verbose:
+                print "Packing application into >%s< ..." % archive_path
+            return archive_directory(output_dir, archive_path, archive,
+                                     prefix=os.path.basename(output_dir))
 
         return params['output_dir']
 
-    def _recursive_copy_or_link(self, try_link, src, dst):
+    # where the manifest of an incremental build into output_dir is kept:
+    # beside the app, so it's never packaged
+    def _manifest_path(self, output_dir):
+        return os.path.join(os.path.dirname(output_dir),
+                            "." + os.path.basename(output_dir) + ".manifest.json")
+
+    # exclude names top level entries of src which should not be copied
+    # (because we'll generate them).  skip holds paths (relative to src) of
+    # files to leave out, and rewritten maps the paths of files to contents to
+    # write in their place, when copying.
+    def _recursive_copy_or_link(self, output, try_link, src, dst, exclude=(),
+                                skip=None, rewritten=None):
         IGNORED_FILES = [".gitignore", ".hgignore", "install.rdf"]
         IGNORED_FILE_SUFFIXES = ["~", ".test.js"]
         IGNORED_DIRS = [".svn", ".hg", "defaults", ".git"]
 
-        os.makedirs(dst)
+        output.add_dir(dst)
 
         def filter_filenames(filenames):
             for filename in filenames:
@@ -74,27 +108,56 @@ class Appifier(object):
 
         if try_link and platform.system() != 'Windows':
             for f in os.listdir(src):
-                if (f in IGNORED_DIRS or f in IGNORED_FILES or
+                if (f in IGNORED_DIRS or f in IGNORED_FILES or f in exclude or
                     any([f.endswith(suffix) for suffix in IGNORED_FILE_SUFFIXES])):
                     continue
-                os.symlink(os.path.join(src, f), os.path.join(dst, f))
+                output.add_link(os.path.join(src, f), os.path.join(dst, f))
         else:
             for dirpath, dirnames, filenames in os.walk(src):
                 goodfiles = list(filter_filenames(filenames))
+                if dirpath == src:
+                    goodfiles = [f for f in goodfiles if f not in exclude]
                 tgt_dir = dst
+                src_dir = ""
                 if dirpath != src:
-                    tgt_dir = os.path.join(tgt_dir, relpath(dirpath, src))
-                if not os.path.isdir(tgt_dir):
-                    os.makedirs(tgt_dir)
+                    src_dir = relpath(dirpath, src)
+                    tgt_dir = os.path.join(tgt_dir, src_dir)
+                if skip:
+                    # directories are made as files are put in them, so
+                    # none are left empty by what we skip
+                    goodfiles = [f for f in goodfiles
+                                 if os.path.join(src_dir, f) not in skip]
+                else:
+                    output.add_dir(tgt_dir)
                 for filename in goodfiles:
-                    shutil.copy(os.path.join(dirpath, filename), os.path.join(tgt_dir, filename))
+                    src_path = os.path.join(dirpath, filename)
+                    tgt_path = os.path.join(tgt_dir, filename)
+                    if rewritten and src_path in rewritten:
+                        output.add_contents(tgt_path, rewritten[src_path])
+                    else:
+                        output.add_file(src_path, tgt_path)
                 dirnames[:] = [dirname for dirname in dirnames if dirname not in IGNORED_DIRS]
 
     # generate a xul application (a directory with application.ini and other stuff)
     # the application will be placed in the build/ directory and the path to it
-    # will be returned
+    # will be returned.  with incremental=True a previous build in the same
+    # location is brought up to date rather than rebuilt from scratch.  with
+    # hardlink=True files are hardlinked rather than copied where possible.
+    # with archive set to one of ARCHIVE_FORMATS, the app is written straight
+    # into a single (reproducible) archive rather than a directory, and the
+    # path to the archive is returned.  with cached=True the build is skipped
+    # entirely when none of its inputs (nor harness_options) have changed
+    # since the last build into the same location; in that case
+    # harness_options are updated just as a build would have updated them.
+    # generated maps paths (relative to the app) to the contents of further
+    # files to write into it.  omit maps resource names to the paths (within
+    # each resource) of files to leave out of the app, and rewritten maps the
+    # paths of source files (in resources or browser code) to the contents to
+    # write in their place, when files are copied.
     def output_xul_app(self, browser_code, harness_options, dev_mode,
-                       verbose=True, output_dir=None):
+                       verbose=True, output_dir=None, incremental=False,
+                       hardlink=False, archive=None, cached=False,
+                       generated=None, omit=None, rewritten=None):
         browser_code_dir = browser_code
         browser_code_main = "index.html"
         if not os.path.isdir(browser_code_dir):
@@ -105,16 +168,70 @@ class Appifier(object):
         # specified we'll put the app output in build/ and remove
         # pre-existing output, otherwise we'll write into the location
         # and hope for the best.
-        if output_dir == None:
+        default_output = output_dir == None
+        if default_output:
             app_info = chromeless.AppInfo(dir=browser_code_dir)
             output_dir = os.path.join(self.dirs.build_dir, app_info.name) + ".xul"
+        if archive:
+            # an archive holds copies of everything, and is always rebuilt
+            output_dir += "." + archive
+            dev_mode = False
+            incremental = False
             if os.path.exists(output_dir):
+                os.remove(output_dir)
+
+        res_dir = os.path.join(os.path.dirname(__file__), "resources")
+
+        cache = None
+        if not archive:
+            cache = BuildCache(os.path.join(os.path.dirname(output_dir),
+                                            "." + os.path.basename(output_dir) + ".inputs.json"))
+            if not cached:
+                # whatever we build here won't be cached
+                cache.invalidate()
+                cache = None
+        if cache is not None:
+            # a cached build which is out of date is brought up to date in
+            # place rather than rebuilt
+            incremental = True
+            inputs = [res_dir, browser_code_dir] + sorted(harness_options['resources'].values())
+            digest = cache.digest(inputs, extra={
+                    "harness_options": harness_options,
+                    "browser_code_main": browser_code_main,
+                    "dev_mode": dev_mode,
+                    "hardlink": hardlink
+            })
+            built_options = os.path.join(output_dir, "harness-options.json")
+            # and the build must still be as we left it; if it's been
+            # meddled with, the incremental build below repairs it
+            if (cache.matches(digest) and os.path.isfile(built_options) and
+                output_intact(output_dir, self._manifest_path(output_dir))):
+                with open(built_options, 'r') as f:
+                    built = json.loads(f.read())
+                harness_options.clear()
+                harness_options.update(built)
+                if verbose:
+                    print "xul app in %s is up to date" % relpath(output_dir, self.dirs.cuddlefish_root)
+                return output_dir
+            # should this build fail, we mustn't trust what's left behind
+            cache.invalidate()
+
+        if default_output and not archive:
+            if os.path.exists(output_dir) and not incremental:
                 if verbose:
                     print "Removing old xul app"
                 shutil.rmtree(output_dir)
 
-        if not os.path.isdir(output_dir):
-            os.makedirs(output_dir)
+        engine = CopyEngine(hardlink=hardlink)
+        if archive:
+            output = ArchiveOutput(output_dir, archive)
+        elif incremental:
+            output = IncrementalOutput(output_dir,
+                                       self._manifest_path(output_dir), engine,
+                                       clear_unknown=default_output)
+        else:
+            output = DirectoryOutput(output_dir, engine)
+        output.add_dir("")
 
         if verbose:
             print "Building xulrunner app in >%s< ..." % output_dir 
@@ -122,73 +239,83 @@ class Appifier(object):
         # extract information about the application from appinfo.json
         app_info = chromeless.AppInfo(dir=browser_code_dir)
 
-        res_dir = os.path.join(os.path.dirname(__file__), "resources")
-
         # copy all the template files which require no substitution
         template_dir = os.path.join(res_dir, "xulrunner.template")
         if verbose:
             print "  ... copying application template"
 
-        for f in os.listdir(template_dir):
-            src = os.path.join(template_dir, f)
-            dst = os.path.join(output_dir, f)
-            if (os.path.isdir(src)):
-                shutil.copytree(src, dst)
-            else:
-                shutil.copy(src, dst)
+        for dirpath, dirnames, filenames in os.walk(template_dir):
+            tgt_dir = ""
+            if dirpath != template_dir:
+                tgt_dir = relpath(dirpath, template_dir)
+            output.add_dir(tgt_dir)
+            for filename in filenames:
+                output.add_file(os.path.join(dirpath, filename),
+                                os.path.join(tgt_dir, filename))
 
         # sub in application.ini
         if verbose:
             print "  ... creating application.ini"
 
         app_ini_template = os.path.join(res_dir, "application.ini.template")
-        app_ini_path = os.path.join(output_dir, "application.ini")
 
-        self._sub_and_copy(app_ini_template, app_ini_path, {
+        output.add_contents("application.ini", self._substitute(app_ini_template, {
                 "application_name": app_info.name,
                 "application_vendor": app_info.vendor,
                 "short_version": app_info.version,
                 "build_id": app_info.build_id,
                 "developer_email": app_info.developer_email
-        })
+        }))
 
         # now copy in required packages (and update harness options with new pathing
         # as we go)
         if verbose:
             print "  ... copying in CommonJS packages"
 
-        pkg_tgt_dir = os.path.join(output_dir, "packages")
+        # packages are placed in directories named without the (per run)
+        # harness guid, so that successive builds of an app line up
+        guid_prefix = None
+        if 'jetpackID' in harness_options:
+            guid_prefix = harness_options['jetpackID'] + "-"
 
         new_resources = {}
         for resource in harness_options['resources']:
-            base_arcpath = os.path.join('packages', resource)
-            new_resources[resource] = ['packages', resource]
+            pkg_dirname = resource
+            if guid_prefix and pkg_dirname.startswith(guid_prefix):
+                pkg_dirname = pkg_dirname[len(guid_prefix):]
+            new_resources[resource] = ['packages', pkg_dirname]
             abs_dirname = harness_options['resources'][resource]
             # Always create the directory, even if it contains no files,
             # since the harness will try to access it.
-            res_tgt_dir = os.path.join(pkg_tgt_dir, resource)
+            res_tgt_dir = os.path.join('packages', pkg_dirname)
 
             # in development mode we'll create symlinks.  otherwise we'll
             # recursively copy over required packages and filter out temp files
-            self._recursive_copy_or_link(try_link=dev_mode,
+            self._recursive_copy_or_link(output,
+                                         try_link=dev_mode,
                                          src=abs_dirname,
-                                         dst=res_tgt_dir)
+                                         dst=res_tgt_dir,
+                                         skip=omit and omit.get(resource),
+                                         rewritten=rewritten)
 
         harness_options['resources'] = new_resources
 
         # and browser code
         if verbose:
             print "  ... copying in browser code (%s)" % browser_code_dir 
-        self._recursive_copy_or_link(try_link=dev_mode,
+        self._recursive_copy_or_link(output,
+                                     try_link=dev_mode,
                                      src=browser_code_dir,
-                                     dst=os.path.join(output_dir, "browser_code"))
+                                     dst="browser_code",
+                                     exclude=["appinfo.json"],
+                                     rewritten=rewritten)
 
         # now re-write appinfo
         if verbose:
             print "  ... writing application info file"
 
-        with open(os.path.join(output_dir, "browser_code", "appinfo.json"), 'w') as f:
-            f.write(json.dumps(app_info.object, indent=4))
+        output.add_contents(os.path.join("browser_code", "appinfo.json"),
+                            json.dumps(app_info.object, indent=4))
 
         # now munge harness_options a bit to get correct path to browser_code in
         browser_code_path = "browser_code"
@@ -198,12 +325,25 @@ class Appifier(object):
         static_opts = harness_options['staticArgs']
         static_opts["browser"] = browser_code_path
 
+        if generated:
+            if verbose:
+                print "  ... writing generated files"
+            for gen_path in sorted(generated.keys()):
+                output.add_contents(gen_path, generated[gen_path])
+
         # and write harness options
         if verbose:
             print "  ... writing harness options"
 
-        with open(os.path.join(output_dir, "harness-options.json"), 'w') as f:
-            f.write(json.dumps(harness_options, indent=4))
+        output.add_contents("harness-options.json",
+                            json.dumps(harness_options, indent=4))
+
+        stats = output.close()
+        if verbose and stats:
+            print "  ... %(copied)d copied, %(linked)d linked, %(written)d written, %(unchanged)d unchanged, %(removed)d removed" % stats
+
+        if cache is not None:
+            cache.save(digest)
 
         # XXX: support for extra packages located outside of the packages/ directory!
 
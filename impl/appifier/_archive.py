@@ -0,0 +1,404 @@
+from __future__ import with_statement
+import os
+import time
+import zlib
+import struct
+import tarfile
+import zipfile
+from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from _copy import default_workers
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# ArchiveOutput writes a xul app straight into a single archive rather than
+# a directory.  Archives are reproducible: entries are sorted, timestamps
+# are fixed (to $SOURCE_DATE_EPOCH, if set) and ownership and permissions
+# are normalized, so building the same app twice yields identical bytes.
+# Compression is spread over a pool of threads (zlib releases the GIL).
+
+FORMATS = ["zip", "tar.gz"]
+if zstandard is not None:
+    FORMATS.append("tar.zst")
+
+# 1980-01-01, the earliest time a zip file can represent
+DEFAULT_TIMESTAMP = 315532800
+
+# entries are read and compressed a batch at a time, each batch holding up
+# to this many bytes of (uncompressed) data
+BATCH_BYTES = 16 * 1024 * 1024
+# files larger than this aren't read whole, but streamed into the archive
+# on their own, this much at a time
+STREAM_SIZE = 1024 * 1024
+READ_SIZE = 64 * 1024
+
+# tar output is cut into blocks of this size, each compressed as a separate
+# gzip member.  concatenated members form a valid gzip stream.
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+def archive_timestamp():
+    epoch = os.environ.get("SOURCE_DATE_EPOCH")
+    if epoch and epoch.isdigit():
+        return max(int(epoch), DEFAULT_TIMESTAMP)
+    return DEFAULT_TIMESTAMP
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _is_executable(path):
+    return os.name != 'nt' and bool(os.stat(path).st_mode & 0111)
+
+def _deflate(data):
+    co = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -15)
+    return co.compress(data) + co.flush()
+
+def _gzip_member(data):
+    # a gzip member with no file name and a zero mtime, so that the output
+    # depends only on the data
+    return ("\037\213\010\000" + struct.pack("<L", 0) + "\002\377" +
+            _deflate(data) +
+            struct.pack("<L", zlib.crc32(data) & 0xffffffffL) +
+            struct.pack("<L", len(data) & 0xffffffffL))
+
+class _ParallelGzipWriter(object):
+    def __init__(self, fileobj, pool, workers):
+        self._fileobj = fileobj
+        self._pool = pool
+        self._pending = []
+        self._pending_size = 0
+        self._flush_at = GZIP_BLOCK_SIZE * workers
+
+    def write(self, data):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= self._flush_at:
+            self._flush()
+
+    def _flush(self):
+        data = "".join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        blocks = [data[i:i + GZIP_BLOCK_SIZE]
+                  for i in range(0, len(data), GZIP_BLOCK_SIZE)]
+        for member in self._pool.map(_gzip_member, blocks):
+            self._fileobj.write(member)
+
+    def close(self):
+        if self._pending_size:
+            self._flush()
+
+# the largest size or offset a zip file can hold without zip64 extensions
+_ZIP32_MAX = 0xfffffffe
+
+def _dos_date_time(date_time):
+    year, month, day, hour, minute, second = date_time
+    return (((year - 1980) << 9) | (month << 5) | day,
+            (hour << 11) | (minute << 5) | (second // 2))
+
+class _ZipWriter(object):
+    # writes a zip file entry by entry, taking data compressed elsewhere
+    # (or streaming it in), with every entry given the same date_time
+
+    def __init__(self, fileobj, date_time):
+        self._fileobj = fileobj
+        self._offset = 0
+        self._date, self._time = _dos_date_time(date_time)
+        # (name, flags, method, crc, compress_size, file_size,
+        # external_attr, header_offset) of each entry written
+        self._entries = []
+
+    def _write(self, data):
+        self._fileobj.write(data)
+        self._offset += len(data)
+
+    def _name(self, name):
+        if isinstance(name, unicode):
+            return name.encode("utf-8"), 0x800
+        return name, 0
+
+    def _local_header(self, name, flags, method, crc, compress_size,
+                      file_size, zip64):
+        extra = ""
+        version = 20
+        if zip64:
+            extra = struct.pack("<HHQQ", 1, 16, file_size, compress_size)
+            file_size = compress_size = 0xffffffff
+            version = 45
+        return struct.pack("<LHHHHHLLLHH", 0x04034b50, version, flags, method,
+                           self._time, self._date, crc, compress_size,
+                           file_size, len(name), len(extra)) + name + extra
+
+    def add(self, name, compressed, crc, file_size, external_attr):
+        name, flags = self._name(name)
+        method = zipfile.ZIP_DEFLATED
+        if name.endswith("/"):
+            method = zipfile.ZIP_STORED
+        zip64 = max(file_size, len(compressed)) > _ZIP32_MAX
+        header_offset = self._offset
+        self._write(self._local_header(name, flags, method, crc,
+                                       len(compressed), file_size, zip64))
+        self._write(compressed)
+        self._entries.append((name, flags, method, crc, len(compressed),
+                              file_size, external_attr, header_offset))
+
+    def add_stream(self, name, f, file_size, external_attr):
+        # the header is written with room for the sizes and crc, and filled
+        # in once they're known.  deflate can grow data a little, so zip64
+        # extensions are used if the compressed size may need them.
+        name, flags = self._name(name)
+        method = zipfile.ZIP_DEFLATED
+        zip64 = file_size + (file_size >> 10) + 1024 > _ZIP32_MAX
+        header_offset = self._offset
+        self._write(self._local_header(name, flags, method, 0, 0, 0, zip64))
+        co = zlib.compressobj(zlib.Z_BEST_COMPRESSION, zlib.DEFLATED, -15)
+        crc = 0
+        file_size = 0
+        data_offset = self._offset
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            self._write(co.compress(chunk))
+        self._write(co.flush())
+        crc &= 0xffffffff
+        compress_size = self._offset - data_offset
+        self._fileobj.seek(header_offset)
+        self._fileobj.write(self._local_header(name, flags, method, crc,
+                                               compress_size, file_size, zip64))
+        self._fileobj.seek(self._offset)
+        self._entries.append((name, flags, method, crc, compress_size,
+                              file_size, external_attr, header_offset))
+
+    def close(self):
+        cd_offset = self._offset
+        for (name, flags, method, crc, compress_size, file_size,
+             external_attr, header_offset) in self._entries:
+            # values too large for their fields go in a zip64 extra field,
+            # in this order
+            extra = ""
+            if file_size > _ZIP32_MAX:
+                extra += struct.pack("<Q", file_size)
+                file_size = 0xffffffff
+            if compress_size > _ZIP32_MAX:
+                extra += struct.pack("<Q", compress_size)
+                compress_size = 0xffffffff
+            if header_offset > _ZIP32_MAX:
+                extra += struct.pack("<Q", header_offset)
+                header_offset = 0xffffffff
+            version = 20
+            if extra:
+                extra = struct.pack("<HH", 1, len(extra)) + extra
+                version = 45
+            # made by unix, so that permissions are honored
+            self._write(struct.pack("<LHHHHHHLLLHHHHHLL", 0x02014b50,
+                                    (3 << 8) | version, version, flags,
+                                    method, self._time, self._date, crc,
+                                    compress_size, file_size, len(name),
+                                    len(extra), 0, 0, 0, external_attr,
+                                    header_offset) + name + extra)
+        cd_size = self._offset - cd_offset
+        count = len(self._entries)
+        if count > 0xffff or max(cd_offset, cd_size) > _ZIP32_MAX:
+            zip64_offset = self._offset
+            self._write(struct.pack("<LQHHLLQQQQ", 0x06064b50, 44,
+                                    (3 << 8) | 45, 45, 0, 0, count, count,
+                                    cd_size, cd_offset))
+            self._write(struct.pack("<LLQL", 0x07064b50, 0, zip64_offset, 1))
+        self._write(struct.pack("<LHHHHLLH", 0x06054b50, 0, 0,
+                                min(count, 0xffff), min(count, 0xffff),
+                                min(cd_size, 0xffffffff),
+                                min(cd_offset, 0xffffffff), 0))
+
+class ArchiveOutput(object):
+    def __init__(self, path, format, workers=None):
+        if format not in FORMATS:
+            raise ValueError("unsupported archive format '%s' (try one of: %s)" %
+                             (format, ", ".join(FORMATS)))
+        if workers is None:
+            workers = default_workers()
+        self.root = path
+        self._format = format
+        self._workers = workers
+        self._timestamp = archive_timestamp()
+        # archive path -> ("dir", None), ("file", source path), or
+        # ("data", contents)
+        self._entries = {}
+
+    def _name(self, relpath):
+        return "/".join([p for p in relpath.split(os.sep) if p and p != "."])
+
+    def add_dir(self, relpath):
+        name = self._name(relpath)
+        while name:
+            self._entries[name + "/"] = ("dir", None)
+            name = name.rpartition("/")[0]
+
+    def add_file(self, src, relpath):
+        self.add_dir(os.path.dirname(relpath))
+        self._entries[self._name(relpath)] = ("file", src)
+
+    # archives hold no links, so the target's contents are included
+    def add_link(self, src, relpath):
+        if not os.path.isdir(src):
+            self.add_file(src, relpath)
+            return
+        for dirpath, dirnames, filenames in os.walk(src):
+            tgt_dir = os.path.join(relpath, dirpath[len(src):].lstrip(os.sep))
+            self.add_dir(tgt_dir)
+            for filename in filenames:
+                self.add_file(os.path.join(dirpath, filename),
+                              os.path.join(tgt_dir, filename))
+
+    def add_contents(self, relpath, contents):
+        self.add_dir(os.path.dirname(relpath))
+        if isinstance(contents, unicode):
+            contents = contents.encode("utf-8")
+        self._entries[self._name(relpath)] = ("data", contents)
+
+    def _size(self, name):
+        kind, value = self._entries[name]
+        if kind == "file":
+            return os.path.getsize(value)
+        if kind == "data":
+            return len(value)
+        return 0
+
+    # the entries, in order, in batches to be read (and compressed) at
+    # once, as (names, streamed): a streamed batch is a single file too
+    # large to be read whole
+    def _batches(self):
+        batch = []
+        batch_size = 0
+        for name in sorted(self._entries.keys()):
+            size = self._size(name)
+            if self._entries[name][0] == "file" and size > STREAM_SIZE:
+                if batch:
+                    yield batch, False
+                    batch = []
+                    batch_size = 0
+                yield [name], True
+                continue
+            if batch and batch_size + size > BATCH_BYTES:
+                yield batch, False
+                batch = []
+                batch_size = 0
+            batch.append(name)
+            batch_size += size
+        if batch:
+            yield batch, False
+
+    # read an entry, returning (data, executable)
+    def _load(self, name):
+        kind, value = self._entries[name]
+        if kind == "file":
+            return _read(value), _is_executable(value)
+        if kind == "data":
+            return value, False
+        return "", False
+
+    def _zip_entry(self, name):
+        data, executable = self._load(name)
+        if self._entries[name][0] == "dir":
+            return name, data, 0, 0, False
+        return name, _deflate(data), zlib.crc32(data) & 0xffffffff, len(data), executable
+
+    def _write_zip(self, pool):
+        with open(self.root, 'wb') as f:
+            zf = _ZipWriter(f, time.gmtime(self._timestamp)[:6])
+            for batch, streamed in self._batches():
+                if streamed:
+                    src = self._entries[batch[0]][1]
+                    mode = _is_executable(src) and 0100755 or 0100644
+                    with open(src, 'rb') as data:
+                        zf.add_stream(batch[0], data, os.path.getsize(src),
+                                      mode << 16)
+                    continue
+                for name, compressed, crc, size, executable in pool.map(self._zip_entry, batch):
+                    if name.endswith("/"):
+                        external_attr = (040755 << 16) | 0x10
+                    else:
+                        external_attr = (executable and 0100755 or 0100644) << 16
+                    zf.add(name, compressed, crc, size, external_attr)
+            zf.close()
+
+    def _tar_entry(self, name):
+        data, executable = self._load(name)
+        return name, data, executable
+
+    def _tar_info(self, name, executable, size=0):
+        info = tarfile.TarInfo(name.rstrip("/"))
+        info.mtime = self._timestamp
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        if name.endswith("/"):
+            info.type = tarfile.DIRTYPE
+            info.mode = 0755
+        else:
+            info.mode = executable and 0755 or 0644
+            info.size = size
+        return info
+
+    def _write_tar(self, pool):
+        with open(self.root, 'wb') as f:
+            if self._format == "tar.zst":
+                compressor = zstandard.ZstdCompressor(level=19, threads=self._workers)
+                stream = compressor.stream_writer(f)
+            else:
+                stream = _ParallelGzipWriter(f, pool, self._workers)
+            tar = tarfile.open(mode="w|", fileobj=stream, format=tarfile.GNU_FORMAT)
+            for batch, streamed in self._batches():
+                if streamed:
+                    src = self._entries[batch[0]][1]
+                    info = self._tar_info(batch[0], _is_executable(src),
+                                          os.path.getsize(src))
+                    with open(src, 'rb') as data:
+                        tar.addfile(info, data)
+                    continue
+                for name, data, executable in pool.map(self._tar_entry, batch):
+                    if name.endswith("/"):
+                        tar.addfile(self._tar_info(name, False))
+                    else:
+                        tar.addfile(self._tar_info(name, executable, len(data)),
+                                    StringIO(data))
+            tar.close()
+            stream.close()
+
+    def close(self):
+        parent = os.path.dirname(self.root)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        pool = ThreadPool(self._workers)
+        try:
+            if self._format == "zip":
+                self._write_zip(pool)
+            else:
+                self._write_tar(pool)
+        finally:
+            pool.close()
+            pool.join()
+        return {}
+
+# pack an existing directory tree into an archive at path, with its contents
+# placed under prefix
+def archive_directory(root, path, format, prefix=""):
+    output = ArchiveOutput(path, format)
+    output.add_dir(prefix)
+    for dirpath, dirnames, filenames in os.walk(root):
+        tgt_dir = os.path.join(prefix, dirpath[len(root):].lstrip(os.sep))
+        output.add_dir(tgt_dir)
+        for name in dirnames:
+            if os.path.islink(os.path.join(dirpath, name)):
+                output.add_link(os.path.join(dirpath, name),
+                                os.path.join(tgt_dir, name))
+        for name in filenames:
+            output.add_file(os.path.join(dirpath, name),
+                            os.path.join(tgt_dir, name))
+    output.close()
+    return path
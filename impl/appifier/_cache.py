@@ -0,0 +1,80 @@
+from __future__ import with_statement
+import os
+import hashlib
+import simplejson as json
+from _output import _hash_file
+
+# A BuildCache remembers a digest of everything a build was made from, so
+# that a build whose inputs haven't changed can be skipped.  The digest
+# covers the contents of every input file; to keep checking cheap the md5 of
+# each file is remembered along with its size and mtime, and is only
+# recomputed for files which have been touched since.
+
+# directories we never look inside
+IGNORED_DIRS = [".svn", ".hg", ".git"]
+
+class BuildCache(object):
+    def __init__(self, record_path):
+        self._record_path = record_path
+        self._record = {}
+        if os.path.isfile(record_path):
+            try:
+                with open(record_path, 'r') as f:
+                    self._record = json.loads(f.read())
+            except ValueError:
+                self._record = {}
+        self._old_files = self._record.get("files", {})
+        self._files = {}
+
+    def _file_digest(self, path):
+        st = os.stat(path)
+        old = self._old_files.get(path)
+        if old and old[0] == st.st_size and old[1] == st.st_mtime:
+            digest = old[2]
+        else:
+            digest = _hash_file(path)
+        self._files[path] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    # compute the digest of a build from the given input files and
+    # directories, along with extra, a json-able description of anything
+    # else the build depends on
+    def digest(self, inputs, extra=None):
+        sig = hashlib.md5()
+        sig.update(json.dumps(extra, sort_keys=True))
+        for path in inputs:
+            sig.update("\0input\0" + path)
+            if not os.path.isdir(path):
+                if os.path.exists(path):
+                    sig.update("\0" + self._file_digest(path))
+                continue
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted([d for d in dirnames if d not in IGNORED_DIRS])
+                sig.update("\0dir\0" + dirpath)
+                for filename in sorted(filenames):
+                    filepath = os.path.join(dirpath, filename)
+                    if not os.path.exists(filepath):
+                        # a dangling link
+                        continue
+                    sig.update("\0file\0" + filename + "\0" +
+                               self._file_digest(filepath))
+        return sig.hexdigest()
+
+    # whether the last build recorded had the given digest
+    def matches(self, digest):
+        return self._record.get("digest") == digest
+
+    # record a successful build with the given digest
+    def save(self, digest):
+        self._record = { "digest": digest, "files": self._files }
+        tmp = self._record_path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self._record))
+        if os.path.exists(self._record_path) and os.name == 'nt':
+            os.remove(self._record_path)
+        os.rename(tmp, self._record_path)
+
+    # forget the last build, it's being replaced
+    def invalidate(self):
+        if os.path.exists(self._record_path):
+            os.remove(self._record_path)
@@ -0,0 +1,193 @@
+import os
+import sys
+import errno
+import shutil
+import threading
+import Queue
+
+# A small engine for copying many files at once.  Copies are handed to a
+# pool of threads (copying is I/O bound, so the GIL isn't much of a
+# concern), and on linux files are reflinked where the filesystem allows,
+# or the data is moved by the kernel with copy_file_range() or sendfile()
+# rather than through python.  Optionally, files are hardlinked rather than
+# copied when source and destination share a filesystem.
+
+def default_workers():
+    try:
+        import multiprocessing
+        return min(16, multiprocessing.cpu_count() * 2)
+    except (ImportError, NotImplementedError):
+        return 4
+
+def _load_kernel_copy():
+    # returns a function (in_fd, out_fd, count) -> bytes copied, or None if
+    # the kernel can't copy for us
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+    except (ImportError, OSError):
+        return None
+
+    # both calls are used with NULL offsets, so they read and write at (and
+    # advance) each file's current position
+    if hasattr(libc, "copy_file_range"):
+        fn = libc.copy_file_range
+        fn.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                       ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+        fn.restype = ctypes.c_ssize_t
+        def copy_file_range(in_fd, out_fd, count):
+            return fn(in_fd, None, out_fd, None, count, 0)
+        copy_file_range.errno = ctypes.get_errno
+        return copy_file_range
+    if hasattr(libc, "sendfile"):
+        fn = libc.sendfile
+        fn.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                       ctypes.c_size_t]
+        fn.restype = ctypes.c_ssize_t
+        def sendfile(in_fd, out_fd, count):
+            return fn(out_fd, in_fd, None, count)
+        sendfile.errno = ctypes.get_errno
+        return sendfile
+    return None
+
+_kernel_copy = _load_kernel_copy()
+
+# the FICLONE ioctl asks filesystems that support it (btrfs, xfs) to share
+# the source's blocks with the destination, copy-on-write
+FICLONE = 0x40049409
+
+def reflink(fsrc, fdst):
+    """Try to make fdst a copy-on-write clone of fsrc, returning success."""
+
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        import fcntl
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except (ImportError, IOError, OSError):
+        return False
+
+# the most we'll ask the kernel to copy in one call
+KERNEL_COPY_CHUNK = 1024 * 1024 * 16
+
+def copy_file(src, dst):
+    """Copy the data and permission bits of src to dst, like shutil.copy."""
+
+    # never write through an existing file, it may be a hardlink to (or
+    # share storage with) some source
+    if os.path.lexists(dst):
+        os.remove(dst)
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            copied = 0
+            if reflink(fsrc, fdst):
+                pass
+            elif _kernel_copy is not None:
+                while True:
+                    n = _kernel_copy(fsrc.fileno(), fdst.fileno(), KERNEL_COPY_CHUNK)
+                    if n > 0:
+                        copied += n
+                        continue
+                    if n == 0:
+                        break
+                    err = _kernel_copy.errno()
+                    if err == errno.EINTR:
+                        continue
+                    if copied or err not in (errno.EINVAL, errno.ENOSYS,
+                                             errno.EXDEV, errno.EOPNOTSUPP,
+                                             errno.EBADF):
+                        raise OSError(err, os.strerror(err), src)
+                    # this pair of files can't be copied by the kernel,
+                    # do it the old fashioned way
+                    shutil.copyfileobj(fsrc, fdst, 1024 * 64)
+                    break
+            else:
+                shutil.copyfileobj(fsrc, fdst, 1024 * 64)
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+    shutil.copymode(src, dst)
+
+class CopyEngine(object):
+    def __init__(self, workers=None, hardlink=False):
+        if workers is None:
+            workers = default_workers()
+        self._workers = workers
+        self._hardlink = hardlink and hasattr(os, "link")
+        self._queue = None
+        self._threads = []
+        self._errors = []
+        self._devices = {}
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            fn, args = job
+            try:
+                fn(*args)
+            except Exception, e:
+                self._errors.append(e)
+
+    # run fn(*args) on the pool.  with a single worker, jobs run immediately.
+    def submit(self, fn, *args):
+        if self._workers <= 1:
+            fn(*args)
+            return
+        if self._queue is None:
+            # bound the queue so a huge tree doesn't queue up in memory
+            self._queue = Queue.Queue(self._workers * 64)
+            for i in range(self._workers):
+                t = threading.Thread(target=self._worker)
+                t.setDaemon(True)
+                t.start()
+                self._threads.append(t)
+        self._queue.put((fn, args))
+
+    def _device(self, path):
+        if path not in self._devices:
+            self._devices[path] = os.stat(path).st_dev
+        return self._devices[path]
+
+    def can_link(self, src, dst):
+        return (self._hardlink and
+                os.stat(src).st_dev == self._device(os.path.dirname(dst)))
+
+    # copy (or hardlink) src to dst, now
+    def copy_now(self, src, dst):
+        if self.can_link(src, dst):
+            if os.path.lexists(dst):
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                pass
+        copy_file(src, dst)
+
+    def copy(self, src, dst):
+        self.submit(self.copy_now, src, dst)
+
+    # wait for all submitted jobs to finish, raising the first error any
+    # of them hit
+    def wait(self):
+        if self._queue is not None:
+            for t in self._threads:
+                self._queue.put(None)
+            for t in self._threads:
+                while t.isAlive():
+                    t.join(0.5)
+            self._queue = None
+            self._threads = []
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise errors[0]
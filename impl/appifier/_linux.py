@@ -4,6 +4,9 @@ import shutil
 from string import Template
 import simplejson as json
 import platform
+from _relpath import relpath
+from _copy import CopyEngine
+from _output import IncrementalOutput
 
 class OSAppifier(object):
     def __init__(self):
@@ -11,10 +14,18 @@ class OSAppifier(object):
         # as properties
         self.dirs = chromeless.Dirs()
 
-    def output_app_shell(self, browser_code_dir, dev_mode, verbose=True):
+    # with hardlink=True the xulrunner runtime in the app is populated with
+    # hardlinks (or reflinks, or copies, whichever the filesystem allows)
+    # and kept in step with build/xulrunner using a manifest, rather than
+    # being deleted and recopied each time.  with incremental=True the rest
+    # of a previous build is left for the xul app build to bring up to date.
+    def output_app_shell(self, browser_code_dir, dev_mode, verbose=True,
+                         hardlink=False, build_dir=None, incremental=False):
         # first, determine the application name
         app_info = chromeless.AppInfo(dir=browser_code_dir)
-        output_dir = os.path.join(self.dirs.build_dir, app_info.name)
+        if build_dir is None:
+            build_dir = self.dirs.build_dir
+        output_dir = os.path.join(build_dir, app_info.name)
 
         if verbose:
             print "Building application in >%s< ..." % output_dir 
@@ -23,9 +34,25 @@ class OSAppifier(object):
         if os.path.exists(output_dir):
             if verbose:
                 print "  ... removing previous application"
-            shutil.rmtree(output_dir)
+            if hardlink or incremental:
+                # everything but what's brought up to date in place: the
+                # runtime, with hardlink, and the rest, with incremental
+                for f in os.listdir(output_dir):
+                    path = os.path.join(output_dir, f)
+                    if f == "xulrunner":
+                        if hardlink and not os.path.islink(path):
+                            continue
+                    elif incremental:
+                        continue
+                    if os.path.isdir(path) and not os.path.islink(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+            else:
+                shutil.rmtree(output_dir)
 
-        os.makedirs(output_dir)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
 
         # create the current version dir
         xul_src = os.path.join(self.dirs.build_dir, "xulrunner")
@@ -34,7 +61,36 @@ class OSAppifier(object):
         # and recursivly copy in the bin/ directory out of the sdk 
         if verbose:
             print "  ... copying in xulrunner binaries"
-        shutil.copytree(xul_src, xul_dst)
+        engine = CopyEngine(hardlink=hardlink)
+        if hardlink:
+            # the runtime is large and never changes, so its manifest
+            # records sizes and mtimes but doesn't bother with checksums
+            manifest_path = os.path.join(build_dir,
+                                         "." + app_info.name + ".xulrunner.manifest.json")
+            output = IncrementalOutput(xul_dst, manifest_path, engine,
+                                       hash_files=False)
+            for dirpath, dirnames, filenames in os.walk(xul_src):
+                tgt_dir = ""
+                if dirpath != xul_src:
+                    tgt_dir = relpath(dirpath, xul_src)
+                output.add_dir(tgt_dir)
+                # os.walk doesn't descend into symlinked directories, so
+                # they're linked as they are
+                for dirname in dirnames:
+                    src = os.path.join(dirpath, dirname)
+                    if os.path.islink(src):
+                        output.add_link(os.readlink(src), os.path.join(tgt_dir, dirname))
+                for filename in filenames:
+                    src = os.path.join(dirpath, filename)
+                    if os.path.islink(src):
+                        output.add_link(os.readlink(src), os.path.join(tgt_dir, filename))
+                    else:
+                        output.add_file(src, os.path.join(tgt_dir, filename))
+            stats = output.close()
+            if verbose:
+                print "  ... %(copied)d linked or copied, %(unchanged)d unchanged, %(removed)d removed" % stats
+        else:
+            shutil.copytree(xul_src, xul_dst)
 
         # we'll copy over the xulrunner-stub binary to the top leve
         if verbose:
@@ -42,6 +98,6 @@ class OSAppifier(object):
 
         xulrunner_stub_path = os.path.join(output_dir, "xulrunner", "xulrunner-stub")
         final_binary_path = os.path.join(output_dir, app_info.name)
-        shutil.copy(xulrunner_stub_path,  final_binary_path)
+        engine.copy_now(xulrunner_stub_path,  final_binary_path)
 
         return { "xulrunner_app_dir": output_dir, "output_dir": output_dir } 
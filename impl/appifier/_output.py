@@ -0,0 +1,270 @@
+from __future__ import with_statement
+import os
+import shutil
+import hashlib
+import simplejson as json
+from _copy import CopyEngine
+
+# Outputs are the things the appifier writes a xul application into.  The
+# appifier describes the tree it wants (files copied from a source,
+# symlinks to a source, and generated contents) by path relative to the
+# root of the output, and the output takes care of getting them there.
+
+# writes the tree into an (empty) directory on disk
+class DirectoryOutput(object):
+    def __init__(self, root, engine=None):
+        self.root = root
+        self._made = set()
+        # file copies are handed to a CopyEngine, which may run them in
+        # parallel; they're only known to be done once close() returns
+        if engine is None:
+            engine = CopyEngine()
+        self._engine = engine
+
+    def _path(self, relpath):
+        return os.path.join(self.root, relpath)
+
+    def add_dir(self, relpath):
+        path = self._path(relpath)
+        if path not in self._made and not os.path.isdir(path):
+            os.makedirs(path)
+        self._made.add(path)
+
+    def add_file(self, src, relpath):
+        self.add_dir(os.path.dirname(relpath))
+        self._engine.copy(src, self._path(relpath))
+
+    def add_link(self, src, relpath):
+        self.add_dir(os.path.dirname(relpath))
+        os.symlink(src, self._path(relpath))
+
+    def add_contents(self, relpath, contents):
+        self.add_dir(os.path.dirname(relpath))
+        with open(self._path(relpath), 'w') as f:
+            f.write(contents)
+
+    def close(self):
+        self._engine.wait()
+        return {}
+
+def _hash_and_copy(src, dst):
+    # never write through an existing file, it may be a hardlink to a source
+    if os.path.lexists(dst):
+        os.remove(dst)
+    sig = hashlib.md5()
+    with open(src, 'rb') as i:
+        with open(dst, 'wb') as o:
+            while True:
+                chunk = i.read(1024 * 64)
+                if not chunk: break
+                sig.update(chunk)
+                o.write(chunk)
+    shutil.copymode(src, dst)
+    return sig.hexdigest()
+
+def _hash_file(path):
+    sig = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 64)
+            if not chunk: break
+            sig.update(chunk)
+    return sig.hexdigest()
+
+# whether the tree at root is still just as the IncrementalOutput which
+# kept manifest_path left it: everything written there, and unmodified
+# (going by sizes and mtimes)
+def output_intact(root, manifest_path):
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.loads(f.read())
+    except (IOError, ValueError):
+        return False
+    if not manifest:
+        return False
+    for relpath, record in manifest.items():
+        path = os.path.join(root, relpath)
+        if "link" in record:
+            if not os.path.islink(path) or os.readlink(path) != record["link"]:
+                return False
+            continue
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        if (os.path.islink(path) or st.st_size != record.get("out_size") or
+            st.st_mtime != record.get("out_mtime")):
+            return False
+    return True
+
+# brings a previously built tree up to date, touching only what changed.
+# a manifest of what was written on the last build (the source of each file
+# along with its size, mtime and md5, or the target of each link) is kept in
+# manifest_path.  files whose source and output are unchanged are left
+# alone, generated files are only rewritten when their contents differ, and
+# anything written last time but not this time is removed.
+class IncrementalOutput(DirectoryOutput):
+    # with hash_files=False no md5s are kept, so a source which is touched
+    # is copied again even if its contents didn't change.  clear_unknown
+    # says whether root may be emptied when there's no manifest for it.
+    def __init__(self, root, manifest_path, engine=None, hash_files=True,
+                 clear_unknown=True):
+        DirectoryOutput.__init__(self, root, engine)
+        self._manifest_path = manifest_path
+        self._hash_files = hash_files
+        self._old = {}
+        self._new = {}
+        self.stats = { "copied": 0, "linked": 0, "written": 0,
+                       "unchanged": 0, "removed": 0 }
+        if os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path, 'r') as f:
+                    self._old = json.loads(f.read())
+            except ValueError:
+                self._old = {}
+        if not self._old and clear_unknown and os.path.exists(root):
+            # we don't know what's in there, so start from scratch
+            shutil.rmtree(root)
+
+    def _clear(self, path):
+        if os.path.islink(path) or os.path.isfile(path):
+            os.remove(path)
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+
+    def add_dir(self, relpath):
+        # every component of the path must be a real directory.  a symlink
+        # left over from a development build would otherwise have us writing
+        # into the source tree.
+        path = self._path(relpath)
+        if path in self._made:
+            return
+        parent = os.path.dirname(relpath)
+        if parent and parent != relpath:
+            self.add_dir(parent)
+        if os.path.islink(path) or (os.path.exists(path) and not os.path.isdir(path)):
+            os.remove(path)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._made.add(path)
+
+    def _output_matches(self, path, record):
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return False
+        return (not os.path.islink(path) and st.st_size == record.get("out_size")
+                and st.st_mtime == record.get("out_mtime"))
+
+    def _record_output(self, path, record):
+        st = os.stat(path)
+        record["out_size"] = st.st_size
+        record["out_mtime"] = st.st_mtime
+        return record
+
+    def add_file(self, src, relpath):
+        self.add_dir(os.path.dirname(relpath))
+        path = self._path(relpath)
+        st = os.stat(src)
+        old = self._old.get(relpath)
+        if old and old.get("src") == src and self._output_matches(path, old):
+            if old.get("size") == st.st_size and old.get("mtime") == st.st_mtime:
+                self._new[relpath] = old
+                self.stats["unchanged"] += 1
+                return
+            # the source was touched, but perhaps not changed
+            if self._hash_files and _hash_file(src) == old.get("hash"):
+                record = dict(old, size=st.st_size, mtime=st.st_mtime)
+                self._new[relpath] = record
+                self.stats["unchanged"] += 1
+                return
+        if os.path.islink(path) or os.path.isdir(path):
+            self._clear(path)
+        record = { "src": src, "size": st.st_size, "mtime": st.st_mtime }
+        self._new[relpath] = record
+        self._engine.submit(self._copy_and_record, src, path, record)
+        self.stats["copied"] += 1
+
+    # runs on the copy engine: we need the md5 of what we copy, so data
+    # passes through python unless we can just link to the source
+    def _copy_and_record(self, src, path, record):
+        if not self._hash_files:
+            self._engine.copy_now(src, path)
+        elif self._engine.can_link(src, path):
+            record["hash"] = _hash_file(src)
+            self._engine.copy_now(src, path)
+        else:
+            record["hash"] = _hash_and_copy(src, path)
+        self._record_output(path, record)
+
+    def add_link(self, src, relpath):
+        self.add_dir(os.path.dirname(relpath))
+        path = self._path(relpath)
+        self._new[relpath] = { "link": src }
+        if os.path.islink(path) and os.readlink(path) == src:
+            self.stats["unchanged"] += 1
+            return
+        self._clear(path)
+        os.symlink(src, path)
+        self.stats["linked"] += 1
+
+    def add_contents(self, relpath, contents):
+        self.add_dir(os.path.dirname(relpath))
+        path = self._path(relpath)
+        record = self._new[relpath] = { "generated": True }
+        if os.path.isfile(path) and not os.path.islink(path):
+            with open(path, 'r') as f:
+                if f.read() == contents:
+                    self._record_output(path, record)
+                    self.stats["unchanged"] += 1
+                    return
+        self._clear(path)
+        with open(path, 'w') as f:
+            f.write(contents)
+        self._record_output(path, record)
+        self.stats["written"] += 1
+
+    # whether a path lies in the output proper, rather than being reached
+    # through a symlink (into some source tree) left by a previous build
+    def _in_tree(self, relpath):
+        parent = os.path.dirname(relpath)
+        while parent:
+            if os.path.islink(self._path(parent)):
+                return False
+            parent = os.path.dirname(parent)
+        return True
+
+    def close(self):
+        self._engine.wait()
+        # remove whatever we wrote last time, but not this time.  only
+        # remove things that are still what we left there: a stale link may
+        # since have been replaced by a directory we now populate, and a
+        # stale file may now be visible through a link into the source.
+        emptied = set()
+        for relpath, record in self._old.items():
+            if relpath in self._new or not self._in_tree(relpath):
+                continue
+            path = self._path(relpath)
+            if "link" in record:
+                if not os.path.islink(path):
+                    continue
+            elif os.path.islink(path) or not os.path.isfile(path):
+                continue
+            os.remove(path)
+            emptied.add(os.path.dirname(path))
+            self.stats["removed"] += 1
+        # and prune directories left empty, deepest first
+        for d in sorted(emptied, key=len, reverse=True):
+            while (d.startswith(os.path.join(self.root, "")) and
+                   not os.path.islink(d) and os.path.isdir(d) and
+                   not os.listdir(d)):
+                os.rmdir(d)
+                d = os.path.dirname(d)
+
+        tmp = self._manifest_path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self._new))
+        if os.path.exists(self._manifest_path) and os.name == 'nt':
+            os.remove(self._manifest_path)
+        os.rename(tmp, self._manifest_path)
+        return self.stats
@@ -11,10 +11,14 @@ class OSAppifier(object):
         # as properties
         self.dirs = chromeless.Dirs()
 
-    def output_app_shell(self, browser_code_dir, dev_mode, verbose=True):
+    # (hardlink and incremental are only honored on linux)
+    def output_app_shell(self, browser_code_dir, dev_mode, verbose=True,
+                         hardlink=False, build_dir=None, incremental=False):
         # first, determine the application name
         app_info = chromeless.AppInfo(dir=browser_code_dir)
-        output_dir = os.path.join(self.dirs.build_dir, app_info.name)
+        if build_dir is None:
+            build_dir = self.dirs.build_dir
+        output_dir = os.path.join(build_dir, app_info.name)
 
         if verbose:
             print "Building application in >%s< ..." % output_dir 
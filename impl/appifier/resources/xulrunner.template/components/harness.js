@@ -116,12 +116,19 @@ function buildHarnessService(rootFileSpec, dump, logError,
   // The Jetpack program's main module.
   var program;
 
+  // If we're serving jobs (see options.controlChannel), the channel they
+  // come in over, and the id of the job being run, if any.
+  var control;
+  var jobId = null;
+
   var ioService = Cc["@mozilla.org/network/io-service;1"]
                   .getService(Ci.nsIIOService);
   var resProt = ioService.getProtocolHandler("resource")
                 .QueryInterface(Ci.nsIResProtocolHandler);
 
-  function quit(status) {
+  // details is an optional object of anything more to report along with
+  // the status, such as test counts.
+  function quit(status, details) {
     if (status === undefined)
       status = "OK";
     if (status != "OK" && status != "FAIL") {
@@ -133,12 +140,89 @@ function buildHarnessService(rootFileSpec, dump, logError,
     if (isQuitting)
       return;
 
+    if (control) {
+      finishJob(status, details);
+      return;
+    }
+
     isQuitting = true;
 
     if (harnessService)
       harnessService.unload();
 
-    onQuit(status);
+    onQuit(status, details);
+  }
+
+  // Each job run while serving is a program run, with options of its own,
+  // in a loader of its own.  Rather than quitting, a finished job reports
+  // over the control channel, and the app waits for the next job.
+  function runJob(job) {
+    if (job.quit) {
+      control.close();
+      control = null;
+      quit("OK");
+      return;
+    }
+    if (jobId !== null) {
+      control.send({id: job.id, status: "FAIL",
+                    error: "a job is already running"});
+      return;
+    }
+    var bootstrap = options.bootstrap;
+    options = job.options;
+    options.bootstrap = bootstrap;
+    jobId = job.id;
+    try {
+      loader = buildLoader();
+      program = loader.require(options.main);
+      if ('main' in program)
+        program.main(options, {quit: quit, print: dump});
+    } catch (e) {
+      if (loader)
+        loader.console.exception(e);
+      else
+        logError(e);
+      quit("FAIL");
+    }
+  }
+
+  function finishJob(status, details) {
+    if (jobId === null)
+      return;
+    var message = {id: jobId, status: status};
+    for (var name in details)
+      if (!(name in message))
+        message[name] = details[name];
+    jobId = null;
+    unloadProgram("disable");
+    // Mark the end of the job's output, so that whatever is reading it
+    // can tell one job's output from the next's.
+    dump("\n" + control.token + " " + message.id + "\n");
+    control.send(message);
+  }
+
+  // Notifies the program and the loader of unload, and forgets them.
+  function unloadProgram(reason) {
+    if (program) {
+      if (typeof(program.onUnload) === "function") {
+        try {
+          program.onUnload(reason);
+        }
+        catch (err) {
+          if (loader)
+            loader.console.exception(err);
+        }
+      }
+      program = null;
+    }
+
+    if (loader) {
+      loader.unload(reason);
+      loader = null;
+    }
+
+    for (name in options.resources)
+      resProt.setSubstitution(name, null);
   }
 
   function logErrorAndBail(e) {
@@ -174,10 +258,20 @@ function buildHarnessService(rootFileSpec, dump, logError,
       resProt.setSubstitution(name, dirUri);
     }
 
+    // bundles of preloaded modules, if the app was built with them
+    var bundles = [];
+    if (options.bundles)
+      options.bundles.forEach(function(path) {
+        var file = rootFileSpec.clone();
+        path.forEach(function(part) { file.append(part); });
+        bundles.push(ioService.newFileURI(file).spec);
+      });
+
     var jsm = {};
     Cu.import(options.loader, jsm);
     var packaging = new Packaging();
     var loader = new jsm.Loader({rootPaths: options.rootPaths.slice(),
+                                 bundles: bundles,
                                  print: dump,
                                  packaging: packaging,
                                  globals: { packaging: packaging }
@@ -216,9 +310,13 @@ function buildHarnessService(rootFileSpec, dump, logError,
       return options;
     },
 
-    jetpackID: options.jetpackID,
+    get jetpackID() {
+      return options.jetpackID;
+    },
 
-    bundleID: options.bundleID,
+    get bundleID() {
+      return options.bundleID;
+    },
 
     getModuleInfo: function getModuleInfo(path) {
    var i = this.__packages[path];
@@ -324,7 +422,16 @@ function buildHarnessService(rootFileSpec, dump, logError,
 
       isStarted = true;
       obSvc.addObserver(this, "quit-application-granted", true);
-      if (options.main) {
+      if (options.controlChannel) {
+        control = openControlChannel(options.controlChannel, runJob,
+                                     function onClose() {
+                                       if (control) {
+                                         control = null;
+                                         quit("FAIL");
+                                       }
+                                     });
+        control.send({status: "READY"});
+      } else if (options.main) {
         try {
 
           if (reason)
@@ -353,28 +460,12 @@ function buildHarnessService(rootFileSpec, dump, logError,
 
       obSvc.removeObserver(this, "quit-application-granted");
 
-      // Notify the program of unload.
-      if (program) {
-        if (typeof(program.onUnload) === "function") {
-          try {
-            program.onUnload(reason);
-          }
-          catch (err) {
-            if (loader)
-              loader.console.exception(err);
-          }
-        }
-        program = null;
+      if (control) {
+        control.close();
+        control = null;
       }
 
-      // Notify the loader of unload.
-      if (loader) {
-        loader.unload(reason);
-        loader = null;
-      }
-
-      for (name in options.resources)
-        resProt.setSubstitution(name, null);
+      unloadProgram(reason);
     },
 
     observe: function Harness_observe(subject, topic, data) {
@@ -433,28 +524,124 @@ function defaultLogError(e, print) {
     print("stack:\n" + e.stack + "\n");
 }
 
-// Builds an onQuit() function that writes a result file if necessary
-// and does some other extra things to enhance developer ergonomics.
+// Connects to the control channel ({host, port, token}) of whatever is
+// running us, over which it sends jobs to run, each as a line of JSON.
+// onMessage is called with each, and onClose when the connection closes.
+// Returns an object with send(), to send a message back (as a line of
+// JSON, along with the channel's token), and close().
+
+function openControlChannel(channel, onMessage, onClose) {
+  var sts = Cc["@mozilla.org/network/socket-transport-service;1"]
+            .getService(Ci.nsISocketTransportService);
+  var transport = sts.createTransport(null, 0, channel.host, channel.port,
+                                      null);
+  var output = transport.openOutputStream(Ci.nsITransport.OPEN_BLOCKING,
+                                          0, 0);
+  var input = transport.openInputStream(0, 0, 0)
+              .QueryInterface(Ci.nsIAsyncInputStream);
+  var scriptable = Cc["@mozilla.org/scriptableinputstream;1"]
+                   .createInstance(Ci.nsIScriptableInputStream);
+  scriptable.init(input);
+  var mainThread = Cc["@mozilla.org/thread-manager;1"]
+                   .getService().mainThread;
+  var buffer = "";
+  var isClosed = false;
+
+  function close() {
+    if (isClosed)
+      return;
+    isClosed = true;
+    input.close();
+    output.close();
+  }
+
+  var reader = {
+    onInputStreamReady: function(stream) {
+      if (isClosed)
+        return;
+      var data = null;
+      try {
+        data = scriptable.read(scriptable.available());
+      } catch (e) {
+        // The stream throws once the other end has closed it.
+      }
+      if (!data) {
+        close();
+        onClose();
+        return;
+      }
+      buffer += data;
+      var lines = buffer.split("\n");
+      buffer = lines.pop();
+      lines.forEach(function(line) {
+        if (line && !isClosed)
+          onMessage(JSON.parse(line));
+      });
+      if (!isClosed)
+        input.asyncWait(reader, 0, 0, mainThread);
+    }
+  };
+  input.asyncWait(reader, 0, 0, mainThread);
+
+  return {
+    token: channel.token,
+    send: function send(message) {
+      message.token = channel.token;
+      var data = JSON.stringify(message) + "\n";
+      output.write(data, data.length);
+    },
+    close: close
+  };
+}
+
+// Builds an onQuit() function that reports the result to whatever is
+// running us if necessary and does some other extra things to enhance
+// developer ergonomics.
 
 function buildDevQuit(options, dump) {
-  // Absolute path to a file that we put our result code in. Ordinarily
-  // we'd just exit the process with a zero or nonzero return code, but
-  // there doesn't appear to be a way to do this in XULRunner.
+  // Where we report our result. Ordinarily we'd just exit the process
+  // with a zero or nonzero return code, but there doesn't appear to be a
+  // way to do this in XULRunner.  Either a channel ({host, port, token})
+  // to send a line of JSON to, or the absolute path to a file that we put
+  // our result code in.
+  var resultChannel = options.resultChannel;
   var resultFile = options.resultFile;
 
-  // Whether we've written resultFile or not.
+  // Whether we've reported our result or not.
   var fileWritten = false;
 
+  function sendResult(result, details) {
+    var message = {token: resultChannel.token, status: result};
+    for (var name in details)
+      if (!(name in message))
+        message[name] = details[name];
+    var data = JSON.stringify(message) + "\n";
+
+    var sts = Cc["@mozilla.org/network/socket-transport-service;1"]
+              .getService(Ci.nsISocketTransportService);
+    var transport = sts.createTransport(null, 0, resultChannel.host,
+                                        resultChannel.port, null);
+    var stream = transport.openOutputStream(Ci.nsITransport.OPEN_BLOCKING,
+                                            0, 0);
+    stream.write(data, data.length);
+    stream.close();
+  }
+
   function attemptQuit() {
     var appStartup = Cc['@mozilla.org/toolkit/app-startup;1'].
                      getService(Ci.nsIAppStartup);
     appStartup.quit(Ci.nsIAppStartup.eAttemptQuit);
   }
 
-  return function onQuit(result) {
+  return function onQuit(result, details) {
     function writeResult() {
-      if (!fileWritten)
+      if (!fileWritten && (resultChannel || resultFile))
         try {
+          if (resultChannel) {
+            sendResult(result, details || {});
+            fileWritten = true;
+            return;
+          }
           var file = Cc["@mozilla.org/file/local;1"]
                      .createInstance(Ci.nsILocalFile);
           file.initWithPath(resultFile);
@@ -549,7 +736,8 @@ function getDefaults(rootFileSpec) {
   var onQuit = function() {};
   var doDump = dump;
 
-  if ('resultFile' in options)
+  if ('resultChannel' in options || 'resultFile' in options ||
+      'controlChannel' in options)
     onQuit = buildDevQuit(options, print);
   else
     // If we're not being run by cfx or some other kind of tool that is
@@ -23,7 +23,8 @@ class AppInfo(object):
             "build_id": timestamp,
             "developer_email": "unknown@unknown.com",
             "vendor": "Unknown",
-            "module_dirs": [ ]
+            "module_dirs": [ ],
+            "keep_modules": [ ]
         }
 
         self.object = { }
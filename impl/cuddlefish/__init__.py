@@ -56,6 +56,23 @@ parser_groups = (
                                        default=None,
                                        cmds=['test', 'run', 'testex',
                                              'testpkgs', 'testall'])),
+        (("", "--prefs",), dict(dest="prefs_file",
+                                help=("JSON file of preferences to set in "
+                                      "the profile, as an object mapping "
+                                      "their names to their values"),
+                                metavar=None,
+                                default=None,
+                                cmds=['test', 'run', 'testex', 'testpkgs',
+                                      'testall'])),
+        (("", "--profile-cache",), dict(dest="profile_cache",
+                                        help=("directory of profile "
+                                              "templates to clone new "
+                                              "profiles from, rather than "
+                                              "starting from empty ones"),
+                                        metavar=None,
+                                        default=None,
+                                        cmds=['test', 'run', 'testex',
+                                              'testpkgs', 'testall'])),
         (("-b", "--binary",), dict(dest="binary",
                                    help="path to app binary",
                                    metavar=None,
@@ -110,6 +127,62 @@ parser_groups = (
                                  metavar=None,
                                  default=None,
                                  cmds=['run', 'test'])),
+        (("", "--incremental",), dict(dest="incremental",
+                                      help=("update the previously built app "
+                                            "in place, copying only what "
+                                            "changed"),
+                                      action="store_true",
+                                      default=False,
+                                      cmds=['run', 'package', 'appify'])),
+        (("", "--hardlink",), dict(dest="hardlink",
+                                   help=("hardlink rather than copy files "
+                                         "into the app, where possible"),
+                                   action="store_true",
+                                   default=False,
+                                   cmds=['package', 'appify'])),
+        (("", "--archive",), dict(dest="archive",
+                                  help=("write the app into a single, "
+                                        "reproducible archive of the given "
+                                        "format (%s)" %
+                                        ", ".join(appifier.ARCHIVE_FORMATS)),
+                                  type="choice",
+                                  choices=appifier.ARCHIVE_FORMATS,
+                                  metavar=None,
+                                  default=None,
+                                  cmds=['package', 'appify'])),
+        (("", "--bundle",), dict(dest="bundle",
+                                 help=("bundle the app's modules so they "
+                                       "can all be loaded at once"),
+                                 action="store_true",
+                                 default=False,
+                                 cmds=['package', 'appify'])),
+        (("", "--tree-shake",), dict(dest="tree_shake",
+                                     help=("leave out of the app any module "
+                                           "it never requires"),
+                                     action="store_true",
+                                     default=False,
+                                     cmds=['package', 'appify'])),
+        (("", "--minify",), dict(dest="minify",
+                                 help=("strip comments and whitespace from "
+                                       "the app's javascript (writing source "
+                                       "maps into the build directory)"),
+                                 action="store_true",
+                                 default=False,
+                                 cmds=['package', 'appify'])),
+        (("", "--keep-modules",), dict(dest="keep_modules",
+                                       help=("modules to ship even when "
+                                             "nothing requires them by name, "
+                                             "separated by commas"),
+                                       metavar=None,
+                                       default=None,
+                                       cmds=['package', 'appify'])),
+        (("", "--build-cache",), dict(dest="build_cache",
+                                      help=("reuse the previously built app "
+                                            "when none of its inputs have "
+                                            "changed"),
+                                      action="store_true",
+                                      default=False,
+                                      cmds=['run'])),
         (("", "--static-args",), dict(dest="static_args",
                                       help="extra harness options as JSON",
                                       type="json",
@@ -162,6 +235,45 @@ parser_groups = (
                                          default=0,
                                          cmds=['test', 'testex', 'testpkgs',
                                                'testall'])),
+        (("-j", "--jobs",), dict(dest="jobs",
+                                 help=("number of examples to test at once "
+                                       "(default is one per CPU)"),
+                                 type="int",
+                                 default=None,
+                                 cmds=['testex', 'testall'])),
+        (("", "--report",), dict(dest="report",
+                                 help=("write a report of example test "
+                                       "results to this file: JUnit XML if "
+                                       "it ends in .xml, otherwise JSON"),
+                                 metavar=None,
+                                 default=None,
+                                 cmds=['testex', 'testall'])),
+        (("", "--warm",), dict(dest="warm",
+                               help=("test examples on a pool of runtimes "
+                                     "started up front, rather than starting "
+                                     "one per example"),
+                               action="store_true",
+                               default=False,
+                               cmds=['testex', 'testall'])),
+        (("", "--max-runs",), dict(dest="max_runs",
+                                   help=("with --warm, the number of examples "
+                                         "each runtime tests before it's "
+                                         "replaced by a fresh one"),
+                                   type="int",
+                                   default=None,
+                                   cmds=['testex', 'testall'])),
+        (("", "--test-dir",), dict(dest="test_dir",
+                                   help=("directory of the tests to run "
+                                         "(default is the test harness's)"),
+                                   metavar=None,
+                                   default=None,
+                                   cmds=['test'])),
+        (("", "--work-dir",), dict(dest="work_dir",
+                                   help=("directory to build the app in "
+                                         "(default is build/)"),
+                                   metavar=None,
+                                   default=None,
+                                   cmds=['run', 'test'])),
         ]
      ),
     )
@@ -264,45 +376,30 @@ def test_cfx(env_root, verbose):
     return retval
 
 def test_all_examples(env_root, defaults):
+    from cuddlefish.testex import run_examples, write_report
+
     examples_dir = os.path.join(env_root, "tests")
-    examples = [dirname for dirname in os.listdir(examples_dir)
-                if os.path.isdir(os.path.join(examples_dir, dirname))]
-    examples.sort()
-    fail = False
-    for dirname in examples:
-        print "Testing %s..." % dirname
-        output_test = os.path.join(env_root, "modules", "internal","test_harness","test-app.js")
-        try:
-            import shutil
-            from string import Template
-
-            test_script_for_app = os.path.join(examples_dir, dirname, "test-app.js")
-            browserToLaunch = os.path.join(examples_dir, dirname, "index.html")
-
-            if os.path.exists(test_script_for_app):
-               print "Found test file for %s: %s" % (dirname, test_script_for_app)
-
-               print "Will create test file in " + output_test
-
-               defaultBrowser = os.path.join(".", "tests" , dirname, "index.html")
-               with open(test_script_for_app, 'r') as f:
-                  test_content = f.read()
-                  prefix_contents = 'var options = { "staticArgs": {quitWhenDone: true, "browser": "'+defaultBrowser+'" , "appBasePath": "'+env_root+'" } };' + "\n"
-
-                  with open(output_test, 'w') as ff:
-                     ff.write(prefix_contents)
-                     ff.write(test_content)
-
-               run(arguments=["test",
-                              "--pkgdir",
-                              "packages/chromeless",
-                              "--static-args", json.dumps({"browser": browserToLaunch})],
-                   defaults=defaults,
-                   env_root=env_root)
-        except SystemExit, e:
-            fail = (e.code != 0) or fail
 
-    if fail:
+    def on_result(result):
+        print "Testing %s... %s (%.1fs)" % (result["name"], result["status"],
+                                            result["time"])
+        if result["status"] != "passed" or defaults.get('verbose'):
+            sys.stdout.write(result["output"].encode("utf-8"))
+        sys.stdout.flush()
+
+    results = run_examples(env_root, examples_dir, defaults,
+                           jobs=defaults.get('jobs'), on_result=on_result,
+                           warm=defaults.get('warm'),
+                           max_runs=defaults.get('max_runs'),
+                           timeout=TEST_RUN_TIMEOUT)
+    if defaults.get('report'):
+        write_report(results, defaults['report'])
+
+    failed = [r["name"] for r in results if r["status"] != "passed"]
+    print "%d of %d examples passed." % (len(results) - len(failed),
+                                         len(results))
+    if failed:
+        print "Failed: %s" % ", ".join(failed)
         sys.exit(-1)
 
 def test_all_packages(env_root, defaults):
@@ -319,6 +416,60 @@ def test_all_packages(env_root, defaults):
         defaults=defaults)
 
 
+# the harness options for the app whose browser code is given in
+# static_args.  with command "test", the program run is the test harness,
+# running the tests in test_dir (by default, the test harness's own).
+def build_harness_options(command, harness_guid, static_args, test_dir=None):
+    resources = { }
+    rootPaths = [ ]
+    import chromeless
+    path_to_modules = os.path.join(chromeless.Dirs().cuddlefish_root, "modules")
+    for f in os.listdir(path_to_modules):
+        resourceName = harness_guid + "-" + f
+        resources[resourceName] = os.path.join(path_to_modules, f)
+        rootPaths.append("resource://" + resourceName + "/");
+
+    # now add custom modules as specified by the app
+    app_info = chromeless.AppInfo(dir=static_args["browser"])
+    if app_info.module_dirs:
+        ac_path = static_args["browser"]
+        if os.path.isfile(ac_path):
+            ac_path = os.path.dirname(ac_path)
+        for d in app_info.module_dirs:
+            resourceName = harness_guid + "-appmodules-" + os.path.basename(d)
+            if not os.path.isabs(d):
+                d = os.path.normpath(os.path.join(ac_path, d))
+            resources[resourceName] = d
+            rootPaths.append("resource://" + resourceName + "/")
+
+    harness_contract_id = ('@mozilla.org/harness-service;1?id=%s' % harness_guid)
+    harness_options = {
+        'bootstrap': {
+            'contractID': harness_contract_id,
+            'classID': '{%s}' % harness_guid
+            },
+        'jetpackID': harness_guid,
+        'bundleID': harness_guid,
+        'staticArgs': static_args,
+        'resources': resources,
+        'loader': "resource://%s-%s/%s" % (harness_guid, "internal", "cuddlefish.js"),
+        'rootPaths': rootPaths
+        }
+
+    if command == "test":
+        harness_options['main'] = 'test_harness/run-tests'
+        if test_dir:
+            harness_options['testDir'] = os.path.abspath(test_dir)
+        else:
+            harness_options['testDir'] = os.path.join(chromeless.Dirs().cuddlefish_root, "modules", "internal", "test_harness")
+        resourceName = harness_guid + "-app-tests"
+        resources[resourceName] = os.path.join(harness_options['testDir'])
+        rootPaths.append("resource://" + resourceName + "/");
+    else:
+        harness_options['main'] = 'main'
+
+    return harness_options
+
 def get_config_args(name, env_root):
     local_json = os.path.join(env_root, "local.json")
     if not (os.path.exists(local_json) and
@@ -375,6 +526,14 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
 
     command = args[0]
 
+    # tests may run from other directories
+    if options.profile_cache:
+        options.profile_cache = os.path.abspath(
+            os.path.expanduser(options.profile_cache))
+    if options.prefs_file:
+        options.prefs_file = os.path.abspath(
+            os.path.expanduser(options.prefs_file))
+
     if command == "testpkgs":
         test_all_packages(env_root, defaults=options.__dict__)
         return
@@ -413,7 +572,15 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
 
     # the harness_guid is used for an XPCOM class ID.
     import uuid
-    harness_guid = str(uuid.uuid4())
+    if command == "run" and options.build_cache:
+        # it's also baked into the built app, so a cached build needs the
+        # same one from run to run.  derive it from the app's location.
+        app_path = os.path.abspath(options.static_args["browser"])
+        if isinstance(app_path, unicode):
+            app_path = app_path.encode("utf-8")
+        harness_guid = str(uuid.uuid5(uuid.NAMESPACE_URL, "file://" + app_path))
+    else:
+        harness_guid = str(uuid.uuid4())
 
     targets = [target]
     if command == "test":
@@ -422,66 +589,85 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
     if options.extra_packages:
         targets.extend(options.extra_packages.split(","))
 
-    resources = { }
-    rootPaths = [ ]
     import chromeless
-    path_to_modules = os.path.join(chromeless.Dirs().cuddlefish_root, "modules")
-    for f in os.listdir(path_to_modules):
-        resourceName = harness_guid + "-" + f
-        resources[resourceName] = os.path.join(path_to_modules, f)
-        rootPaths.append("resource://" + resourceName + "/");
-
-    # now add custom modules as specified by the app
+    harness_options = build_harness_options(command, harness_guid,
+                                            options.static_args,
+                                            options.test_dir)
+    resources = harness_options['resources']
     app_info = chromeless.AppInfo(dir=options.static_args["browser"])
-    if app_info.module_dirs:
-        ac_path = options.static_args["browser"]
-        if os.path.isfile(ac_path):
-            ac_path = os.path.dirname(ac_path)
-        for d in app_info.module_dirs:
-            resourceName = harness_guid + "-appmodules-" + os.path.basename(d)
-            if not os.path.isabs(d):
-                d = os.path.normpath(os.path.join(ac_path, d))
-            resources[resourceName] = d
-            rootPaths.append("resource://" + resourceName + "/")
-
-    harness_contract_id = ('@mozilla.org/harness-service;1?id=%s' % harness_guid)
-    harness_options = {
-        'bootstrap': {
-            'contractID': harness_contract_id,
-            'classID': '{%s}' % harness_guid
-            },
-        'jetpackID': harness_guid,
-        'bundleID': harness_guid,
-        'staticArgs': options.static_args,
-        'resources': resources,
-        'loader': "resource://%s-%s/%s" % (harness_guid, "internal", "cuddlefish.js"),
-        'rootPaths': rootPaths
-        }
-
-    if command == "test":
-        harness_options['main'] = 'test_harness/run-tests'
-        # XXX: we should write 'test-app' into a tempdir...
-        harness_options['testDir'] = os.path.join(chromeless.Dirs().cuddlefish_root, "modules", "internal", "test_harness")
-        resourceName = harness_guid + "-app-tests"
-        resources[resourceName] = os.path.join(harness_options['testDir'])
-        rootPaths.append("resource://" + resourceName + "/");
-    else:
-        harness_options['main'] = 'main'
 
     retval = 0
 
     a = appifier.Appifier()
 
+    generated = None
+    omit = None
+    rewritten = None
+    build_dir = chromeless.Dirs().build_dir
+    browser_code_dir = options.static_args["browser"]
+    if os.path.isfile(browser_code_dir):
+        browser_code_dir = os.path.dirname(browser_code_dir)
+    manifest = None
+    if command in ('package', 'appify') and (options.bundle or
+                                             options.tree_shake):
+        from cuddlefish.bundle import build_program_manifest
+        cache_path = None
+        if os.path.isdir(build_dir):
+            cache_path = os.path.join(build_dir, "scan-cache.json")
+        manifest, graph = build_program_manifest(harness_options,
+                                                 cache_path=cache_path,
+                                                 verbose=True)
+        shipped = None
+        if options.tree_shake:
+            from cuddlefish.shake import shake
+            keep = list(app_info.keep_modules)
+            if options.keep_modules:
+                keep.extend(options.keep_modules.split(","))
+            shipped, omit = shake(manifest, graph, harness_options,
+                                  browser_code_dir, keep=keep, verbose=True)
+
+    if command in ('package', 'appify') and options.minify:
+        from cuddlefish.minify import minify_dirs
+        import shutil
+        # source maps are laid out as the app is
+        dirs = { "browser_code": (browser_code_dir, None) }
+        guid_prefix = harness_guid + "-"
+        for name, dirname in resources.items():
+            label = os.path.join("packages", name[len(guid_prefix):])
+            dirs[label] = (dirname, omit and omit.get(name))
+        maps_dir = os.path.join(build_dir, app_info.name + ".sourcemaps")
+        if os.path.exists(maps_dir):
+            shutil.rmtree(maps_dir)
+        rewritten = minify_dirs(dirs, maps_dir, verbose=True)
+
+    if manifest is not None and options.bundle:
+        from cuddlefish.bundle import write_bundles
+        generated = write_bundles(manifest, graph, harness_options,
+                                  only=shipped, sources=rewritten,
+                                  verbose=True)
+
     if command == 'package':
        browser_code_path = options.static_args["browser"]
        a.output_xul_app(browser_code=browser_code_path,
                         harness_options=harness_options,
-                        dev_mode=False)
+                        dev_mode=False,
+                        incremental=options.incremental,
+                        hardlink=options.hardlink,
+                        archive=options.archive,
+                        generated=generated,
+                        omit=omit,
+                        rewritten=rewritten)
     elif command == 'appify':
         browser_code_path = options.static_args["browser"]
         a.output_application(browser_code=browser_code_path,
                              harness_options=harness_options,
-                             dev_mode=False)
+                             dev_mode=False,
+                             incremental=options.incremental,
+                             hardlink=options.hardlink,
+                             archive=options.archive,
+                             generated=generated,
+                             omit=omit,
+                             rewritten=rewritten)
 
     else:
         browser_code_path = options.static_args["browser"]
@@ -505,7 +691,13 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
 
             harness_options['logFile'] = tmppath
 
-            standalone_app_dir = a.output_application(browser_code=browser_code_path, harness_options=harness_options, dev_mode=True, verbose=False)
+            # runs given a work dir of their own (as parallel test runs
+            # are) mustn't share an application bundle, or LaunchServices
+            # just brings the one already running to the front
+            build_dir = None
+            if options.work_dir:
+                build_dir = os.path.join(options.work_dir, "app")
+            standalone_app_dir = a.output_application(browser_code=browser_code_path, harness_options=harness_options, dev_mode=True, verbose=False, build_dir=build_dir)
             print "opening '%s'" % standalone_app_dir
 
             tailProcess = None
@@ -520,9 +712,15 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
                 tailProcess.terminate()
                 os.remove(tmppath)
         else:
+            output_dir = None
+            if options.work_dir:
+                output_dir = os.path.join(options.work_dir, "app.xul")
             xul_app_dir = a.output_xul_app(browser_code=browser_code_path,
                                            harness_options=harness_options,
-                                           dev_mode=True, verbose=False)
+                                           dev_mode=True, verbose=False,
+                                           output_dir=output_dir,
+                                           incremental=options.incremental,
+                                           cached=options.build_cache)
             from cuddlefish.runner import run_app
 
             try:
@@ -534,7 +732,9 @@ def run(arguments=sys.argv[1:], target_cfg=None, pkg_cfg=None,
                              verbose=options.verbose,
                              timeout=timeout,
                              logfile=options.logfile,
-                             addons=options.addons)
+                             addons=options.addons,
+                             profile_cache=options.profile_cache,
+                             prefs_file=options.prefs_file)
             except Exception, e:
                 if str(e).startswith(MOZRUNNER_BIN_NOT_FOUND):
                     print >>sys.stderr, MOZRUNNER_BIN_NOT_FOUND_HELP.strip()
@@ -0,0 +1,122 @@
+from __future__ import with_statement
+import os
+import sys
+import simplejson as json
+from cuddlefish.manifest import build_manifest, DependencyGraph, ScanCache
+
+# Bundles hold the source of many modules in a single file, so that at
+# startup the loader can read every module it will need at once rather than
+# resolving and reading each module as it's required.  A bundle is a json
+# object whose "modules" map each module's resolved url (as the loader will
+# come to know it, e.g. resource://<guid>-lib/foo.js) to its source.  Each
+# module is still evaluated in its own sandbox, so bundling changes nothing
+# but where the source comes from.
+
+# start a new bundle once one grows beyond this size
+BUNDLE_SIZE = 1024 * 1024
+
+BUNDLE_DIR = "bundles"
+
+# tests aren't shipped in apps
+def _excluded(relpath):
+    return relpath.endswith(".test.js")
+
+# the test harness is only loaded by `cfx test`, which doesn't bundle
+def _bundled(info):
+    return info.name.split("/")[0] != "test_harness"
+
+# the (prefix, resource_url, pkg_name, section, dirname) sections which make
+# up the program described by harness_options, in search order.  resources
+# must still map to directories on disk.
+def program_sections(harness_options):
+    resources = harness_options['resources']
+    names = []
+    for root in harness_options['rootPaths']:
+        name = root[len("resource://"):].rstrip("/")
+        if name in resources and name not in names:
+            names.append(name)
+    for name in sorted(resources.keys()):
+        if name not in names:
+            names.append(name)
+    return [("", "resource://%s/" % name, name, "lib", resources[name])
+            for name in names]
+
+# the name of the package the loader lives in
+def loader_package(harness_options):
+    loader = harness_options['loader']
+    return loader[len("resource://"):].split("/")[0]
+
+# build the manifest of every module shipped with the program described by
+# harness_options, returning (manifest, graph).  scan results are cached in
+# cache_path, if given.
+def build_program_manifest(harness_options, stderr=sys.stderr,
+                           cache_path=None, verbose=False):
+    cache = None
+    if cache_path is not None:
+        cache = ScanCache(cache_path)
+    sections = program_sections(harness_options)
+    manifest, has_problems = build_manifest(sections,
+                                            loader_package(harness_options),
+                                            stderr, cache, verbose=verbose,
+                                            exclude=_excluded)
+    if cache is not None:
+        cache.save()
+    return manifest, DependencyGraph(manifest)
+
+# bundle every module of the program described by harness_options, returning
+# a dict mapping paths (relative to the root of the app) to the contents of
+# each bundle.  harness_options['bundles'] is set to say where the bundles
+# will be, so the harness can hand them to the loader.
+def build_bundles(harness_options, stderr=sys.stderr, cache_path=None,
+                  verbose=False):
+    manifest, graph = build_program_manifest(harness_options, stderr,
+                                             cache_path, verbose)
+    return write_bundles(manifest, graph, harness_options, verbose=verbose)
+
+# bundle the modules of manifest (or just those whose urls are in only), in
+# dependency order.  sources maps the paths of modules to source to bundle in
+# place of what's on disk.
+def write_bundles(manifest, graph, harness_options, only=None, sources=None,
+                  verbose=False):
+    dirnames = {}
+    for prefix, resource_url, pkg_name, section, dirname in \
+            program_sections(harness_options):
+        dirnames[resource_url] = dirname
+
+    bundles = []
+    current = {}
+    size = 0
+    count = 0
+    for url in graph.topological_order():
+        info = manifest[url]
+        if (only is not None and url not in only) or not _bundled(info):
+            continue
+        count += 1
+        resource_url = url[:len(url) - len(info.name) - len(".js")]
+        path = os.path.join(dirnames[resource_url], *(info.name + ".js").split("/"))
+        if sources and path in sources:
+            source = sources[path]
+        else:
+            with open(path, 'rb') as f:
+                source = f.read()
+        source = source.decode("utf-8", "replace")
+        if current and size + len(source) > BUNDLE_SIZE:
+            bundles.append(current)
+            current = {}
+            size = 0
+        current[url] = source
+        size += len(source)
+    if current:
+        bundles.append(current)
+
+    files = {}
+    harness_options['bundles'] = []
+    for i, modules in enumerate(bundles):
+        filename = "modules-%d.json" % i
+        files[os.path.join(BUNDLE_DIR, filename)] = json.dumps(
+            { "modules": modules }, sort_keys=True)
+        harness_options['bundles'].append([BUNDLE_DIR, filename])
+    if verbose:
+        print "bundled %d modules into %d file(s), %d bytes" % (
+            count, len(files), sum([len(c) for c in files.values()]))
+    return files
@@ -0,0 +1,247 @@
+import time
+import uuid
+import errno
+import select
+import socket
+
+import simplejson as json
+
+class ResultChannel(object):
+    """
+    A channel over which a single run of the harness reports its
+    result: a socket listening on the loopback interface, on a port
+    of its own, so that any number of runs can go at once.
+
+    The harness connects, sends its result as a line of JSON and
+    closes the connection.  The result is an object with a 'status'
+    ('OK' or 'FAIL'), the channel's token (so that nothing else on
+    the machine can pass off a result as the harness's) and whatever
+    else the harness has to report, such as test counts.
+
+    For example:
+
+      >>> channel = ResultChannel()
+      >>> s = socket.create_connection((channel.host, channel.port))
+      >>> s.sendall(json.dumps({'token': channel.token, 'status': 'OK',
+      ...                       'passed': 2, 'failed': 0}) + '\\n')
+      >>> s.close()
+      >>> result = channel.wait(5)
+      >>> print result['status'], result['passed'], result['failed']
+      OK 2 0
+      >>> channel.close()
+    """
+
+    def __init__(self, host='127.0.0.1'):
+        self.token = uuid.uuid4().hex
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self._listener.bind((host, 0))
+            self._listener.listen(5)
+        except:
+            self._listener.close()
+            raise
+        self.host, self.port = self._listener.getsockname()
+        # connections accepted, mapped to what's been read from them
+        self._connections = {}
+
+    @property
+    def options(self):
+        """
+        The harness option which tells the harness where to send its
+        result.
+        """
+
+        return {'host': self.host, 'port': self.port, 'token': self.token}
+
+    def _read(self, conn):
+        """
+        Reads what's available from an accepted connection, returning
+        the result sent over it once it's complete.
+        """
+
+        try:
+            data = conn.recv(4096)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return None
+            data = ""
+        if data:
+            self._connections[conn] += data
+            if "\n" not in self._connections[conn]:
+                return None
+        line = self._connections.pop(conn).split("\n")[0]
+        conn.close()
+        try:
+            result = json.loads(line)
+        except ValueError:
+            return None
+        if not isinstance(result, dict) or result.get('token') != self.token:
+            return None
+        del result['token']
+        return result
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the harness sends its result, and returns it, or
+        returns None if timeout seconds pass first.
+        """
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            wait = None
+            if deadline is not None:
+                wait = max(deadline - time.time(), 0)
+            socks = [self._listener] + self._connections.keys()
+            try:
+                ready = select.select(socks, [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if not ready:
+                return None
+            for sock in ready:
+                if sock is self._listener:
+                    conn, addr = self._listener.accept()
+                    self._connections[conn] = ""
+                else:
+                    result = self._read(sock)
+                    if result is not None:
+                        return result
+
+    def close(self):
+        for conn in self._connections:
+            conn.close()
+        self._connections = {}
+        self._listener.close()
+
+class ControlChannel(object):
+    """
+    A channel over which a long-running instance of the harness is
+    handed jobs to run: like a ResultChannel, a socket listening on
+    a loopback port of its own, but the harness keeps its connection
+    open.  It says it's ready, then waits for jobs, each of which is
+    sent as a line of JSON; it reports the result of each the same
+    way.  Everything the harness sends carries the channel's token.
+
+    For example:
+
+      >>> channel = ControlChannel()
+      >>> s = socket.create_connection((channel.host, channel.port))
+      >>> s.sendall(json.dumps({'token': channel.token,
+      ...                       'status': 'READY'}) + '\\n')
+      >>> print channel.receive(5)['status']
+      READY
+      >>> channel.send({'id': 1, 'options': {}})
+      >>> print json.loads(s.makefile().readline())['id']
+      1
+      >>> s.close()
+      >>> channel.receive(5) is None
+      True
+      >>> channel.closed
+      True
+      >>> channel.close()
+    """
+
+    def __init__(self, host='127.0.0.1'):
+        self.token = uuid.uuid4().hex
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self._listener.bind((host, 0))
+            self._listener.listen(1)
+        except:
+            self._listener.close()
+            raise
+        self.host, self.port = self._listener.getsockname()
+        self._conn = None
+        self._buffer = ""
+        self.closed = False
+
+    @property
+    def options(self):
+        """
+        The harness option which tells the harness where to connect
+        to for jobs.
+        """
+
+        return {'host': self.host, 'port': self.port, 'token': self.token}
+
+    def _next_message(self):
+        """
+        Returns the next message in what's been read so far, if there's
+        a complete one.  Anything without the token is dropped.
+        """
+
+        while "\n" in self._buffer:
+            line, self._buffer = self._buffer.split("\n", 1)
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(message, dict) and message.get('token') == self.token:
+                del message['token']
+                return message
+        return None
+
+    def receive(self, timeout=None):
+        """
+        Blocks until the harness sends a message, and returns it.
+        Returns None if timeout seconds pass first, or if the
+        connection is closed (in which case closed is set).
+        """
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            message = self._next_message()
+            if message is not None:
+                return message
+            if self.closed:
+                return None
+            wait = None
+            if deadline is not None:
+                wait = max(deadline - time.time(), 0)
+            sock = self._conn or self._listener
+            try:
+                ready = select.select([sock], [], [], wait)[0]
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if not ready:
+                return None
+            if sock is self._listener:
+                self._conn = self._listener.accept()[0]
+                continue
+            try:
+                data = self._conn.recv(4096)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    continue
+                data = ""
+            if not data:
+                self.closed = True
+            self._buffer += data
+
+    def send(self, message):
+        """
+        Sends a message to the harness, which must have connected.
+        """
+
+        if self._conn is None or self.closed:
+            raise IOError("the harness isn't connected")
+        try:
+            self._conn.sendall(json.dumps(message) + "\n")
+        except socket.error:
+            self.closed = True
+            raise IOError("the harness isn't connected")
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        self._listener.close()
+        self.closed = True
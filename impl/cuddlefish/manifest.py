@@ -1,50 +1,75 @@
 
-import os, sys, re, hashlib
+from __future__ import with_statement
+import os, sys, re, time, bisect, hashlib
+from StringIO import StringIO
+import simplejson as json
 from cuddlefish.bunch import Bunch
 
-COMMENT_PREFIXES = ["//", "/*", "*", "\'", "\""]
+# JavaScript source is scanned in a single pass by a small lexer, which
+# knows enough about comments, strings and regular expression literals that
+# code inside them is never mistaken for the real thing.  as tokens go by we
+# pick out:
+#   require("name")
+#   require(["dep1", "dep2"], ...) and
+#   define("module name", ["dep1", "dep2", "dep3"], function() {})
+#   uses of the chrome aliases (Cc, Ci, ...) and of Components.*
 
-REQUIRE_RE = r"(?<![\'\"])require\s*\(\s*[\'\"]([^\'\"]+?)[\'\"]\s*\)"
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+      (?P<comment>//[^\n]*|/\*.*?(?:\*/|\Z))
+    | (?P<name>[A-Za-z_$][\w$]*)
+    | (?P<string>'(?:[^'\\\n]|\\.)*(?:'|$)
+               |"(?:[^"\\\n]|\\.)*(?:"|$)
+               |`(?:[^`\\]|\\.)*(?:`|\Z))
+    | (?P<number>\.?\d[\w.]*)
+    | (?P<punct>\S)
+    )""", re.S | re.M | re.X)
 
-# detect the define idiom of the form:
-#   define("module name", ["dep1", "dep2", "dep3"], function() {})
-# by capturing the contents of the list in a group.
-DEF_RE = re.compile(r"(require|define)\s*\(\s*([\'\"][^\'\"]+[\'\"]\s*,)?\s*\[([^\]]+)\]")
+_REGEX_RE = re.compile(r"/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[\w$]*")
 
-# Out of the async dependencies, do not allow quotes in them.
-DEF_RE_ALLOWED = re.compile(r"^[\'\"][^\'\"]+[\'\"]$")
+# a / following one of these (or punctuation other than a closing bracket)
+# starts a regular expression rather than being a division
+_KEYWORDS_BEFORE_EXPRESSION = set([
+    "return", "typeof", "instanceof", "in", "of", "new", "delete", "void",
+    "throw", "case", "do", "else", "yield"])
 
-def scan_requirements_with_grep(fn, lines):
-    requires = Bunch()
-    for line in lines:
-        for clause in line.split(";"):
-            clause = clause.strip()
-            iscomment = False
-            for commentprefix in COMMENT_PREFIXES:
-                if clause.startswith(commentprefix):
-                    iscomment = True
-            if iscomment:
-                continue
-            mo = re.search(REQUIRE_RE, clause)
-            if mo:
-                modname = mo.group(1)
-                requires[modname] = Bunch()
-
-    # define() can happen across multiple lines, so join everyone up.
-    wholeshebang = "\n".join(lines)
-    for match in DEF_RE.finditer(wholeshebang):
-        # this should net us a list of string literals separated by commas
-        for strbit in match.group(3).split(","):
-            strbit = strbit.strip()
-            # There could be a trailing comma netting us just whitespace, so
-            # filter that out. Make sure that only string values with
-            # quotes around them are allowed, and no quotes are inside
-            # the quoted value.
-            if strbit and DEF_RE_ALLOWED.match(strbit):
-                modname = strbit[1:-1]
-                requires[modname] = Bunch()
-
-    return requires
+# yield (kind, value, offset) for each significant token of text.  kind is
+# one of "name", "string" (with the quotes stripped from value), "number",
+# "regex" or "punct".
+def tokenize(text):
+    for kind, value, start, end in tokenize_spans(text):
+        yield kind, value, start
+
+# as tokenize, but yield (kind, value, start, end), where text[start:end] is
+# the source of the token
+def tokenize_spans(text):
+    pos = 0
+    prev_kind, prev_value = None, None
+    match = _TOKEN_RE.match
+    while True:
+        m = match(text, pos)
+        if m is None:
+            return
+        pos = m.end()
+        kind = m.lastgroup
+        if kind == "comment":
+            continue
+        value = m.group(kind)
+        offset = m.start(kind)
+        if kind == "string":
+            value = value[1:]
+            if value[-1:] == text[offset]:
+                value = value[:-1]
+        elif (kind == "punct" and value == "/" and
+              (prev_kind is None or
+               (prev_kind == "punct" and prev_value not in ")]}") or
+               (prev_kind == "name" and
+                prev_value in _KEYWORDS_BEFORE_EXPRESSION))):
+            r = _REGEX_RE.match(text, offset)
+            if r is not None:
+                kind, value, pos = "regex", r.group(0), r.end()
+        prev_kind, prev_value = kind, value
+        yield kind, value, offset, pos
 
 MUST_ASK_FOR_CHROME =  """\
 To use chrome authority, as in line %d in:
@@ -56,103 +81,521 @@ You must enable it with:
 
 CHROME_ALIASES = ["Cc", "Ci", "Cu", "Cr", "Cm"]
 
-def scan_chrome(fn, lines, stderr):
-    filename = os.path.basename(fn)
-    if filename == "cuddlefish.js" or filename == "securable-module.js":
-        return False, False # these are the loader
-    problems = False
-    asks_for_chrome = set() # Cc,Ci in: var {Cc,Ci} = require("chrome")
-    asks_for_all_chrome = False # e.g.: var c = require("chrome")
-    uses_chrome = set()
-    uses_components = False
-    uses_chrome_at = []
-    for lineno,line in enumerate(lines):
-        # note: this scanner is not obligated to spot all possible forms of
-        # chrome access. The scanner is detecting voluntary requests for
-        # chrome. Runtime tools will enforce allowance or denial of access.
-        line = line.strip()
-        iscomment = False
-        for commentprefix in COMMENT_PREFIXES:
-            if line.startswith(commentprefix):
-                iscomment = True
-        if iscomment:
+# the loader gets chrome without asking
+LOADER_FILES = ["cuddlefish.js", "securable-module.js"]
+
+# scan module source, returning (requires, chrome) where requires lists the
+# modules required (in the order first seen) and chrome is a Bunch of:
+#   asked: whether chrome was required at all
+#   asked_for: the chrome aliases which were asked for by name
+#   uses: a list of (alias, line number) for each line using an alias, or
+#         None as the alias for lines using Components.* (and no alias)
+def scan_source(text):
+    requires = []
+    asked = False
+    asked_for = set()
+    uses = set()
+    components_at = set()
+    newlines = None
+
+    def lineno(offset):
+        return bisect.bisect_right(newlines, offset) + 1
+
+    toks = [] # (kind, value) of every token so far
+    deps = None # inside define([...]), the tokens of the current element
+    chrome_close = None # index in toks of the ) of require("chrome")
+    components = None # offset of a Components which may be followed by .
+    for kind, value, offset in tokenize(text):
+        toks.append((kind, value))
+        n = len(toks)
+
+        if components is not None:
+            if kind == "punct" and value == ".":
+                components_at.add(components)
+            components = None
+
+        if deps is not None:
+            if kind == "punct" and value in ",]":
+                if len(deps) == 1 and deps[0][0] == "string" and deps[0][1]:
+                    requires.append(deps[0][1])
+                deps = [] if value == "," else None
+            else:
+                deps.append((kind, value))
+            continue
+
+        if kind == "name":
+            if value in CHROME_ALIASES or value == "Components":
+                if n > 1 and toks[n - 2] == ("punct", "."):
+                    # someone else's property
+                    if (value != "Components" and chrome_close is not None and
+                        n - 3 == chrome_close):
+                        # require("chrome").Cc
+                        asked_for.add(value)
+                    continue
+                if value == "Components":
+                    components = offset
+                    continue
+                if newlines is None:
+                    newlines = [m.start() for m in re.finditer("\n", text)]
+                uses.add((value, lineno(offset)))
             continue
-        mo = re.search(REQUIRE_RE, line)
-        if mo:
-            if mo.group(1) == "chrome":
-                for alias in CHROME_ALIASES:
-                    if alias in line:
-                        asks_for_chrome.add(alias)
-                if not asks_for_chrome:
-                    asks_for_all_chrome = True
-        alias_in_this_line = False
-        for wanted in CHROME_ALIASES:
-            if re.search(r'\b'+wanted+r'\b', line):
-                alias_in_this_line = True
-                uses_chrome.add(wanted)
-                uses_chrome_at.append( (wanted, lineno+1, line) )
-        
-        if not alias_in_this_line and "Components." in line:
-            uses_components = True
-            uses_chrome_at.append( (None, lineno+1, line) )
-            problems = True
-            break
-    if uses_components or (uses_chrome - asks_for_chrome):
+
+        if kind != "punct":
+            continue
+
+        if (value == ")" and n >= 4 and toks[n - 2][0] == "string" and
+            toks[n - 3] == ("punct", "(") and toks[n - 4] == ("name", "require")):
+            name = toks[n - 2][1]
+            if name:
+                requires.append(name)
+            if name == "chrome":
+                asked = True
+                chrome_close = n - 1
+                # var {Cc, Ci: ci} = require("chrome")
+                i = n - 5
+                if i > 0 and toks[i] == ("punct", "=") and toks[i - 1] == ("punct", "}"):
+                    i -= 1
+                    depth = 0
+                    while i >= 0:
+                        if toks[i] == ("punct", "}"):
+                            depth += 1
+                        elif toks[i] == ("punct", "{"):
+                            depth -= 1
+                            if not depth:
+                                break
+                        elif toks[i][0] == "name" and toks[i][1] in CHROME_ALIASES:
+                            asked_for.add(toks[i][1])
+                        i -= 1
+        elif value == "[" and n >= 3:
+            # require([...]), define([...]) and define("name", [...])
+            if (toks[n - 2] == ("punct", "(") and
+                toks[n - 3] in (("name", "require"), ("name", "define"))):
+                deps = []
+            elif (n >= 5 and toks[n - 2] == ("punct", ",") and
+                  toks[n - 3][0] == "string" and toks[n - 4] == ("punct", "(") and
+                  toks[n - 5] in (("name", "require"), ("name", "define"))):
+                deps = []
+
+    # a line using Components along with an alias is taken to be defining
+    # that alias, so it's the alias we'll suggest
+    alias_lines = set([line for alias, line in uses])
+    if components_at and newlines is None:
+        newlines = [m.start() for m in re.finditer("\n", text)]
+    for offset in components_at:
+        line = lineno(offset)
+        if line not in alias_lines:
+            uses.add((None, line))
+
+    def use_order(use):
+        alias, line = use
+        if alias is None:
+            return (line, len(CHROME_ALIASES))
+        return (line, CHROME_ALIASES.index(alias))
+
+    chrome = Bunch(asked=asked, asked_for=asked_for,
+                   uses=sorted(uses, key=use_order))
+    return requires, chrome
+
+# report chrome used but not asked for, returning (wants_chrome, problems)
+def check_chrome(fn, lines, chrome, stderr):
+    if os.path.basename(fn) in LOADER_FILES:
+        return False, False
+    uses_chrome = set([alias for alias, line in chrome.uses if alias])
+    uses_components = bool([1 for alias, line in chrome.uses if alias is None])
+    problems = False
+    if uses_components or (uses_chrome - chrome.asked_for):
         problems = True
         print >>stderr, ""
         print >>stderr, "To use chrome authority, as in:"
         print >>stderr, " %s" % fn
-        for (alias, lineno, line) in uses_chrome_at:
-            if alias not in asks_for_chrome:
-                print >>stderr, " %d> %s" % (lineno, line)
+        for (alias, lineno) in chrome.uses:
+            if alias not in chrome.asked_for:
+                print >>stderr, " %d> %s" % (lineno, lines[lineno - 1].strip())
         print >>stderr, "You must enable it with something like:"
         uses = sorted(uses_chrome)
         if uses_components:
             uses.append("components")
         needed = ",".join(uses)
         print >>stderr, '  const {%s} = require("chrome");' % needed
-    wants_chrome = bool(asks_for_chrome) or asks_for_all_chrome
-    return wants_chrome, problems
+    return chrome.asked, problems
 
 def scan_module(fn, lines, stderr=sys.stderr):
-    # barfs on /\s+/ in context-menu.js
-    #requires = scan_requirements_with_jsscan(fn)
-    requires = scan_requirements_with_grep(fn, lines)
-    requires.pop("chrome", None)
-    chrome, problems = scan_chrome(fn, lines, stderr)
+    # note: this scanner is not obligated to spot all possible forms of
+    # chrome access. The scanner is detecting voluntary requests for
+    # chrome. Runtime tools will enforce allowance or denial of access.
+    text = "".join(lines)
+    names, chrome_info = scan_source(text)
+    requires = Bunch()
+    for name in names:
+        if name != "chrome":
+            requires[name] = Bunch()
+    chrome, problems = check_chrome(fn, text.split("\n"), chrome_info, stderr)
     return requires, chrome, problems
 
-def scan_package(prefix, resource_url, pkg_name, section, dirname,
-                 stderr=sys.stderr):
-    manifest = {}
-    has_problems = False
+# bump this whenever the scanners change what they find, so that results
+# cached by an older version are thrown away
+SCAN_CACHE_VERSION = 2
+
+# remembers what scanning each module found, so that only modules which have
+# changed since the last scan need to be scanned again.  results are kept in
+# a json file keyed by the module's path, and are valid for as long as its
+# size and mtime are unchanged.
+class ScanCache(object):
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.loads(f.read())
+                if data.get("version") == SCAN_CACHE_VERSION:
+                    self.entries = data.get("entries", {})
+            except ValueError:
+                pass
+
+    def get(self, fn, st):
+        entry = self.entries.get(fn)
+        if (entry and entry["size"] == st.st_size and
+            entry["mtime"] == st.st_mtime):
+            self.hits += 1
+            return entry
+        self.misses += 1
+        return None
+
+    def put(self, fn, st, entry):
+        entry["size"] = st.st_size
+        entry["mtime"] = st.st_mtime
+        self.entries[fn] = entry
+        self._dirty = True
+
+    # write the cache back out, if anything changed
+    def save(self):
+        if not self._dirty:
+            return
+        # forget modules which have gone away
+        for fn in [fn for fn in self.entries if not os.path.exists(fn)]:
+            del self.entries[fn]
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(json.dumps({ "version": SCAN_CACHE_VERSION,
+                                 "entries": self.entries }))
+        if os.path.exists(self.path) and sys.platform == 'win32':
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+        self._dirty = False
+
+# scan a module without reference to any cache, returning what we found in
+# the form the cache keeps it.  the file is read just once, for both hashing
+# and scanning, and any problems are reported in the result rather than to
+# stderr (so this can run in another process).
+def _scan_uncached(absfn):
+    with open(absfn, "rb") as f:
+        data = f.read()
+    hashhex = hashlib.sha256(data).hexdigest()
+    lines = data.splitlines(True)
+    report = StringIO()
+    requires, chrome, problems = scan_module(absfn, lines, report)
+    return { "hash": hashhex,
+             "requires": sorted(requires.keys()),
+             "chrome": chrome,
+             "problems": problems,
+             "report": report.getvalue() }
+
+# turn a scan result back into (hash, requires, chrome, problems), reporting
+# any problems it found
+def _unpack_scan(entry, stderr):
+    if entry["report"]:
+        stderr.write(entry["report"])
+    requires = Bunch()
+    for name in entry["requires"]:
+        requires[name] = Bunch()
+    return entry["hash"], requires, entry["chrome"], entry["problems"]
+
+# scan a single module, returning (hash, requires, chrome, problems).  with a
+# cache, modules which haven't changed aren't read at all, though any
+# problems found when they were scanned are reported again.
+def scan_file(absfn, stderr=sys.stderr, cache=None):
+    if cache is None:
+        return _unpack_scan(_scan_uncached(absfn), stderr)
+    st = os.stat(absfn)
+    entry = cache.get(absfn, st)
+    if entry is None:
+        entry = _scan_uncached(absfn)
+        cache.put(absfn, st, entry)
+    return _unpack_scan(entry, stderr)
+
+# yield (path, module name) for each module beneath dirname, skipping
+# those whose path (relative to dirname) exclude returns true for
+def _find_modules(dirname, exclude=None):
     for dirpath, dirnames, filenames in os.walk(dirname):
-        for fn in [fn for fn in filenames if fn.endswith(".js")]:
+        dirnames.sort()
+        for fn in sorted([fn for fn in filenames if fn.endswith(".js")]):
             modname = os.path.splitext(fn)[0]
             # turn "packages/api-utils/lib/content/foo" into "content/foo"
             reldir = dirpath[len(dirname)+1:]
             if reldir:
                 modname = "/".join(reldir.split(os.sep) + [modname])
-            absfn = os.path.join(dirpath, fn)
-            hashhex = hashlib.sha256(open(absfn,"rb").read()).hexdigest()
-            lines = open(absfn).readlines()
-            requires, chrome, problems = scan_module(absfn, lines, stderr)
-            url = "%s%s.js" % (resource_url, modname)
-            info = { "packageName": pkg_name,
-                     "sectionName": section,
-                     "name": modname,
-                     "hash": hashhex,
-                     "requires": requires,
-                     "chrome": chrome,
-                     "e10s-adapter": None,
-                     "zipname": "resources/%s%s-%s/%s.js" % (prefix, pkg_name,
-                                                             section, modname),
-                     }
-            manifest[url] = Bunch(**info)
-            if problems:
-                has_problems = True
+            if exclude and exclude(os.path.join(reldir, fn)):
+                continue
+            yield os.path.join(dirpath, fn), modname
+
+def _manifest_entry(prefix, resource_url, pkg_name, section, modname,
+                    hashhex, requires, chrome):
+    url = "%s%s.js" % (resource_url, modname)
+    info = { "packageName": pkg_name,
+             "sectionName": section,
+             "name": modname,
+             "hash": hashhex,
+             "requires": requires,
+             "chrome": chrome,
+             "e10s-adapter": None,
+             "zipname": "resources/%s%s-%s/%s.js" % (prefix, pkg_name,
+                                                     section, modname),
+             }
+    return url, Bunch(**info)
+
+def scan_package(prefix, resource_url, pkg_name, section, dirname,
+                 stderr=sys.stderr, cache=None):
+    manifest = {}
+    has_problems = False
+    for absfn, modname in _find_modules(dirname):
+        hashhex, requires, chrome, problems = scan_file(absfn, stderr, cache)
+        url, info = _manifest_entry(prefix, resource_url, pkg_name, section,
+                                    modname, hashhex, requires, chrome)
+        manifest[url] = info
+        if problems:
+            has_problems = True
+    return manifest, has_problems
+
+# how many modules a worker process scans at a time
+SCAN_BATCH_SIZE = 32
+# with fewer modules than this to scan, starting worker processes costs more
+# than it saves
+MIN_PARALLEL_SCAN = 128
+
+def _scan_batch(fns):
+    return [(fn, _scan_uncached(fn)) for fn in fns]
+
+# scan the given modules, returning a dict of path -> scan result.  modules
+# are farmed out to a pool of processes when there are enough of them.
+def _scan_files(fns, processes):
+    if processes == 1 or len(fns) < MIN_PARALLEL_SCAN:
+        return dict(_scan_batch(fns))
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+        batches = [fns[i:i + SCAN_BATCH_SIZE]
+                   for i in range(0, len(fns), SCAN_BATCH_SIZE)]
+        # get() with a timeout, so that ^C is delivered promptly
+        results = pool.map_async(_scan_batch, batches).get(60 * 60 * 24)
+    finally:
+        pool.terminate()
+        pool.join()
+    scanned = {}
+    for batch in results:
+        scanned.update(batch)
+    return scanned
+
+# build the manifest for a whole program.  sections is a list of (prefix,
+# resource_url, pkg_name, section, dirname) (the arguments scan_package
+# takes), in the order the packages are searched.  every module is scanned
+# (those which haven't changed since the last scan are taken from cache, the
+# rest split between processes, all of them by default), and then each
+# module's requirements are resolved.  modules for which exclude(path
+# relative to the section) returns true are left out.  returns (manifest,
+# has_problems).
+def build_manifest(sections, loader, stderr=sys.stderr, cache=None,
+                   processes=None, verbose=False, exclude=None):
+    started = time.time()
+
+    modules = []
+    for prefix, resource_url, pkg_name, section, dirname in sections:
+        for absfn, modname in _find_modules(dirname, exclude):
+            modules.append((prefix, resource_url, pkg_name, section,
+                            modname, absfn))
+
+    scanned = {}
+    todo = []
+    stats = {}
+    seen = set()
+    for module in modules:
+        absfn = module[5]
+        if absfn in seen:
+            continue
+        seen.add(absfn)
+        if cache is not None:
+            st = os.stat(absfn)
+            entry = cache.get(absfn, st)
+            if entry is not None:
+                scanned[absfn] = entry
+                continue
+            stats[absfn] = st
+        todo.append(absfn)
+    scanned.update(_scan_files(todo, processes))
+    if cache is not None:
+        for absfn, st in stats.items():
+            cache.put(absfn, st, scanned[absfn])
+
+    manifest = {}
+    has_problems = False
+    for prefix, resource_url, pkg_name, section, modname, absfn in modules:
+        hashhex, requires, chrome, problems = _unpack_scan(scanned[absfn],
+                                                           stderr)
+        url, info = _manifest_entry(prefix, resource_url, pkg_name, section,
+                                    modname, hashhex, requires, chrome)
+        manifest[url] = info
+        if problems:
+            has_problems = True
+
+    elapsed = time.time() - started
+    if verbose:
+        print "scanned %d modules (%d from cache) in %.2fs, %d files/sec" % (
+            len(modules), len(modules) - len(todo), elapsed,
+            len(modules) / max(elapsed, 0.001))
+
+    deps = []
+    for section in sections:
+        if section[2] not in deps:
+            deps.append(section[2])
+    update_manifest_with_fileinfo(deps, loader, manifest)
     return manifest, has_problems
 
+# the dependencies between the modules of a manifest, once their requires
+# have been resolved.  modules are identified by their url.
+class DependencyGraph(object):
+    def __init__(self, manifest):
+        self.modules = sorted(manifest.keys())
+        self._deps = {}
+        self._rdeps = {}
+        for url in self.modules:
+            self._deps[url] = []
+            self._rdeps.setdefault(url, [])
+        for url in self.modules:
+            for reqname, req in sorted(manifest[url].requires.items()):
+                found = req.get("url")
+                if found is None or found not in self._deps:
+                    continue
+                if found not in self._deps[url]:
+                    self._deps[url].append(found)
+                    self._rdeps[found].append(url)
+        self._components = None
+
+    # the modules url requires directly
+    def dependencies(self, url):
+        return list(self._deps[url])
+
+    # the modules which require url directly
+    def dependents(self, url):
+        return list(self._rdeps[url])
+
+    def _closure(self, urls, edges):
+        seen = set()
+        todo = list(urls)
+        while todo:
+            url = todo.pop()
+            for other in edges[url]:
+                if other not in seen:
+                    seen.add(other)
+                    todo.append(other)
+        return seen
+
+    # every module that url depends on, directly or not
+    def all_dependencies(self, url):
+        return self._closure([url], self._deps)
+
+    # every module which depends on url, directly or not
+    def all_dependents(self, url):
+        return self._closure([url], self._rdeps)
+
+    # the strongly connected components of the graph (by Tarjan's
+    # algorithm, without recursion), each sorted, listed such that a
+    # component comes after all the components it depends on
+    def components(self):
+        if self._components is not None:
+            return self._components
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in self.modules:
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                url, i = work.pop()
+                if i == 0:
+                    index[url] = lowlink[url] = len(index)
+                    stack.append(url)
+                    on_stack.add(url)
+                deps = self._deps[url]
+                while i < len(deps):
+                    dep = deps[i]
+                    i += 1
+                    if dep not in index:
+                        # come back to url once dep is done
+                        work.append((url, i))
+                        work.append((dep, 0))
+                        break
+                    if dep in on_stack:
+                        lowlink[url] = min(lowlink[url], index[dep])
+                else:
+                    if lowlink[url] == index[url]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == url:
+                                break
+                        components.append(sorted(component))
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[url])
+        self._components = components
+        return components
+
+    # all modules, each listed after the modules it depends on (excepting
+    # modules in a cycle, which are listed together)
+    def topological_order(self):
+        order = []
+        for component in self.components():
+            order.extend(component)
+        return order
+
+    # the sets of modules which depend on each other in a cycle
+    def cycles(self):
+        return [c for c in self.components()
+                if len(c) > 1 or c[0] in self._deps[c[0]]]
+
+# resolve a relative require (like "./foo" or "../bar/baz") made by the
+# module named modname, returning the module name it refers to.  results are
+# remembered in memo, since the same few relative paths recur throughout a
+# package.
+def _resolve_relative(modname, reqname, memo):
+    key = (modname.rpartition("/")[0], reqname)
+    if key in memo:
+        return memo[key]
+    reqname_bits = reqname.split("/")
+    # start from the module doing the require()
+    target = modname.split("/")[:-1]
+    while reqname_bits:
+        first = reqname_bits.pop(0)
+        if first == ".":
+            continue
+        elif first == "..":
+            try:
+                target.pop()
+            except IndexError:
+                raise
+        else:
+            target.append(first)
+    memo[key] = "/".join(target)
+    return memo[key]
+
 def update_manifest_with_fileinfo(deps, loader, manifest):
     packages = deps[:]
     if loader not in packages:
@@ -168,17 +611,25 @@ def update_manifest_with_fileinfo(deps, loader, manifest):
     # first section that the module appears in, and the resource: URL of the
     # module there.
     m = {}
-    for url, i in manifest.items():
+    for url in sorted(manifest.keys()):
+        i = manifest[url]
         idx = (i.packageName,i.name)
         if idx not in m:
             m[idx] = url
+    # and "first" maps each modname to the module that an absolute require()
+    # of it finds: the one in the earliest package, in search order
+    provided = {}
+    for (pkgname, modname), url in m.items():
+        provided.setdefault(pkgname, []).append((modname, url))
+    first = {}
+    for source in packages:
+        for modname, url in provided.get(source, []):
+            if modname not in first:
+                first[modname] = url
+    memo = {}
+
     for url, i in manifest.items():
-        looking_for = i.name + '-e10s-adapter'
-        for source in packages:
-            if (source,looking_for) in m:
-                # got it
-                i['e10s-adapter'] = m[ (source,looking_for) ]
-                break
+        i['e10s-adapter'] = first.get(i.name + '-e10s-adapter')
 
         for reqname in i.requires:
             # now where will this requirement come from? This code tries to
@@ -193,45 +644,17 @@ def update_manifest_with_fileinfo(deps, loader, manifest):
             # through the code can confidently exclude common modules that
             # were reviewed earlier.
 
-            reqname_bits = reqname.split("/")
-
-            if reqname_bits[0] in (".", ".."):
+            if reqname.split("/")[0] in (".", ".."):
                 # for relative paths like these, we only look in the single
                 # package that did the require()
-                search_all = False
-                # and start from the module doing the require()
-                target = i.name.split("/")[:-1]
-                while reqname_bits:
-                    first = reqname_bits.pop(0)
-                    if first == ".":
-                        continue
-                    elif first == "..":
-                        try:
-                            target.pop()
-                        except IndexError:
-                            raise
-                    else:
-                        target.append(first)
-                looking_for = "/".join(target)
+                looking_for = _resolve_relative(i.name, reqname, memo)
+                found_url = m.get( (i.packageName,looking_for) )
             else:
                 # for absolute paths, we search all packages, always in the
                 # same order (i.e. the package that did the require() does
                 # not get special treatment)
-                search_all = True
                 looking_for = reqname
-
-            found_url = None
-            if search_all:
-                for source in packages:
-                    if (source,looking_for) in m:
-                        # got it
-                        found_url = m[ (source,looking_for) ]
-                        break
-            else:
-                # only look in the package doing the importing
-                if (i.packageName,looking_for) in m:
-                    # yup
-                    found_url = m[ (i.packageName,looking_for) ]
+                found_url = first.get(looking_for)
 
             if found_url:
                 # now store the zipfile name (actually the URL)
@@ -249,7 +672,9 @@ def update_manifest_with_fileinfo(deps, loader, manifest):
                 pass
             else:
                 print >>sys.stderr, "NOT FOUND", i.packageName, i.sectionName, i.name, reqname, looking_for, packages
-    # the manifest is modified in-place
+    # the manifest is modified in-place, and we return the graph of
+    # dependencies between its modules
+    return DependencyGraph(manifest)
 
 if __name__ == '__main__':
     for fn in sys.argv[1:]:
@@ -0,0 +1,181 @@
+from __future__ import with_statement
+import os
+import re
+import simplejson as json
+from cuddlefish.manifest import tokenize_spans
+
+# Minifying strips comments, and the whitespace between tokens, from the
+# javascript shipped in packaged apps, using the same lexer the manifest is
+# built with.  Where there was a line break between two tokens a line break
+# is kept, since automatic semicolon insertion can depend on it; so a file
+# shrinks by its comments, indentation and blank lines, and each line of the
+# minified file still comes from a single line of the original.  Which one
+# is recorded in a source map, so that tracebacks from a packaged app can be
+# mapped back to the original sources.
+
+MINIFY_BATCH_SIZE = 8
+# with fewer files than this to minify, starting worker processes costs more
+# than it saves
+MIN_PARALLEL_MINIFY = 16
+
+# characters which may make up identifiers (and keywords, and numbers).
+# source is minified as bytes, so any byte of a multibyte character counts.
+_WORD_RE = re.compile(r"[\w$\\\x80-\xff]")
+
+# whether the last character of one token and the first character of the
+# next would run together (into one token, or a comment) without a space
+def _needs_space(a, b):
+    if _WORD_RE.match(a) and _WORD_RE.match(b):
+        return True
+    if a == b and a in "+-":
+        return True
+    if a == "/" and b in "/*":
+        return True
+    if a.isdigit() and b == ".":
+        return True
+    return a == "<" and b == "!"
+
+def _signature(text):
+    return [(kind, value) for kind, value, start, end in tokenize_spans(text)]
+
+# minify javascript source, returning (minified, lines), where lines[i] is
+# the line of text (counting from 1) which line i+1 of minified came from.
+# source which doesn't lex back into the same tokens once minified is
+# returned as it was.
+def minify_source(text):
+    out = []
+    lines = []
+    line = 1
+    prev_end = None
+    prev_last = None
+    for kind, value, start, end in tokenize_spans(text):
+        raw = text[start:end]
+        if prev_end is None:
+            line += text.count("\n", 0, start)
+            lines.append(line)
+        else:
+            breaks = text.count("\n", prev_end, start)
+            if breaks:
+                line += breaks
+                out.append("\n")
+                lines.append(line)
+            elif start > prev_end and _needs_space(prev_last, raw[0]):
+                out.append(" ")
+        out.append(raw)
+        # strings (and template literals) may span lines
+        for i in range(raw.count("\n")):
+            line += 1
+            lines.append(line)
+        prev_end, prev_last = end, raw[-1]
+    if out:
+        out.append("\n")
+    minified = "".join(out)
+    if _signature(minified) != _signature(text):
+        return text, range(1, text.count("\n") + 2)
+    return minified, lines
+
+_VLQ_DIGITS = ("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+               "0123456789+/")
+
+def _vlq(n):
+    n = (-n << 1) | 1 if n < 0 else n << 1
+    digits = ""
+    while True:
+        digit = n & 31
+        n >>= 5
+        if n:
+            digit |= 32
+        digits += _VLQ_DIGITS[digit]
+        if not n:
+            return digits
+
+# a (version 3) source map for a file minified from source, given the line
+# map minify_source returned.  each line maps, from its start, to the start
+# of the line it came from.
+def source_map(filename, source, lines):
+    mappings = []
+    prev = 1
+    for line in lines:
+        mappings.append("A" + "A" + _vlq(line - prev) + "A")
+        prev = line
+    return json.dumps({ "version": 3,
+                        "file": filename,
+                        "sources": [source],
+                        "names": [],
+                        "mappings": ";".join(mappings) }, sort_keys=True)
+
+def _minify_file(path):
+    with open(path, 'rb') as f:
+        text = f.read()
+    minified, lines = minify_source(text)
+    return path, minified, lines
+
+def _minify_batch(paths):
+    return [_minify_file(path) for path in paths]
+
+# minify the javascript files at the given paths, returning a dict mapping
+# each path to (minified source, line map).  files are farmed out to a pool
+# of processes (all of them by default) when there are enough of them.
+def minify_files(paths, processes=None):
+    if processes == 1 or len(paths) < MIN_PARALLEL_MINIFY:
+        results = [_minify_batch(paths)]
+    else:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes)
+        try:
+            batches = [paths[i:i + MINIFY_BATCH_SIZE]
+                       for i in range(0, len(paths), MINIFY_BATCH_SIZE)]
+            # get() with a timeout, so that ^C is delivered promptly
+            results = pool.map_async(_minify_batch, batches).get(60 * 60 * 24)
+        finally:
+            pool.terminate()
+            pool.join()
+    minified = {}
+    for batch in results:
+        for path, text, lines in batch:
+            minified[path] = (text, lines)
+    return minified
+
+# (path, path relative to dirname) of the javascript files under dirname to
+# ship, less tests and those (by relative path) in skip
+def find_scripts(dirname, skip=None):
+    found = []
+    for dirpath, dirnames, filenames in os.walk(dirname):
+        dirnames[:] = sorted([d for d in dirnames if not d.startswith(".")])
+        for filename in sorted(filenames):
+            if not filename.endswith(".js") or filename.endswith(".test.js"):
+                continue
+            path = os.path.join(dirpath, filename)
+            relpath = path[len(os.path.join(dirname, "")):]
+            if skip and relpath in skip:
+                continue
+            found.append((path, relpath))
+    return found
+
+# minify the javascript under each of dirs (a dict mapping a label for each
+# to (dirname, skip)), writing a source map for each file into
+# maps_dir/<label>/<path>.map.  returns a dict mapping the path of each
+# file to its minified contents.
+def minify_dirs(dirs, maps_dir, processes=None, verbose=False):
+    labels = {}
+    for label, (dirname, skip) in dirs.items():
+        for path, relpath in find_scripts(dirname, skip):
+            labels[path] = (label, relpath)
+    minified = minify_files(sorted(labels.keys()), processes)
+    contents = {}
+    before = after = 0
+    for path, (text, lines) in minified.items():
+        label, relpath = labels[path]
+        map_path = os.path.join(maps_dir, label, relpath + ".map")
+        if not os.path.isdir(os.path.dirname(map_path)):
+            os.makedirs(os.path.dirname(map_path))
+        with open(map_path, 'w') as f:
+            f.write(source_map(os.path.basename(path),
+                               "file://" + os.path.abspath(path), lines))
+        contents[path] = text
+        before += os.path.getsize(path)
+        after += len(text)
+    if verbose:
+        print "minified %d scripts, %d bytes down to %d" % (len(contents),
+                                                            before, after)
+    return contents
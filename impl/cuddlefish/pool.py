@@ -0,0 +1,252 @@
+import time
+import Queue
+import threading
+import subprocess
+
+from cuddlefish.channel import ControlChannel
+
+# how long a runtime has to start up and say it's ready
+START_TIMEOUT = 60
+# how many jobs a runtime runs before it's replaced by a fresh one
+DEFAULT_MAX_RUNS = 20
+# how long, once a job's result is in, to wait for the rest of its output
+OUTPUT_TIMEOUT = 5
+
+class Instance(object):
+    """
+    A runtime started to serve jobs over a control channel, with its
+    output collected job by job.
+    """
+
+    def __init__(self, start):
+        self.channel = ControlChannel()
+        self.runs = 0
+        self.ready = False
+        self._lines = []
+        self._marks = []
+        self._output_changed = threading.Condition()
+        try:
+            self.runner, self.profile = start(
+                self.channel.options,
+                {'stdout': subprocess.PIPE, 'stderr': subprocess.STDOUT}
+                )
+        except:
+            self.channel.close()
+            raise
+        self._reader = threading.Thread(target=self._read_output)
+        self._reader.setDaemon(True)
+        self._reader.start()
+
+    def _read_output(self):
+        stdout = self.runner.process_handler.stdout
+        while True:
+            line = stdout.readline()
+            self._output_changed.acquire()
+            try:
+                if not line:
+                    self._marks.append(None)
+                elif line.rstrip("\r\n").startswith(self.channel.token + " "):
+                    self._marks.append(line.split()[1])
+                    if self._lines and self._lines[-1] == "\n":
+                        # the line break the harness puts before the mark
+                        self._lines.pop()
+                else:
+                    self._lines.append(line)
+                self._output_changed.notifyAll()
+            finally:
+                self._output_changed.release()
+            if not line:
+                return
+
+    def take_output(self, job_id, timeout=OUTPUT_TIMEOUT):
+        """
+        Returns the output of the job with the given id, waiting up to
+        timeout seconds for the harness's mark of its end to come
+        through; without it, returns what output there is.
+        """
+
+        deadline = time.time() + timeout
+        self._output_changed.acquire()
+        try:
+            while not self._marks and time.time() < deadline:
+                self._output_changed.wait(max(deadline - time.time(), 0))
+            while self._marks and self._marks[0] not in (str(job_id), None):
+                self._marks.pop(0)
+            if self._marks and self._marks[0] is not None:
+                self._marks.pop(0)
+            output = "".join(self._lines)
+            self._lines = []
+            return output
+        finally:
+            self._output_changed.release()
+
+    def wait_ready(self, timeout):
+        if not self.ready:
+            message = self.channel.receive(timeout)
+            self.ready = (message is not None and
+                          message.get('status') == 'READY')
+        return self.ready
+
+    def run(self, job_id, job_options, timeout):
+        """
+        Runs a job, returning its result, or None if the runtime died
+        or timeout seconds passed first.
+        """
+
+        self.runs += 1
+        try:
+            self.channel.send({'id': job_id, 'options': job_options})
+        except IOError:
+            return None
+        while True:
+            result = self.channel.receive(timeout)
+            if result is None or result.get('id') == job_id:
+                return result
+
+    def stop(self, timeout=10):
+        """
+        Asks the runtime to quit, killing it if it doesn't within
+        timeout seconds (or can't be asked), and cleans up after it.
+        """
+
+        try:
+            quitting = False
+            if self.ready and not self.channel.closed:
+                try:
+                    self.channel.send({'quit': True})
+                    quitting = True
+                except IOError:
+                    pass
+            if quitting:
+                # this kills the runtime, if it's still running by then
+                self.runner.wait(timeout)
+            else:
+                self.runner.stop()
+        finally:
+            self.channel.close()
+            if self.profile:
+                self.profile.cleanup()
+
+class RuntimePool(object):
+    """
+    A pool of runtimes, kept running between test runs, so that a run
+    needn't wait for a runtime to start up.
+
+    start is called as start(control_options, popen_kwargs) to start
+    each runtime, and returns (runner, profile) as runner.start_app()
+    does: the runtime is to be started with control_options as its
+    controlChannel harness option, and popen_kwargs passed on to its
+    process.  size runtimes are started up front.  Each is replaced by
+    a fresh one after max_runs jobs, or as soon as a job fails, times
+    out or the runtime dies, so that nothing a job leaves behind
+    lingers for long.  Should a replacement fail to start, the pool
+    carries on with those it has; once it has none, jobs fail at once.
+    """
+
+    def __init__(self, start, size=1, max_runs=DEFAULT_MAX_RUNS,
+                 start_timeout=START_TIMEOUT):
+        self.start = start
+        self.size = size
+        self.max_runs = max_runs
+        self.start_timeout = start_timeout
+        self.started = 0
+        self._idle = Queue.Queue()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._closed = False
+        self._instances = set()
+        # why the last runtime which failed to start did
+        self._start_error = None
+        for i in range(size):
+            self._spawn()
+
+    def _spawn(self):
+        instance = Instance(self.start)
+        self._lock.acquire()
+        try:
+            self.started += 1
+            self._instances.add(instance)
+        finally:
+            self._lock.release()
+        self._idle.put(instance)
+
+    def _retire(self, instance):
+        self._lock.acquire()
+        try:
+            self._instances.discard(instance)
+        finally:
+            self._lock.release()
+        instance.stop()
+
+    def _replace(self):
+        """
+        Starts a runtime in place of one retired.  If it can't be, and
+        there are no runtimes left, those waiting for one are woken to
+        fail their jobs.
+        """
+
+        try:
+            self._spawn()
+        except Exception, e:
+            self._lock.acquire()
+            try:
+                self._start_error = e
+                exhausted = not self._instances
+            finally:
+                self._lock.release()
+            if exhausted:
+                # a sentinel, which each waiter passes on to the next
+                self._idle.put(None)
+
+    def run(self, job_options, timeout=None):
+        """
+        Runs a job, on whichever runtime is free first, with the given
+        harness options, and returns (result, output): the result the
+        harness reported (None if it didn't) and everything it printed
+        meanwhile.  May be called from any number of threads at once.
+        """
+
+        if self._closed:
+            raise ValueError("the pool is closed")
+        self._lock.acquire()
+        try:
+            self._next_id += 1
+            job_id = self._next_id
+        finally:
+            self._lock.release()
+
+        # get() with a timeout, so that ^C is delivered promptly
+        instance = self._idle.get(True, 60 * 60 * 24)
+        if instance is None:
+            self._idle.put(None)
+            return None, ("couldn't start a runtime: %s\n" %
+                          self._start_error)
+        result = None
+        output = ""
+        try:
+            if instance.wait_ready(self.start_timeout):
+                result = instance.run(job_id, job_options, timeout)
+            output = instance.take_output(job_id,
+                                          OUTPUT_TIMEOUT if result else 0)
+        finally:
+            if (result is None or result.get('status') != 'OK' or
+                instance.runs >= self.max_runs or self._closed):
+                self._retire(instance)
+                if not self._closed:
+                    self._replace()
+            else:
+                self._idle.put(instance)
+        if result is not None:
+            del result['id']
+        return result, output
+
+    def close(self):
+        self._closed = True
+        self._lock.acquire()
+        try:
+            instances = list(self._instances)
+            self._instances = set()
+        finally:
+            self._lock.release()
+        for instance in instances:
+            instance.stop()
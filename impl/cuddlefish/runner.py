@@ -4,50 +4,18 @@ import time
 import tempfile
 import atexit
 import shutil
+import threading
 
 import simplejson as json
 import mozrunner
 from cuddlefish.prefs import DEFAULT_COMMON_PREFS
 from cuddlefish.prefs import DEFAULT_FIREFOX_PREFS
 from cuddlefish.prefs import DEFAULT_THUNDERBIRD_PREFS
+from cuddlefish.watch import FileTail, PollingWatcher
+from cuddlefish.channel import ResultChannel
 
-def follow_file(filename):
-    """
-    Generator that yields the latest unread content from the given
-    file, or None if no new content is available.
-
-    For example:
-
-      >>> f = open('temp.txt', 'w')
-      >>> f.write('hello')
-      >>> f.flush()
-      >>> tail = follow_file('temp.txt')
-      >>> tail.next()
-      'hello'
-      >>> tail.next() is None
-      True
-      >>> f.write('there')
-      >>> f.flush()
-      >>> tail.next()
-      'there'
-      >>> f.close()
-      >>> os.remove('temp.txt')
-    """
-
-    last_pos = 0
-    last_size = 0
-    while True:
-        newstuff = None
-        if os.path.exists(filename):
-            size = os.stat(filename).st_size
-            if size > last_size:
-                last_size = size
-                f = open(filename, 'r')
-                f.seek(last_pos)
-                newstuff = f.read()
-                last_pos = f.tell()
-                f.close()
-        yield newstuff
+# how often, while waiting for its result, to check that the app's running
+RESULT_POLL_INTERVAL = 0.5
 
 class FennecProfile(mozrunner.Profile):
     preferences = {}
@@ -185,12 +153,20 @@ class XulrunnerAppRunner(mozrunner.Runner):
                 self.names = runner.names
         return self.__real_binary
 
-def run_app(harness_root_dir, harness_options,
-            app_type, binary=None, profiledir=None, verbose=False,
-            timeout=None, logfile=None, addons=None):
+def start_app(harness_root_dir, harness_options, app_type, binary=None,
+              profiledir=None, addons=None, popen_kwargs=None,
+              verbose=True, profile_cache=None, prefs_file=None):
+    """
+    Starts the app at harness_root_dir, running with the given harness
+    options, and returns (runner, profile).  popen_kwargs are passed on
+    to the process, e.g. to redirect its output.  Given a profile_cache
+    directory, the profile is cloned from a template there, if there is
+    one (see mozrunner.Profile).  Preferences in prefs_file, a JSON
+    file, are set along with the defaults.
+    """
+
     if binary:
         binary = os.path.expanduser(binary)
-
     if addons is None:
         addons = []
     else:
@@ -221,11 +197,82 @@ def run_app(harness_root_dir, harness_options,
         if sys.platform == 'darwin':
             cmdargs.append('-foreground')
 
-    resultfile = os.path.join(tempfile.gettempdir(), 'harness_result')
-    if os.path.exists(resultfile):
-        os.remove(resultfile)
-    harness_options['resultFile'] = resultfile
+    if prefs_file:
+        preferences.update(mozrunner.read_prefs_json(prefs_file))
+
+    env = {}
+    env.update(os.environ)
+    env['MOZ_NO_REMOTE'] = '1'
+    env['HARNESS_OPTIONS'] = json.dumps(harness_options)
+
+    if popen_kwargs is None:
+        popen_kwargs = {}
+
+    # the runner finds the binary, which profile templates are kept per
+    runner = runner_class(profile=None,
+                          binary=binary,
+                          env=env,
+                          cmdargs=cmdargs,
+                          kp_kwargs=popen_kwargs)
+    profile = profile_class(binary=runner.binary,
+                            addons=addons,
+                            profile=profiledir,
+                            preferences=preferences,
+                            template_cache=profile_cache)
+    runner.profile = profile
+
+    if verbose:
+        print "Using binary at '%s'." % runner.binary
+        print "Using profile at '%s'." % profile.profile
 
+    runner.start()
+    return runner, profile
+
+def app_running(runner):
+    """
+    Whether the app, or an instance of itself it restarted as, is still
+    running.
+    """
+
+    if runner.process_handler.poll() is None:
+        return True
+    if sys.platform == 'win32':
+        return False
+    return bool([pid for pid in runner.related_pids()
+                 if mozrunner.pid_alive(pid)])
+
+def wait_for_result(channel, runner, timeout=None, starttime=None):
+    """
+    Waits for the app started by runner to report its result over
+    channel, and returns it.  Raises an exception if the app exits
+    without doing so, or if timeout seconds (from starttime) pass
+    first.
+    """
+
+    deadline = None
+    if timeout:
+        deadline = (starttime or time.time()) + timeout
+    while True:
+        wait = RESULT_POLL_INTERVAL
+        if deadline is not None:
+            wait = max(min(wait, deadline - time.time()), 0)
+        result = channel.wait(wait)
+        if result is not None:
+            return result
+        if not app_running(runner):
+            # a result sent as the app quit may still be on its way
+            result = channel.wait(RESULT_POLL_INTERVAL)
+            if result is None:
+                raise Exception("The application exited without reporting "
+                                "a result")
+            return result
+        if deadline is not None and time.time() >= deadline:
+            raise Exception("Wait timeout exceeded (%ds)" % timeout)
+
+def run_app(harness_root_dir, harness_options,
+            app_type, binary=None, profiledir=None, verbose=False,
+            timeout=None, logfile=None, addons=None, profile_cache=None,
+            prefs_file=None):
     def maybe_remove_logfile():
         if os.path.exists(logfile):
             os.remove(logfile)
@@ -236,8 +283,9 @@ def run_app(harness_root_dir, harness_options,
         if not logfile:
             # If we're on Windows, we need to keep a logfile simply
             # to print console output to stdout.
-            logfile = os.path.join(tempfile.gettempdir(), 'harness_log')
-        logfile_tail = follow_file(logfile)
+            fd, logfile = tempfile.mkstemp(prefix='harness_log')
+            os.close(fd)
+        logfile_tail = FileTail(logfile)
         atexit.register(maybe_remove_logfile)
 
     if logfile:
@@ -245,58 +293,76 @@ def run_app(harness_root_dir, harness_options,
         maybe_remove_logfile()
         harness_options['logFile'] = logfile
 
-    env = {}
-    env.update(os.environ)
-    env['MOZ_NO_REMOTE'] = '1'
-    env['HARNESS_OPTIONS'] = json.dumps(harness_options)
+    # the log is echoed from a thread of its own, so that we can simply
+    # block until the result comes in
+    tail_done = threading.Event()
+    def tail_log():
+        watcher = PollingWatcher([logfile])
+        try:
+            while True:
+                finishing = tail_done.isSet()
+                new_chars = logfile_tail.read()
+                if new_chars:
+                    sys.stdout.write(new_chars)
+                    sys.stdout.flush()
+                if finishing:
+                    break
+                # wake up now and then to see whether we're done
+                watcher.wait(0.5)
+        finally:
+            watcher.close()
+    tail_thread = None
+    if logfile_tail:
+        tail_thread = threading.Thread(target=tail_log)
+        tail_thread.setDaemon(True)
 
     starttime = time.time()
 
-    popen_kwargs = {}
-    profile = None
-
-    profile = profile_class(addons=addons,
-                            profile=profiledir,
-                            preferences=preferences)
-    runner = runner_class(profile=profile,
-                          binary=binary,
-                          env=env,
-                          cmdargs=cmdargs,
-                          kp_kwargs=popen_kwargs)
-
-    print "Using binary at '%s'." % runner.binary
-    print "Using profile at '%s'." % profile.profile
-
-    runner.start()
+    # each run gets a channel of its own for the harness to report its
+    # result over
+    channel = ResultChannel()
+    harness_options['resultChannel'] = channel.options
+    try:
+        runner, profile = start_app(harness_root_dir, harness_options,
+                                    app_type, binary=binary,
+                                    profiledir=profiledir, addons=addons,
+                                    profile_cache=profile_cache,
+                                    prefs_file=prefs_file)
+    except:
+        channel.close()
+        raise
+    if tail_thread:
+        tail_thread.start()
 
-    done = False
-    output = None
+    result = None
     try:
-        while not done:
-            time.sleep(0.05)
-            if logfile_tail:
-                new_chars = logfile_tail.next()
-                if new_chars:
-                    sys.stdout.write(new_chars)
-                    sys.stdout.flush()
-            if os.path.exists(resultfile):
-                output = open(resultfile).read()
-                if output in ['OK', 'FAIL']:
-                    done = True
-            if timeout and (time.time() - starttime > timeout):
-                raise Exception("Wait timeout exceeded (%ds)" %
-                                timeout)
+        result = wait_for_result(channel, runner, timeout, starttime)
     except:
         runner.stop()
         raise
     else:
         runner.wait(10)
+        if (profile_cache and result.get('status') == 'OK' and
+            not runner.process_handler.kill_called):
+            # the app set the profile up, and shut down by itself, so new
+            # profiles can start from where this one is now
+            profile.save_template()
     finally:
+        channel.close()
+        if tail_thread:
+            tail_done.set()
+            tail_thread.join()
+            logfile_tail.close()
         if profile:
             profile.cleanup()
 
     print "Total time: %f seconds" % (time.time() - starttime)
 
+    output = result.get('status')
+    if 'passed' in result and 'failed' in result:
+        print "%d tests passed, %d failed." % (result['passed'],
+                                                result['failed'])
+
     if output == 'OK':
         print "Program terminated successfully."
         return 0
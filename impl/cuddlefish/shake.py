@@ -0,0 +1,95 @@
+from __future__ import with_statement
+import os
+import re
+import sys
+from cuddlefish.manifest import scan_source
+from cuddlefish.bundle import program_sections
+
+# Tree shaking: rather than ship every module of every package, ship only
+# those the app can reach.  We start from the main module, the modules the
+# loader and harness require for themselves, anything the app's browser code
+# requires, and an allowlist (for modules which are only ever required
+# dynamically, by a name computed at runtime), and follow the require graph
+# from there.  Files other than modules are always shipped, since modules
+# may read them.
+
+# modules the loader and harness require by name
+IMPLICIT_MODULES = ["es5", "unload", "plain-text-console", "memory",
+                    "traceback", "url"]
+
+# browser code in these files may call require()
+BROWSER_CODE_SUFFIXES = [".html", ".htm", ".xhtml", ".xul", ".svg", ".js"]
+
+_SCRIPT_RE = re.compile(r"<script\b[^>]*>(.*?)</script\s*>", re.S | re.I)
+
+# the names of the modules required by the browser code in browser_code_dir
+def browser_requires(browser_code_dir):
+    names = set()
+    for dirpath, dirnames, filenames in os.walk(browser_code_dir):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        for filename in filenames:
+            if not [s for s in BROWSER_CODE_SUFFIXES if filename.endswith(s)]:
+                continue
+            with open(os.path.join(dirpath, filename), 'rb') as f:
+                text = f.read()
+            if filename.endswith(".js"):
+                scripts = [text]
+            else:
+                scripts = _SCRIPT_RE.findall(text)
+            for script in scripts:
+                requires, chrome = scan_source(script)
+                names.update(requires)
+    names.discard("chrome")
+    return names
+
+# work out which modules of manifest to ship.  returns (shipped, omit):
+# shipped is the set of urls of the modules to ship, and omit maps each
+# resource name to the paths (relative to the resource's directory) of the
+# modules to leave out of it.
+def shake(manifest, graph, harness_options, browser_code_dir, keep=(),
+          stderr=sys.stderr, verbose=False):
+    # where an absolute require() of each module name leads
+    first = {}
+    by_package = {}
+    for url in sorted(manifest.keys()):
+        by_package.setdefault(manifest[url].packageName, []).append(url)
+    for prefix, resource_url, pkg_name, section, dirname in \
+            program_sections(harness_options):
+        for url in by_package.get(pkg_name, []):
+            first.setdefault(manifest[url].name, url)
+
+    roots = set()
+    # the loader itself, and securable-module, which it loads from beside
+    # itself
+    loader = harness_options['loader']
+    roots.add(loader)
+    roots.add(loader.rpartition("/")[0] + "/securable-module.js")
+    names = set([harness_options['main']] + IMPLICIT_MODULES + list(keep))
+    names.update(browser_requires(browser_code_dir))
+    for name in sorted(names):
+        if name in first:
+            roots.add(first[name])
+        elif name in keep:
+            print >>stderr, "warning: module '%s' (to be kept) not found" % name
+    roots = set([url for url in roots if url in manifest])
+
+    shipped = set()
+    todo = list(roots)
+    while todo:
+        url = todo.pop()
+        if url in shipped:
+            continue
+        shipped.add(url)
+        todo.extend(graph.dependencies(url))
+        adapter = manifest[url]['e10s-adapter']
+        if adapter:
+            todo.append(adapter)
+
+    omit = {}
+    for url, info in manifest.items():
+        if url not in shipped:
+            omit.setdefault(info.packageName, set()).add(
+                os.path.join(*(info.name + ".js").split("/")))
+    if verbose:
+        print "shipping %d of %d modules" % (len(shipped), len(manifest))
+    return shipped, omit
@@ -0,0 +1,278 @@
+from __future__ import with_statement
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import uuid
+import threading
+import traceback
+import subprocess
+import Queue
+from xml.sax.saxutils import quoteattr, escape
+
+import simplejson as json
+
+# Example tests are run in parallel, each by a cfx of its own in a work
+# directory of its own: the generated test-app.js (the example's test, plus
+# the options it expects) goes in one subdirectory, and the app is built into
+# another.  Every run has its own profile and result channel, so nothing is
+# shared between them.
+#
+# Alternatively ("warm" testing), a pool of runtimes is started up front, and
+# each test is handed to whichever is free, as a job (see pool.py).  Each test
+# still runs in a loader of its own, with options of its own, but runtimes
+# (and their profiles) are reused from test to test, which saves starting one
+# up per test.
+
+# the driver each test runs under; argv[1] is the parent's options (as
+# json), used as defaults
+CHILD_DRIVER = ("import sys, simplejson, cuddlefish; "
+                "cuddlefish.run(sys.argv[2:], "
+                "defaults=simplejson.loads(sys.argv[1]))")
+
+_COUNTS_RE = re.compile(r"^(\d+) tests passed, (\d+) failed\.$", re.M)
+
+# the examples under examples_dir which have tests, as (name, path to
+# test-app.js)
+def find_examples(examples_dir):
+    examples = []
+    for dirname in sorted(os.listdir(examples_dir)):
+        test_script = os.path.join(examples_dir, dirname, "test-app.js")
+        if os.path.isfile(test_script):
+            examples.append((dirname, test_script))
+    return examples
+
+# write the test-app.js for the example named dirname into test_dir
+def write_test_app(env_root, dirname, test_script, test_dir):
+    default_browser = os.path.join(".", "tests", dirname, "index.html")
+    static_args = { "quitWhenDone": True, "browser": default_browser,
+                    "appBasePath": env_root }
+    with open(test_script, 'r') as f:
+        test_content = f.read()
+    with open(os.path.join(test_dir, "test-app.js"), 'w') as f:
+        f.write("var options = %s;\n" %
+                json.dumps({ "staticArgs": static_args }))
+        f.write(test_content)
+
+# test a single example, in work_dir, returning a dict describing the result
+def run_example(env_root, examples_dir, dirname, test_script, work_dir,
+                defaults):
+    test_dir = os.path.join(work_dir, "tests")
+    os.makedirs(test_dir)
+    write_test_app(env_root, dirname, test_script, test_dir)
+    browser = os.path.join(examples_dir, dirname, "index.html")
+    args = [sys.executable, "-c", CHILD_DRIVER, json.dumps(defaults),
+            "test",
+            "--pkgdir", "packages/chromeless",
+            "--test-dir", test_dir,
+            "--work-dir", work_dir,
+            "--static-args", json.dumps({"browser": browser})]
+    env = dict(os.environ)
+    env['CUDDLEFISH_ROOT'] = env_root
+    python_lib_dir = os.path.join(env_root, "impl")
+    env['PYTHONPATH'] = os.pathsep.join([python_lib_dir] +
+                                        [p for p in [env.get('PYTHONPATH')] if p])
+    started = time.time()
+    try:
+        popen = subprocess.Popen(args, cwd=env_root, env=env,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        output = popen.communicate()[0]
+        returncode = popen.returncode
+    except OSError, e:
+        output = "couldn't run cfx: %s\n" % e
+        returncode = -1
+    result = { "name": dirname,
+               "status": "passed" if returncode == 0 else "failed",
+               "returncode": returncode,
+               "time": time.time() - started,
+               "output": output.decode("utf-8", "replace") }
+    m = _COUNTS_RE.search(output)
+    if m:
+        result["passed"] = int(m.group(1))
+        result["failed"] = int(m.group(2))
+    return result
+
+# build the app which runtimes serving jobs run, into work_root, returning
+# (the app's directory, the harness options it's to be started with)
+def build_runtime_app(env_root, browser, work_root):
+    from cuddlefish import build_harness_options
+    import appifier
+    harness_options = build_harness_options("run", str(uuid.uuid4()),
+                                            { "browser": browser })
+    app_dir = appifier.Appifier().output_xul_app(
+        browser_code=browser, harness_options=harness_options,
+        dev_mode=True, verbose=False,
+        output_dir=os.path.join(work_root, "runtime.xul"))
+    return app_dir, harness_options
+
+# test a single example, in work_dir, on a runtime from pool, returning a dict
+# describing the result as run_example() does
+def run_warm_example(pool, env_root, examples_dir, dirname, test_script,
+                     work_dir, timeout=None):
+    from cuddlefish import build_harness_options
+    test_dir = os.path.join(work_dir, "tests")
+    os.makedirs(test_dir)
+    write_test_app(env_root, dirname, test_script, test_dir)
+    app_dir = os.path.join(examples_dir, dirname)
+    job_options = build_harness_options(
+        "test", str(uuid.uuid4()),
+        { "browser": os.path.join(app_dir, "index.html") }, test_dir)
+    # as the app would see them if it were built on its own
+    job_options["staticArgs"] = { "browser": "index.html",
+                                  "appBasePath": app_dir }
+    started = time.time()
+    result, output = pool.run(job_options, timeout)
+    if result is None:
+        output += "no result from the runtime (it died, or timed out)\n"
+        status = "failed"
+        returncode = -1
+    else:
+        status = "passed" if result.get("status") == "OK" else "failed"
+        returncode = 0 if status == "passed" else -1
+    summary = { "name": dirname,
+                "status": status,
+                "returncode": returncode,
+                "time": time.time() - started,
+                "output": output.decode("utf-8", "replace") }
+    if result and "passed" in result and "failed" in result:
+        summary["passed"] = result["passed"]
+        summary["failed"] = result["failed"]
+    return summary
+
+# a pool of runtimes of the app in app_dir, started as cfx would start them
+# given the options in defaults
+def start_pool(app_dir, harness_options, defaults, size, max_runs=None):
+    from cuddlefish.pool import RuntimePool, DEFAULT_MAX_RUNS
+    from cuddlefish.runner import start_app
+
+    def start(control_options, popen_kwargs):
+        options = dict(harness_options)
+        options["controlChannel"] = control_options
+        return start_app(app_dir, options, defaults.get("app") or "xulrunner",
+                         binary=defaults.get("binary"),
+                         popen_kwargs=popen_kwargs, verbose=False,
+                         profile_cache=defaults.get("profile_cache"),
+                         prefs_file=defaults.get("prefs_file"))
+
+    return RuntimePool(start, size, max_runs=max_runs or DEFAULT_MAX_RUNS)
+
+def _default_jobs():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+# test every example under examples_dir which has tests, jobs at a time
+# (one per CPU by default).  with warm, tests are run on a pool of jobs
+# runtimes, each replaced after max_runs tests.  on_result is called with
+# each result as it comes in.  returns the results, in the order of the
+# examples.
+def run_examples(env_root, examples_dir, defaults, jobs=None, on_result=None,
+                 warm=False, max_runs=None, timeout=None):
+    examples = find_examples(examples_dir)
+    if not jobs:
+        jobs = _default_jobs()
+    jobs = min(jobs, len(examples))
+    work_root = tempfile.mkdtemp(prefix="testex-")
+    pool = None
+    if warm and examples:
+        try:
+            app_dir, harness_options = build_runtime_app(
+                env_root,
+                os.path.join(examples_dir, examples[0][0], "index.html"),
+                work_root)
+            pool = start_pool(app_dir, harness_options, defaults, jobs,
+                              max_runs)
+        except:
+            shutil.rmtree(work_root, ignore_errors=True)
+            raise
+    todo = Queue.Queue()
+    for i, example in enumerate(examples):
+        todo.put((i, example))
+    results = [None] * len(examples)
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                i, (dirname, test_script) = todo.get_nowait()
+            except Queue.Empty:
+                return
+            work_dir = os.path.join(work_root, dirname)
+            started = time.time()
+            try:
+                if pool:
+                    result = run_warm_example(pool, env_root, examples_dir,
+                                              dirname, test_script, work_dir,
+                                              timeout)
+                else:
+                    result = run_example(env_root, examples_dir, dirname,
+                                         test_script, work_dir, defaults)
+            except Exception:
+                # the example fails, but the rest still run
+                result = { "name": dirname,
+                           "status": "failed",
+                           "returncode": -1,
+                           "time": time.time() - started,
+                           "output": traceback.format_exc().decode("utf-8",
+                                                                   "replace") }
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+            with lock:
+                results[i] = result
+                if on_result:
+                    on_result(result)
+
+    threads = [threading.Thread(target=worker) for i in range(jobs)]
+    try:
+        for t in threads:
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            # join with a timeout, so that ^C is delivered promptly
+            while t.isAlive():
+                t.join(1)
+    finally:
+        if pool:
+            pool.close()
+        shutil.rmtree(work_root, ignore_errors=True)
+    return results
+
+# characters which can't appear in xml at all
+_XML_INVALID_RE = re.compile(u"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+def junit_report(results, name="examples"):
+    failures = len([r for r in results if r["status"] != "passed"])
+    total_time = sum([r["time"] for r in results])
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<testsuite name=%s tests="%d" failures="%d" errors="0" '
+             'time="%.3f">' % (quoteattr(name), len(results), failures,
+                               total_time)]
+    for r in results:
+        lines.append('  <testcase classname=%s name=%s time="%.3f">' %
+                     (quoteattr(name), quoteattr(r["name"]), r["time"]))
+        if r["status"] != "passed":
+            lines.append('    <failure message=%s/>' %
+                         quoteattr("exited with code %d" % r["returncode"]))
+        output = _XML_INVALID_RE.sub(u"", r["output"])
+        lines.append('    <system-out>%s</system-out>' % escape(output))
+        lines.append('  </testcase>')
+    lines.append('</testsuite>')
+    return "\n".join(lines) + "\n"
+
+def json_report(results):
+    return json.dumps({ "tests": results }, indent=2, sort_keys=True)
+
+# write a report of results to path: JUnit XML if path ends in .xml,
+# otherwise JSON
+def write_report(results, path):
+    if path.endswith(".xml"):
+        report = junit_report(results).encode("utf-8")
+    else:
+        report = json_report(results)
+    with open(path, 'w') as f:
+        f.write(report)
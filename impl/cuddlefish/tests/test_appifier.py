@@ -0,0 +1,403 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import tarfile
+import zipfile
+
+from appifier._output import IncrementalOutput, output_intact
+from appifier._copy import CopyEngine, copy_file
+from appifier import _archive
+from appifier._cache import BuildCache
+from appifier import _linux
+
+class IncrementalOutputTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(suffix=".appifier")
+        self.src = os.path.join(self.dir, "src")
+        self.out = os.path.join(self.dir, "app.xul")
+        self.manifest = os.path.join(self.dir, ".app.xul.manifest.json")
+        os.makedirs(os.path.join(self.src, "lib"))
+        self.write(os.path.join(self.src, "main.js"), "main")
+        self.write(os.path.join(self.src, "lib", "util.js"), "util")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, path, data):
+        f = open(path, 'w')
+        f.write(data)
+        f.close()
+
+    def read(self, path):
+        f = open(path, 'r')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def build(self, files, contents=None, links=None, **kwargs):
+        output = IncrementalOutput(self.out, self.manifest, **kwargs)
+        output.add_dir("")
+        for rel in files:
+            output.add_file(os.path.join(self.src, rel), rel)
+        for rel, data in (contents or {}).items():
+            output.add_contents(rel, data)
+        for rel in (links or []):
+            output.add_link(os.path.join(self.src, rel), rel)
+        return output.close()
+
+    def test_unchanged_files_are_left_alone(self):
+        stats = self.build(["main.js", "lib/util.js"], {"harness-options.json": "{}"})
+        self.failUnlessEqual((stats["copied"], stats["written"]), (2, 1))
+        stats = self.build(["main.js", "lib/util.js"], {"harness-options.json": "{}"})
+        self.failUnlessEqual(stats["unchanged"], 3)
+        self.failUnlessEqual(stats["copied"] + stats["written"], 0)
+
+    def test_changed_and_touched_files(self):
+        self.build(["main.js", "lib/util.js"])
+        self.write(os.path.join(self.src, "main.js"), "main, changed")
+        # touched, but not changed
+        future = time.time() + 10
+        os.utime(os.path.join(self.src, "lib", "util.js"), (future, future))
+        stats = self.build(["main.js", "lib/util.js"])
+        self.failUnlessEqual((stats["copied"], stats["unchanged"]), (1, 1))
+        self.failUnlessEqual(self.read(os.path.join(self.out, "main.js")), "main, changed")
+
+    def test_generated_contents_rewritten_only_when_different(self):
+        self.build([], {"application.ini": "one"})
+        self.failUnlessEqual(self.build([], {"application.ini": "one"})["written"], 0)
+        self.failUnlessEqual(self.build([], {"application.ini": "two"})["written"], 1)
+        self.failUnlessEqual(self.read(os.path.join(self.out, "application.ini")), "two")
+
+    def test_stale_files_are_removed(self):
+        self.build(["main.js", "lib/util.js"])
+        stats = self.build(["main.js"])
+        self.failUnlessEqual(stats["removed"], 1)
+        self.failIf(os.path.exists(os.path.join(self.out, "lib")))
+
+    def test_links_replaced_by_copies(self):
+        # a development build links lib/, a later build copies into it and
+        # must not write through the link into the source
+        self.build([], links=["lib"])
+        self.failUnless(os.path.islink(os.path.join(self.out, "lib")))
+        stats = self.build(["lib/util.js"])
+        self.failUnlessEqual(stats["copied"], 1)
+        self.failIf(os.path.islink(os.path.join(self.out, "lib")))
+        self.failUnlessEqual(os.listdir(os.path.join(self.src, "lib")), ["util.js"])
+        self.failUnlessEqual(self.read(os.path.join(self.out, "lib", "util.js")), "util")
+
+    def test_copies_replaced_by_links(self):
+        # files copied last time are now reachable through a link into the
+        # source, they must not be removed from there
+        self.build(["lib/util.js"])
+        stats = self.build([], links=["lib"])
+        self.failUnlessEqual(stats["removed"], 0)
+        self.failUnlessEqual(os.listdir(os.path.join(self.src, "lib")), ["util.js"])
+        self.failUnless(os.path.islink(os.path.join(self.out, "lib")))
+
+    def test_without_hashes(self):
+        self.build(["main.js"], hash_files=False)
+        future = time.time() + 10
+        os.utime(os.path.join(self.src, "main.js"), (future, future))
+        stats = self.build(["main.js"], hash_files=False)
+        self.failUnlessEqual(stats["copied"], 1)
+        self.failUnlessEqual(self.build(["main.js"], hash_files=False)["unchanged"], 1)
+
+    def test_unknown_output_kept(self):
+        os.makedirs(os.path.join(self.out, "xulrunner"))
+        self.build(["main.js"], clear_unknown=False)
+        self.failUnlessEqual(sorted(os.listdir(self.out)), ["main.js", "xulrunner"])
+
+    def test_unknown_output_is_rebuilt(self):
+        os.makedirs(os.path.join(self.out, "leftovers"))
+        self.build(["main.js"])
+        self.failUnlessEqual(os.listdir(self.out), ["main.js"])
+
+    def test_output_intact(self):
+        self.failIf(output_intact(self.out, self.manifest))
+        self.build(["main.js"], {"harness-options.json": "{}"}, links=["lib"])
+        self.failUnless(output_intact(self.out, self.manifest))
+        os.remove(os.path.join(self.out, "main.js"))
+        self.failIf(output_intact(self.out, self.manifest))
+        self.build(["main.js", "lib/util.js"], {"harness-options.json": "{}"})
+        self.failUnless(output_intact(self.out, self.manifest))
+        self.write(os.path.join(self.out, "harness-options.json"), "{broken}")
+        self.failIf(output_intact(self.out, self.manifest))
+
+class CopyEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(suffix=".copy")
+        self.src = os.path.join(self.dir, "src")
+        self.dst = os.path.join(self.dir, "dst")
+        os.makedirs(self.src)
+        os.makedirs(self.dst)
+        self.names = ["file%d" % i for i in range(50)]
+        for i, name in enumerate(self.names):
+            f = open(os.path.join(self.src, name), 'wb')
+            f.write(name * (i * 1000 + 1))
+            f.close()
+        os.chmod(os.path.join(self.src, "file1"), 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_copies(self):
+        for name in self.names:
+            a = open(os.path.join(self.src, name), 'rb').read()
+            b = open(os.path.join(self.dst, name), 'rb').read()
+            self.failUnlessEqual(a, b)
+        self.failUnlessEqual(os.stat(os.path.join(self.dst, "file1")).st_mode & 0777, 0755)
+
+    def test_parallel_copy(self):
+        engine = CopyEngine(workers=4)
+        for name in self.names:
+            engine.copy(os.path.join(self.src, name), os.path.join(self.dst, name))
+        engine.wait()
+        self.check_copies()
+        self.failIfEqual(os.stat(os.path.join(self.src, "file0")).st_ino,
+                         os.stat(os.path.join(self.dst, "file0")).st_ino)
+
+    def test_hardlink(self):
+        engine = CopyEngine(workers=4, hardlink=True)
+        for name in self.names:
+            engine.copy(os.path.join(self.src, name), os.path.join(self.dst, name))
+        engine.wait()
+        self.check_copies()
+        self.failUnlessEqual(os.stat(os.path.join(self.src, "file0")).st_ino,
+                             os.stat(os.path.join(self.dst, "file0")).st_ino)
+
+    def test_copy_does_not_write_through_links(self):
+        src = os.path.join(self.src, "file3")
+        before = open(src, 'rb').read()
+        dst = os.path.join(self.dst, "file3")
+        os.link(src, dst)
+        copy_file(os.path.join(self.src, "file4"), dst)
+        self.failUnlessEqual(open(src, 'rb').read(), before)
+
+    def test_errors_are_raised(self):
+        engine = CopyEngine(workers=2)
+        engine.copy(os.path.join(self.src, "missing"), os.path.join(self.dst, "x"))
+        self.assertRaises(IOError, engine.wait)
+
+class ArchiveOutputTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "src")
+        os.makedirs(os.path.join(self.src, "sub"))
+        for name, data in [("a.js", "alert(1);"), ("sub/b.html", "<p>b</p>" * 1000),
+                           ("run", "#!/bin/sh")]:
+            f = open(os.path.join(self.src, name), 'wb')
+            f.write(data)
+            f.close()
+        os.chmod(os.path.join(self.src, "run"), 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build(self, name, format, order, workers=4):
+        path = os.path.join(self.tmp, name)
+        output = _archive.ArchiveOutput(path, format, workers=workers)
+        for relpath in order:
+            if relpath == "generated.json":
+                output.add_contents(relpath, u'{"x": 1}')
+            else:
+                output.add_file(os.path.join(self.src, relpath), relpath)
+        output.add_dir("empty")
+        output.close()
+        return path
+
+    def test_zip_is_reproducible(self):
+        one = self.build("one.zip", "zip", ["run", "sub/b.html", "a.js", "generated.json"])
+        # a later build, adding entries in a different order
+        os.utime(os.path.join(self.src, "a.js"), (1, 1))
+        two = self.build("two.zip", "zip", ["generated.json", "a.js", "sub/b.html", "run"],
+                         workers=1)
+        self.failUnlessEqual(open(one, 'rb').read(), open(two, 'rb').read())
+
+        zf = zipfile.ZipFile(one)
+        self.failUnlessEqual(zf.namelist(), ["a.js", "empty/", "generated.json",
+                                             "run", "sub/", "sub/b.html"])
+        self.failUnlessEqual(zf.testzip(), None)
+        self.failUnlessEqual(zf.read("sub/b.html"), "<p>b</p>" * 1000)
+        self.failUnlessEqual(zf.read("generated.json"), '{"x": 1}')
+        self.failUnlessEqual(zf.getinfo("run").external_attr >> 16, 0100755)
+        self.failUnlessEqual(zf.getinfo("a.js").date_time, (1980, 1, 1, 0, 0, 0))
+        self.failUnlessEqual(zf.getinfo("sub/").compress_type, zipfile.ZIP_STORED)
+
+    def test_tar_is_reproducible(self):
+        # enough data to span several compressed blocks
+        old_block_size = _archive.GZIP_BLOCK_SIZE
+        _archive.GZIP_BLOCK_SIZE = 1024
+        try:
+            one = self.build("one.tar.gz", "tar.gz", ["a.js", "sub/b.html", "run"])
+            two = self.build("two.tar.gz", "tar.gz", ["run", "sub/b.html", "a.js"],
+                             workers=1)
+        finally:
+            _archive.GZIP_BLOCK_SIZE = old_block_size
+        self.failUnlessEqual(open(one, 'rb').read(), open(two, 'rb').read())
+
+        tar = tarfile.open(one, "r:gz")
+        try:
+            self.failUnlessEqual(tar.getnames(), ["a.js", "empty", "run", "sub",
+                                                  "sub/b.html"])
+            self.failUnlessEqual(tar.extractfile("sub/b.html").read(),
+                                 "<p>b</p>" * 1000)
+            self.failUnlessEqual(tar.getmember("run").mode, 0755)
+            self.failUnlessEqual(tar.getmember("a.js").mtime,
+                                 _archive.DEFAULT_TIMESTAMP)
+        finally:
+            tar.close()
+
+    def test_large_files_streamed(self):
+        old_sizes = _archive.STREAM_SIZE, _archive.READ_SIZE
+        _archive.STREAM_SIZE, _archive.READ_SIZE = 1024, 100
+        try:
+            zip_path = self.build("big.zip", "zip", ["a.js", "sub/b.html", "run"])
+            tar_path = self.build("big.tar.gz", "tar.gz", ["a.js", "sub/b.html"])
+        finally:
+            _archive.STREAM_SIZE, _archive.READ_SIZE = old_sizes
+        zf = zipfile.ZipFile(zip_path)
+        self.failUnlessEqual(zf.testzip(), None)
+        self.failUnlessEqual(zf.read("sub/b.html"), "<p>b</p>" * 1000)
+        self.failUnlessEqual(zf.read("run"), "#!/bin/sh")
+        tar = tarfile.open(tar_path, "r:gz")
+        try:
+            self.failUnlessEqual(tar.extractfile("sub/b.html").read(),
+                                 "<p>b</p>" * 1000)
+        finally:
+            tar.close()
+
+    def test_zip64(self):
+        old_max = _archive._ZIP32_MAX
+        _archive._ZIP32_MAX = 100
+        try:
+            path = self.build("z64.zip", "zip", ["a.js", "sub/b.html", "run"])
+        finally:
+            _archive._ZIP32_MAX = old_max
+        zf = zipfile.ZipFile(path)
+        self.failUnlessEqual(zf.testzip(), None)
+        self.failUnlessEqual(zf.namelist(), ["a.js", "empty/", "run", "sub/",
+                                             "sub/b.html"])
+        self.failUnlessEqual(zf.read("sub/b.html"), "<p>b</p>" * 1000)
+
+    def test_archive_directory(self):
+        path = _archive.archive_directory(self.src, os.path.join(self.tmp, "d.zip"),
+                                          "zip", prefix="app")
+        self.failUnlessEqual(zipfile.ZipFile(path).namelist(),
+                             ["app/", "app/a.js", "app/run", "app/sub/",
+                              "app/sub/b.html"])
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, _archive.ArchiveOutput,
+                          os.path.join(self.tmp, "x.rar"), "rar")
+
+class LinuxAppShellTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(suffix=".appifier")
+        self.build_dir = os.path.join(self.dir, "build")
+        self.code = os.path.join(self.dir, "code")
+        os.makedirs(self.code)
+        xul = os.path.join(self.build_dir, "xulrunner")
+        os.makedirs(os.path.join(xul, "lib"))
+        for name in ("xulrunner-stub", os.path.join("lib", "libxul.so")):
+            f = open(os.path.join(xul, name), 'w')
+            f.write(name)
+            f.close()
+        os.symlink("lib", os.path.join(xul, "libs"))
+        os.environ['CUDDLEFISH_ROOT'], self.root = (
+            self.dir, os.environ.get('CUDDLEFISH_ROOT'))
+        self.appifier = _linux.OSAppifier()
+
+    def tearDown(self):
+        if self.root is None:
+            del os.environ['CUDDLEFISH_ROOT']
+        else:
+            os.environ['CUDDLEFISH_ROOT'] = self.root
+        shutil.rmtree(self.dir)
+
+    def shell(self, **kwargs):
+        return self.appifier.output_app_shell(self.code, dev_mode=False,
+                                              verbose=False, **kwargs)
+
+    def test_symlinked_dirs(self):
+        out = self.shell(hardlink=True)["output_dir"]
+        libs = os.path.join(out, "xulrunner", "libs")
+        self.failUnless(os.path.islink(libs))
+        self.failUnlessEqual(os.readlink(libs), "lib")
+
+    def test_incremental_keeps_app(self):
+        out = self.shell(hardlink=True)["output_dir"]
+        built = os.path.join(out, "application.ini")
+        f = open(built, 'w')
+        f.write("built")
+        f.close()
+        self.shell(hardlink=True, incremental=True)
+        self.failUnless(os.path.isfile(built))
+        self.failUnless(os.path.isfile(os.path.join(out, "xulrunner",
+                                                    "xulrunner-stub")))
+        self.shell(hardlink=True)
+        self.failIf(os.path.exists(built))
+
+class BuildCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, "src")
+        os.makedirs(os.path.join(self.src, ".git"))
+        self.write("a.js", "a")
+        self.write("b.js", "b")
+        self.write(".git/HEAD", "x")
+        self.record = os.path.join(self.tmp, "record.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        f = open(os.path.join(self.src, name), 'w')
+        f.write(data)
+        f.close()
+
+    def digest(self, extra=None):
+        return BuildCache(self.record).digest([self.src], extra)
+
+    def save(self):
+        cache = BuildCache(self.record)
+        digest = cache.digest([self.src])
+        cache.save(digest)
+        return digest
+
+    def test_unchanged_inputs_match(self):
+        digest = self.save()
+        self.failUnless(BuildCache(self.record).matches(self.digest()))
+        # touching a file doesn't change its contents
+        os.utime(os.path.join(self.src, "a.js"), (1, 1))
+        self.failUnlessEqual(self.digest(), digest)
+        # and neither does anything under .git
+        self.write(".git/HEAD", "y")
+        self.failUnlessEqual(self.digest(), digest)
+
+    def test_changes_are_noticed(self):
+        digest = self.save()
+        self.failIfEqual(self.digest(extra={"x": 1}), digest)
+        self.write("a.js", "changed")
+        self.failIfEqual(self.digest(), digest)
+        self.save()
+        self.write("c.js", "new")
+        self.failIf(BuildCache(self.record).matches(self.digest()))
+
+    def test_remembered_hashes_are_used(self):
+        os.utime(os.path.join(self.src, "a.js"), (1, 1))
+        self.save()
+        # files whose size and mtime are as recorded aren't read again
+        self.write("a.js", "A")
+        os.utime(os.path.join(self.src, "a.js"), (1, 1))
+        self.failUnless(BuildCache(self.record).matches(self.digest()))
+
+    def test_invalidate(self):
+        self.save()
+        BuildCache(self.record).invalidate()
+        self.failIf(BuildCache(self.record).matches(self.digest()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import unittest
+import simplejson as json
+from StringIO import StringIO
+
+from cuddlefish import bundle, shake
+
+# a program of two packages, in a temporary directory
+class ProgramTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.resources = {}
+        for pkg, modules in [("internal", { "cuddlefish": "var x;",
+                                            "unload": "exports.send = 1;" }),
+                             ("lib", { "main": "require('util/strings');",
+                                       "util/strings": u"exports.s = '\u2603';" })]:
+            for name, text in modules.items():
+                path = os.path.join(self.tmp, pkg, name + ".js")
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                f = open(path, "wb")
+                f.write(text.encode("utf-8"))
+                f.close()
+            self.resources["guid-" + pkg] = os.path.join(self.tmp, pkg)
+        self.harness_options = {
+            'resources': self.resources,
+            'rootPaths': ["resource://guid-internal/", "resource://guid-lib/"],
+            'loader': "resource://guid-internal/cuddlefish.js"
+            }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+class BundleTests(ProgramTestCase):
+    def build(self):
+        return bundle.build_bundles(self.harness_options, StringIO(),
+                                    cache_path=os.path.join(self.tmp, "cache.json"))
+
+    def test_bundle(self):
+        files = self.build()
+        self.failUnlessEqual(self.harness_options['bundles'],
+                             [["bundles", "modules-0.json"]])
+        modules = json.loads(files[os.path.join("bundles", "modules-0.json")])["modules"]
+        self.failUnlessEqual(sorted(modules.keys()),
+                             ["resource://guid-internal/cuddlefish.js",
+                              "resource://guid-internal/unload.js",
+                              "resource://guid-lib/main.js",
+                              "resource://guid-lib/util/strings.js"])
+        self.failUnlessEqual(modules["resource://guid-lib/util/strings.js"],
+                             u"exports.s = '\u2603';")
+        # a second build (from cache) is identical
+        self.failUnlessEqual(self.build(), files)
+
+    def test_split(self):
+        old = bundle.BUNDLE_SIZE
+        bundle.BUNDLE_SIZE = 20
+        try:
+            files = self.build()
+        finally:
+            bundle.BUNDLE_SIZE = old
+        self.failUnless(len(files) > 1)
+        self.failUnlessEqual(len(files), len(self.harness_options['bundles']))
+        urls = []
+        for path in self.harness_options['bundles']:
+            urls.extend(json.loads(files[os.path.join(*path)])["modules"].keys())
+        self.failUnlessEqual(len(urls), 4)
+        # modules come after those they depend on
+        self.failUnless(urls.index("resource://guid-lib/util/strings.js") <
+                        urls.index("resource://guid-lib/main.js"))
+
+class ShakeTests(ProgramTestCase):
+    def setUp(self):
+        ProgramTestCase.setUp(self)
+        self.harness_options['main'] = "main"
+        self.write("lib", "unused", "require('util/strings');")
+        self.write("lib", "dynamic", "")
+        self.write("lib", "chromeful", "")
+        self.browser = os.path.join(self.tmp, "browser")
+        os.mkdir(self.browser)
+        f = open(os.path.join(self.browser, "index.html"), "w")
+        f.write('<html><script>var c = require("chromeful");</script></html>')
+        f.close()
+
+    def write(self, pkg, name, text):
+        f = open(os.path.join(self.tmp, pkg, name + ".js"), "wb")
+        f.write(text)
+        f.close()
+
+    def shake(self, keep=()):
+        manifest, graph = bundle.build_program_manifest(self.harness_options,
+                                                        StringIO())
+        return shake.shake(manifest, graph, self.harness_options,
+                           self.browser, keep=keep, stderr=StringIO())
+
+    def test_browser_requires(self):
+        self.failUnlessEqual(shake.browser_requires(self.browser),
+                             set(["chromeful"]))
+
+    def test_shake(self):
+        shipped, omit = self.shake()
+        self.failUnlessEqual(sorted(shipped),
+                             ["resource://guid-internal/cuddlefish.js",
+                              "resource://guid-internal/unload.js",
+                              "resource://guid-lib/chromeful.js",
+                              "resource://guid-lib/main.js",
+                              "resource://guid-lib/util/strings.js"])
+        self.failUnlessEqual(omit, { "guid-lib": set(["dynamic.js",
+                                                      "unused.js"]) })
+
+    def test_keep(self):
+        shipped, omit = self.shake(keep=["dynamic", "missing"])
+        self.failUnless("resource://guid-lib/dynamic.js" in shipped)
+        self.failUnlessEqual(omit, { "guid-lib": set(["unused.js"]) })
+
+if __name__ == '__main__':
+    unittest.main()
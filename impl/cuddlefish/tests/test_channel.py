@@ -0,0 +1,135 @@
+import os
+import sys
+import time
+import socket
+import threading
+import unittest
+import simplejson as json
+
+import mozrunner
+from mozrunner import killableprocess
+from cuddlefish.channel import ResultChannel, ControlChannel
+from cuddlefish.runner import wait_for_result
+
+# an app which reports the result given it (if any), then quits
+REPORTER = """
+import sys, json, socket
+host, port, token, status = sys.argv[1:]
+if status:
+    s = socket.create_connection((host, int(port)))
+    s.sendall(json.dumps({'token': token, 'status': status}) + '\\n')
+    s.close()
+"""
+
+class ChannelTests(unittest.TestCase):
+    def setUp(self):
+        self.channel = ResultChannel()
+
+    def tearDown(self):
+        self.channel.close()
+
+    def send(self, *chunks):
+        s = socket.create_connection((self.channel.host, self.channel.port))
+        for chunk in chunks:
+            s.sendall(chunk)
+            time.sleep(0.01)
+        s.close()
+
+    def send_later(self, *chunks):
+        t = threading.Thread(target=self.send, args=chunks)
+        t.start()
+        return t
+
+    def test_timeout(self):
+        started = time.time()
+        self.failUnlessEqual(self.channel.wait(0.1), None)
+        self.failUnless(time.time() - started >= 0.1)
+
+    def test_result(self):
+        message = json.dumps({'token': self.channel.token, 'status': 'FAIL',
+                              'passed': 1, 'failed': 2}) + "\n"
+        t = self.send_later(message[:10], message[10:])
+        self.failUnlessEqual(self.channel.wait(5),
+                             {'status': 'FAIL', 'passed': 1, 'failed': 2})
+        t.join()
+
+    def test_untrusted(self):
+        t = self.send_later('{"status": "OK"}\n', "garbage")
+        self.failUnlessEqual(self.channel.wait(0.5), None)
+        t.join()
+
+    def test_options(self):
+        self.failUnlessEqual(self.channel.options,
+                             {'host': self.channel.host,
+                              'port': self.channel.port,
+                              'token': self.channel.token})
+        self.failIfEqual(self.channel.token, ResultChannel().token)
+
+class ControlChannelTests(unittest.TestCase):
+    def setUp(self):
+        self.channel = ControlChannel()
+        self.sock = socket.create_connection((self.channel.host,
+                                              self.channel.port))
+
+    def tearDown(self):
+        self.sock.close()
+        self.channel.close()
+
+    def message(self, **kwargs):
+        kwargs['token'] = self.channel.token
+        return json.dumps(kwargs) + "\n"
+
+    def test_messages(self):
+        ready = self.message(status='READY')
+        self.sock.sendall('{"status": "OK"}\n' + ready[:5])
+        self.failUnlessEqual(self.channel.receive(0.1), None)
+        self.sock.sendall(ready[5:] + self.message(id=1, status='OK'))
+        self.failUnlessEqual(self.channel.receive(5), {'status': 'READY'})
+        self.failUnlessEqual(self.channel.receive(5),
+                             {'id': 1, 'status': 'OK'})
+        self.failIf(self.channel.closed)
+
+    def test_send(self):
+        self.failUnlessEqual(self.channel.receive(0.1), None)
+        self.channel.send({'quit': True})
+        self.failUnlessEqual(json.loads(self.sock.makefile().readline()),
+                             {'quit': True})
+
+    def test_closed(self):
+        self.sock.close()
+        self.failUnlessEqual(self.channel.receive(5), None)
+        self.failUnless(self.channel.closed)
+        self.failUnlessRaises(IOError, self.channel.send, {'quit': True})
+
+class WaitForResultTests(unittest.TestCase):
+    def setUp(self):
+        self.channel = ResultChannel()
+        self.runner = None
+
+    def tearDown(self):
+        self.channel.close()
+        if self.runner:
+            self.runner.process_handler.wait()
+
+    def start(self, status):
+        self.runner = mozrunner.Runner(binary=sys.executable)
+        self.runner.names = []
+        self.runner.process_handler = killableprocess.Popen(
+            [sys.executable, "-c", REPORTER, self.channel.host,
+             str(self.channel.port), self.channel.token, status],
+            preexec_fn=lambda: os.setpgid(0, 0))
+
+    def test_result(self):
+        self.start("OK")
+        self.failUnlessEqual(wait_for_result(self.channel, self.runner, 30),
+                             {'status': 'OK'})
+
+    def test_exit_without_result(self):
+        self.start("")
+        started = time.time()
+        self.failUnlessRaises(Exception, wait_for_result, self.channel,
+                              self.runner)
+        self.failUnless(time.time() - started < 10)
+
+if __name__ == '__main__':
+    unittest.main()
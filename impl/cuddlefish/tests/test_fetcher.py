@@ -0,0 +1,373 @@
+import os
+import re
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+from StringIO import StringIO
+import simplejson as json
+
+import mozfetcher
+from mozfetcher import _download
+
+PAYLOAD = "".join([chr(i % 251) for i in range(5 * 1024 * 1024 + 17)])
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # set on the server: the payload, whether to honor range requests, and
+    # a log of the ranges that were requested
+    def do_GET(self):
+        data = self.server.payload
+        m = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if m and self.server.ranges:
+            start, end = int(m.group(1)), int(m.group(2))
+            self.server.requested.append((start, end))
+            self.send_response(206)
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.server.requested.append(None)
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(object):
+    def __init__(self, ranges=True, payload=PAYLOAD):
+        self.httpd = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.httpd.payload = payload
+        self.httpd.ranges = ranges
+        self.httpd.requested = []
+        self.url = "http://127.0.0.1:%d/xulrunner.tar.bz2" % self.httpd.server_port
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def requested(self):
+        return self.httpd.requested
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class DownloadTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(suffix=".download")
+        self.path = os.path.join(self.dir, "xulrunner.tar.bz2")
+        self.want = hashlib.md5(PAYLOAD).hexdigest()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def contents(self):
+        f = open(self.path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_segmented(self):
+        self.server = StandInServer()
+        d = _download.Downloader(self.server.url, self.path, segments=4)
+        self.failUnlessEqual(d.probe(), len(PAYLOAD))
+        self.failUnlessEqual(d.run(), self.want)
+        self.failUnlessEqual(self.contents(), PAYLOAD)
+        # a probe, followed by one request per segment
+        self.failUnlessEqual(len(self.server.requested()), 5)
+        self.failIf(os.path.exists(self.path + ".part"))
+        self.failIf(os.path.exists(self.path + ".part.json"))
+
+    def test_no_range_support(self):
+        self.server = StandInServer(ranges=False)
+        progress = []
+        d = _download.Downloader(self.server.url, self.path, segments=4,
+                                 progress=lambda done, size: progress.append(done))
+        self.failUnlessEqual(d.run(), self.want)
+        self.failUnlessEqual(self.contents(), PAYLOAD)
+        self.failUnlessEqual(self.server.requested(), [None, None])
+        self.failUnlessEqual(progress[-1], len(PAYLOAD))
+
+    def test_resume(self):
+        self.server = StandInServer()
+        # leave behind a half finished, two segment download
+        half = len(PAYLOAD) // 2
+        part = PAYLOAD[:1000] + "\0" * (half - 1000) + PAYLOAD[half:half + 10]
+        f = open(self.path + ".part", 'wb')
+        f.write(part)
+        f.truncate(len(PAYLOAD))
+        f.close()
+        f = open(self.path + ".part.json", 'w')
+        f.write(json.dumps({
+            "url": self.server.url,
+            "size": len(PAYLOAD),
+            "segments": [[0, half, 1000], [half, len(PAYLOAD), half + 10]]
+        }))
+        f.close()
+        d = _download.Downloader(self.server.url, self.path, segments=2)
+        self.failUnlessEqual(d.run(), self.want)
+        self.failUnlessEqual(self.contents(), PAYLOAD)
+        self.failUnlessEqual(sorted(self.server.requested()[1:]),
+                             [(1000, half - 1), (half + 10, len(PAYLOAD) - 1)])
+
+    def test_checkpoints_claim_only_synced_data(self):
+        self.server = StandInServer()
+        d = _download.Downloader(self.server.url, self.path, segments=2)
+        # how far each segment had gotten as of the last sync (which
+        # flushes the whole file, whichever segment asked)
+        synced = {}
+        claims = []
+        real_sync = _download._sync
+        def sync(fd):
+            positions = dict([(s.start, s.pos) for s in d._segments])
+            real_sync(fd)
+            for start, pos in positions.items():
+                synced[start] = max(synced.get(start, start), pos)
+        real_checkpoint = d._checkpoint
+        def checkpoint():
+            real_checkpoint()
+            state = json.loads(open(self.path + ".part.json").read())
+            claims.extend([(start, pos, synced.get(start, start))
+                           for start, end, pos in state["segments"]])
+        old_interval = _download.CHECKPOINT_INTERVAL
+        _download.CHECKPOINT_INTERVAL = 0
+        _download._sync = sync
+        d._checkpoint = checkpoint
+        try:
+            self.failUnlessEqual(d.run(), self.want)
+        finally:
+            _download._sync = real_sync
+            _download.CHECKPOINT_INTERVAL = old_interval
+        self.failUnless(claims)
+        for start, pos, synced_pos in claims:
+            self.failUnless(pos <= synced_pos, (start, pos, synced_pos))
+
+class FingerprintTests(unittest.TestCase):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp(suffix=".fetcher")
+        self.fetcher = mozfetcher.Fetcher(self.build_dir)
+        self.path = os.path.join(self.build_dir, "some-binary")
+        f = open(self.path, 'wb')
+        f.write("original contents")
+        f.close()
+        self.hashed = []
+        real_calc_md5 = self.fetcher._calc_md5
+        def counting_calc_md5(path):
+            self.hashed.append(path)
+            return real_calc_md5(path)
+        self.fetcher._calc_md5 = counting_calc_md5
+
+    def tearDown(self):
+        shutil.rmtree(self.build_dir)
+
+    def test_unchanged_file_is_not_rehashed(self):
+        first = self.fetcher._fingerprinted_md5(self.path)
+        second = self.fetcher._fingerprinted_md5(self.path)
+        self.failUnlessEqual(first, second)
+        self.failUnlessEqual(self.hashed, [self.path])
+        # and the record survives into a new Fetcher
+        fetcher = mozfetcher.Fetcher(self.build_dir)
+        fetcher._calc_md5 = self.fetcher._calc_md5
+        self.failUnlessEqual(fetcher._fingerprinted_md5(self.path), first)
+        self.failUnlessEqual(len(self.hashed), 1)
+
+    def test_verify_forces_rehash(self):
+        self.fetcher._fingerprinted_md5(self.path)
+        self.fetcher._fingerprinted_md5(self.path, verify=True)
+        self.failUnlessEqual(len(self.hashed), 2)
+
+    def test_changed_file_is_rehashed(self):
+        first = self.fetcher._fingerprinted_md5(self.path)
+        f = open(self.path, 'ab')
+        f.write(" and then some")
+        f.close()
+        second = self.fetcher._fingerprinted_md5(self.path)
+        self.failIfEqual(first, second)
+        self.failUnlessEqual(len(self.hashed), 2)
+
+    def test_missing_file(self):
+        missing = os.path.join(self.build_dir, "nope")
+        self.failUnlessEqual(self.fetcher._fingerprinted_md5(missing), 'error')
+        self.failUnlessEqual(self.hashed, [])
+
+    def test_corrupt_record_is_ignored(self):
+        f = open(self.fetcher._verifyFile, 'w')
+        f.write("{ not json")
+        f.close()
+        digest = self.fetcher._fingerprinted_md5(self.path)
+        self.failUnlessEqual(digest, self.fetcher._calc_md5(self.path))
+
+class FetchTests(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.build_dir = tempfile.mkdtemp(suffix=".fetcher")
+        self.fetcher = mozfetcher.Fetcher(self.build_dir)
+        self.fetcher._config = {
+            "url": self.server.url,
+            "md5": hashlib.md5(PAYLOAD).hexdigest()
+        }
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.build_dir)
+
+    def test_fetch_records_streamed_digest(self):
+        hashed = []
+        self.fetcher._calc_md5 = lambda path: hashed.append(path)
+        self.fetcher._fetch()
+        self.failUnlessEqual(os.path.getsize(self.fetcher._tarball), len(PAYLOAD))
+        # the tarball was not reread to check it, either after the download
+        # or when we're asked to fetch it again
+        self.fetcher._fetch()
+        self.failUnlessEqual(hashed, [])
+        # a probe, followed by one request per segment, and nothing after that
+        self.failUnlessEqual(len(self.server.requested()), 1 + mozfetcher._fetcher.DOWNLOAD_SEGMENTS)
+
+    def test_fetch_md5_mismatch(self):
+        self.fetcher._config["md5"] = "0" * 32
+        self.assertRaises(RuntimeError, self.fetcher._fetch)
+        self.failIf(os.path.exists(self.fetcher._tarball))
+
+RUNTIME_FILES = (("xulrunner/libxul.so", "not really a library"),
+                 ("xulrunner/include/nsISupports.h", "// a header"),
+                 ("xulrunner/idl/nsISupports.idl", "// an idl file"))
+
+def make_runtime_tarball(binary):
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode="w:bz2")
+    for name, data in (("xulrunner/xulrunner", binary),) + RUNTIME_FILES:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, StringIO(data))
+    tar.close()
+    return buf.getvalue()
+
+def make_runtime_zip(binary):
+    buf = StringIO()
+    z = zipfile.ZipFile(buf, "w")
+    for name, data in (("xulrunner/xulrunner", binary),) + RUNTIME_FILES:
+        z.writestr(name, data)
+    z.close()
+    return buf.getvalue()
+
+class UnpackTests(unittest.TestCase):
+    def setUp(self):
+        self.build_dir = tempfile.mkdtemp(suffix=".unpack")
+        self.fetcher = mozfetcher.Fetcher(self.build_dir)
+        self.fetcher._config = {
+            "bin": {
+                "path": "xulrunner/xulrunner",
+                "sig": hashlib.md5("a xulrunner binary").hexdigest()
+            }
+        }
+        self.fetcher._calc_md5 = lambda path: self.fail("rehashed " + path)
+
+    def tearDown(self):
+        shutil.rmtree(self.build_dir)
+
+    def archive(self, name, data):
+        path = os.path.join(self.build_dir, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def check_unpacked(self):
+        top = os.path.join(self.build_dir, "xulrunner")
+        self.failUnlessEqual(sorted(os.listdir(top)), ["libxul.so", "xulrunner"])
+
+    def test_tarball(self):
+        path = self.archive("xr.tar.bz2", make_runtime_tarball("a xulrunner binary"))
+        digest = self.fetcher._unpack(None, path)
+        self.failUnlessEqual(digest, self.fetcher._config["bin"]["sig"])
+        self.check_unpacked()
+        self.failUnless("extract" in self.fetcher._timings)
+
+    def test_zip(self):
+        path = self.archive("xr.zip", make_runtime_zip("a xulrunner binary"))
+        digest = self.fetcher._unpack(None, path)
+        self.failUnlessEqual(digest, self.fetcher._config["bin"]["sig"])
+        self.check_unpacked()
+
+    def test_signature_mismatch(self):
+        path = self.archive("xr.tar.bz2", make_runtime_tarball("an impostor"))
+        self.assertRaises(RuntimeError, self.fetcher._unpack, None, path)
+
+    def test_members_outside_dest(self):
+        buf = StringIO()
+        z = zipfile.ZipFile(buf, "w")
+        z.writestr("../escaped", "nope")
+        z.close()
+        path = self.archive("evil.zip", buf.getvalue())
+        self.assertRaises(RuntimeError, self.fetcher._unpack, None, path)
+        self.failIf(os.path.exists(os.path.join(self.build_dir, "..", "escaped")))
+
+class SharedCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tarball = make_runtime_tarball("a xulrunner binary")
+        self.server = StandInServer(payload=self.tarball)
+        self.dir = tempfile.mkdtemp(suffix=".shared")
+        self.shared = os.path.join(self.dir, "shared")
+        self.config = {
+            "url": self.server.url,
+            "md5": hashlib.md5(self.tarball).hexdigest(),
+            "bin": {
+                "path": "xulrunner/xulrunner",
+                "sig": hashlib.md5("a xulrunner binary").hexdigest()
+            }
+        }
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def fetcher(self, name):
+        build_dir = os.path.join(self.dir, name)
+        os.mkdir(build_dir)
+        f = mozfetcher.Fetcher(build_dir, sharedCache=self.shared)
+        f._config = self.config
+        f._sharedEntry = os.path.join(self.shared, self.config["md5"])
+        f._cacheDir = f._sharedEntry
+        if not os.path.isdir(f._sharedEntry):
+            os.makedirs(f._sharedEntry)
+        return f
+
+    def test_runtime_is_shared(self):
+        first = self.fetcher("one")
+        second = self.fetcher("two")
+        self.failUnless(first.needs_fetch())
+        first.run(descriptor=None)
+        self.failIf(first.needs_fetch())
+        requests = len(self.server.requested())
+        self.failUnless(second.needs_fetch())
+        second.run(descriptor=None)
+        self.failIf(second.needs_fetch())
+        # the second checkout neither downloaded nor unpacked anything
+        self.failUnlessEqual(len(self.server.requested()), requests)
+        for f in (first, second):
+            top = os.path.join(f._buildDir, "xulrunner")
+            self.failUnless(os.path.islink(top))
+        self.failUnlessEqual(os.path.realpath(first.xulrunner_path()),
+                             os.path.realpath(second.xulrunner_path()))
+
+    def test_corrupt_shared_runtime_is_replaced(self):
+        first = self.fetcher("one")
+        first.run(descriptor=None)
+        f = open(first.xulrunner_path(), 'wb')
+        f.write("tampered with")
+        f.close()
+        second = self.fetcher("two")
+        self.failUnless(second.needs_fetch())
+        second.run(descriptor=None)
+        self.failIf(second.needs_fetch(verify=True))
+        self.failIf(first.needs_fetch(verify=True))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,19 @@
 
 import os
+import shutil
+import tempfile
 import unittest
 from StringIO import StringIO
-from cuddlefish.manifest import scan_module, scan_package
+from cuddlefish import manifest as manifest_module
+from cuddlefish.manifest import scan_module, scan_package, ScanCache, build_manifest
+from cuddlefish.manifest import update_manifest_with_fileinfo
 
 class Require(unittest.TestCase):
     def scan(self, text):
         lines = StringIO(text).readlines()
         requires, chrome, problems = scan_module("fake.js", lines)
         self.failUnlessEqual(problems, False)
-        return requires, chrome
+        return sorted(requires.keys()), chrome
 
     def test_modules(self):
         mod = """var foo = require('one');"""
@@ -49,7 +53,9 @@ class Require(unittest.TestCase):
         self.failUnlessEqual(requires, [])
         self.failUnlessEqual(chrome, False)
 
-        mod = """ * var foo = require('one');"""
+        mod = """/*
+         * var foo = require('one');
+         */"""
         requires, chrome = self.scan(mod)
         self.failUnlessEqual(requires, [])
         self.failUnlessEqual(chrome, False)
@@ -82,7 +88,7 @@ def scan2(text, fn="fake.js"):
     lines = StringIO(text).readlines()
     requires, chrome, problems = scan_module(fn, lines, stderr)
     stderr.seek(0)
-    return requires, chrome, problems, stderr.readlines()
+    return sorted(requires.keys()), chrome, problems, stderr.readlines()
 
 class Chrome(unittest.TestCase):
 
@@ -202,5 +208,216 @@ class Package(unittest.TestCase):
         self.failUnlessEqual(err, [], "".join(err))
         self.failUnlessEqual(has_problems, False)
 
+class Lexer(unittest.TestCase):
+    def test_strings_comments_and_regexps(self):
+        mod = """var s = "require('no')"; // require('no')
+        var r = /\s+require\('no'\)/g, t = 'it\\'s'; /* require('no') */
+        var q = a / b / require('yes');
+        var x = `template require('no')`;
+        if (/[/]require('no')/.test(s)) require("also");"""
+        requires, chrome, problems, err = scan2(mod)
+        self.failUnlessEqual(requires, ["also", "yes"])
+        self.failUnlessEqual(problems, False)
+
+    def test_define(self):
+        mod = """define("name", ["a", 'b',
+                         "c" + "d", e,
+                         "f",], function() {});
+        require(["g"], function(g) {});
+        foo("h", ["i"]);"""
+        requires, chrome, problems, err = scan2(mod)
+        self.failUnlessEqual(requires, ["a", "b", "f", "g"])
+
+    def test_chrome_forms(self):
+        mod = """let {
+            Cc,
+            Ci: ci
+        } = require("chrome");
+        var Cu = require("chrome").Cu;
+        Cc; ci; Cu.import("x");
+        foo.Cr; // not ours"""
+        requires, chrome, problems, err = scan2(mod)
+        self.failUnlessEqual(chrome, True)
+        self.failUnlessEqual(problems, False, err)
+
+        mod = """var x = "Components.classes"; // Components.classes
+        var Components = 1;"""
+        requires, chrome, problems, err = scan2(mod)
+        self.failUnlessEqual(problems, False, err)
+
+class Graph(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.modules = {
+            "app": { "main": "require('util'); require('./ui/view');",
+                     "ui/view": "require('../model'); require('util');",
+                     "model": "require('./ui/view'); require('store');",
+                     "store-e10s-adapter": "" },
+            "util": { "util": "require('store');",
+                      "store": "",
+                      "store-e10s-adapter": "" },
+            "base": { "store": "require('store');" },
+            }
+        self.sections = []
+        for pkg in ["app", "util", "base"]:
+            for name, text in self.modules[pkg].items():
+                path = os.path.join(self.tmp, pkg, name + ".js")
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                f = open(path, "w")
+                f.write(text)
+                f.close()
+            self.sections.append(("", "resource://%s/" % pkg, pkg, "lib",
+                                  os.path.join(self.tmp, pkg)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def graph(self):
+        manifest = {}
+        for section in self.sections:
+            manifest.update(scan_package(*section)[0])
+        return manifest, update_manifest_with_fileinfo(["app", "util", "base"],
+                                                       "base", manifest)
+
+    def test_resolution(self):
+        manifest, graph = self.graph()
+        main = manifest["resource://app/main.js"]
+        self.failUnlessEqual(main.requires["./ui/view"]["url"],
+                             "resource://app/ui/view.js")
+        # absolute requires find the first package providing the module
+        self.failUnlessEqual(manifest["resource://base/store.js"].requires["store"]["url"],
+                             "resource://util/store.js")
+        self.failUnlessEqual(manifest["resource://app/ui/view.js"].requires["../model"]["url"],
+                             "resource://app/model.js")
+        self.failUnlessEqual(manifest["resource://util/store.js"]["e10s-adapter"],
+                             "resource://app/store-e10s-adapter.js")
+
+    def test_graph(self):
+        manifest, graph = self.graph()
+        self.failUnlessEqual(sorted(graph.dependents("resource://util/store.js")),
+                             ["resource://app/model.js", "resource://base/store.js",
+                              "resource://util/util.js"])
+        self.failUnlessEqual(graph.all_dependents("resource://util/util.js"),
+                             set(["resource://app/main.js", "resource://app/model.js",
+                                  "resource://app/ui/view.js"]))
+        self.failUnlessEqual(graph.cycles(), [["resource://app/model.js",
+                                               "resource://app/ui/view.js"]])
+        order = graph.topological_order()
+        self.failUnlessEqual(sorted(order), sorted(manifest.keys()))
+        for url in order:
+            for dep in graph.dependencies(url):
+                if [url] in graph.cycles() or dep in graph.all_dependents(url):
+                    continue
+                self.failUnless(order.index(dep) < order.index(url), (dep, url))
+        self.failUnless(order.index("resource://app/main.js") >
+                        order.index("resource://app/ui/view.js"))
+
+class Cache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.lib = os.path.join(self.tmp, "lib")
+        os.makedirs(os.path.join(self.lib, "sub"))
+        self.write("main.js", "var one = require('one');\n")
+        self.write("sub/two.js", "var {Cc,Ci} = require('chrome');\nCc; Ci;\n")
+        self.write("bad.js", "Components.classes;\n")
+        self.cache_path = os.path.join(self.tmp, "scan-cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, text):
+        f = open(os.path.join(self.lib, name), "w")
+        f.write(text)
+        f.close()
+
+    def scan(self):
+        cache = ScanCache(self.cache_path)
+        stderr = StringIO()
+        manifest, has_problems = scan_package("", "resource://p-lib/", "p",
+                                              "lib", self.lib, stderr, cache)
+        cache.save()
+        return manifest, has_problems, stderr.getvalue(), cache
+
+    def test_warm_scan_matches_cold_scan(self):
+        cold, cold_problems, cold_err, cache = self.scan()
+        self.failUnlessEqual((cache.hits, cache.misses), (0, 3))
+        warm, warm_problems, warm_err, cache = self.scan()
+        self.failUnlessEqual((cache.hits, cache.misses), (3, 0))
+        self.failUnlessEqual(warm, cold)
+        self.failUnlessEqual(warm_problems, True)
+        # problems are reported even when the module isn't rescanned
+        self.failUnlessEqual(warm_err, cold_err)
+        self.failUnless("bad.js" in warm_err, warm_err)
+
+        main = warm["resource://p-lib/main.js"]
+        self.failUnlessEqual(main.requires.keys(), ["one"])
+        two = warm["resource://p-lib/sub/two.js"]
+        self.failUnlessEqual(two.chrome, True)
+        # requirements are fresh each time, since they're later annotated
+        main.requires["one"]["url"] = "x"
+        warm, warm_problems, warm_err, cache = self.scan()
+        self.failUnlessEqual(warm["resource://p-lib/main.js"].requires["one"], {})
+
+    def test_changed_modules_are_rescanned(self):
+        self.scan()
+        self.write("main.js", "var two = require('two'); var x;\n")
+        os.remove(os.path.join(self.lib, "bad.js"))
+        manifest, has_problems, err, cache = self.scan()
+        self.failUnlessEqual((cache.hits, cache.misses), (1, 1))
+        self.failUnlessEqual(manifest["resource://p-lib/main.js"].requires.keys(),
+                             ["two"])
+        self.failUnlessEqual(has_problems, False)
+        # and entries for modules which are gone are dropped
+        self.failUnlessEqual(len(ScanCache(self.cache_path).entries), 2)
+
+class Build(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.sections = []
+        for pkg, deps in [("app", ["util", "helper"]), ("util", ["helper"]),
+                          ("helper", [])]:
+            lib = os.path.join(self.tmp, pkg)
+            os.makedirs(lib)
+            for i in range(20):
+                f = open(os.path.join(lib, "m%d.js" % i), "w")
+                for dep in deps:
+                    f.write("require('%s');\n" % dep)
+                f.write("require('./m%d');\n" % ((i + 1) % 20))
+                f.close()
+            f = open(os.path.join(lib, pkg + ".js"), "w")
+            f.write("exports.x = 1;\n")
+            f.close()
+            self.sections.append(("", "resource://%s-lib/" % pkg, pkg, "lib", lib))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def build(self, processes, cache=None):
+        old = manifest_module.MIN_PARALLEL_SCAN
+        manifest_module.MIN_PARALLEL_SCAN = 0
+        try:
+            return build_manifest(self.sections, "helper", StringIO(),
+                                  cache=cache, processes=processes)
+        finally:
+            manifest_module.MIN_PARALLEL_SCAN = old
+
+    def test_parallel_matches_serial(self):
+        serial, serial_problems = self.build(1)
+        parallel, parallel_problems = self.build(3)
+        self.failUnlessEqual(parallel, serial)
+        self.failUnlessEqual(len(serial), 63)
+        m0 = serial["resource://app-lib/m0.js"]
+        self.failUnlessEqual(m0.requires["util"]["url"], "resource://util-lib/util.js")
+        self.failUnlessEqual(m0.requires["./m1"]["url"], "resource://app-lib/m1.js")
+
+    def test_cache(self):
+        cache = ScanCache(os.path.join(self.tmp, "cache.json"))
+        cold, problems = self.build(2, cache)
+        self.failUnlessEqual((cache.hits, cache.misses), (0, 63))
+        warm, problems = self.build(2, cache)
+        self.failUnlessEqual(cache.hits, 63)
+        self.failUnlessEqual(warm, cold)
+
 if __name__ == '__main__':
     unittest.main()
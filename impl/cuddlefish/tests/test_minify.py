@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+import simplejson as json
+
+from cuddlefish import minify
+
+class MinifyTests(unittest.TestCase):
+    def minify(self, text):
+        return minify.minify_source(text)[0]
+
+    def test_comments(self):
+        self.failUnlessEqual(self.minify("  var a = 1; // one\n"
+                                         "/* two\n three */\n"
+                                         "\n"
+                                         "    a += 2;\n"),
+                             "var a=1;\na+=2;\n")
+
+    def test_lines(self):
+        text = ("// header\n"
+                "\n"
+                "function f(x) {\n"
+                "  /* nothing */\n"
+                "  return x;\n"
+                "}\n")
+        minified, lines = minify.minify_source(text)
+        self.failUnlessEqual(minified, "function f(x){\nreturn x;\n}\n")
+        self.failUnlessEqual(lines, [3, 5, 6])
+
+    def test_multiline_string(self):
+        minified, lines = minify.minify_source("var s = 'a\\\nb';\nf();\n")
+        self.failUnlessEqual(minified, "var s='a\\\nb';\nf();\n")
+        self.failUnlessEqual(lines, [1, 2, 3])
+
+    def test_spacing(self):
+        self.failUnlessEqual(self.minify("a + +b"), "a+ +b\n")
+        self.failUnlessEqual(self.minify("a - -b"), "a- -b\n")
+        self.failUnlessEqual(self.minify("i++ ;"), "i++;\n")
+        self.failUnlessEqual(self.minify("typeof x"), "typeof x\n")
+        self.failUnlessEqual(self.minify("1 .toString()"), "1 .toString()\n")
+        self.failUnlessEqual(self.minify("a / /b/.x"), "a/ /b/.x\n")
+
+    def test_preserved(self):
+        self.failUnlessEqual(self.minify('x = "a  // b";'), 'x="a  // b";\n')
+        self.failUnlessEqual(self.minify("x = / a  b /g;"), "x=/ a  b /g;\n")
+
+    def test_empty(self):
+        self.failUnlessEqual(minify.minify_source("// nothing\n"), ("", []))
+
+    def test_source_map(self):
+        self.failUnlessEqual(minify._vlq(0), "A")
+        self.failUnlessEqual(minify._vlq(-1), "D")
+        self.failUnlessEqual(minify._vlq(16), "gB")
+        m = json.loads(minify.source_map("a.js", "file:///a.js", [3, 5, 4]))
+        self.failUnlessEqual(m["version"], 3)
+        self.failUnlessEqual(m["sources"], ["file:///a.js"])
+        self.failUnlessEqual(m["mappings"], "AAEA;AAEA;AADA")
+
+    def test_minify_dirs(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            src = os.path.join(tmp, "src")
+            os.makedirs(os.path.join(src, "sub"))
+            for name in ["a.js", os.path.join("sub", "b.js"), "c.test.js",
+                         "d.js"]:
+                f = open(os.path.join(src, name), "w")
+                f.write("// comment\nvar x = 1;\n")
+                f.close()
+            maps = os.path.join(tmp, "maps")
+            contents = minify.minify_dirs({ "lib": (src, set(["d.js"])) },
+                                          maps)
+            self.failUnlessEqual(sorted(contents.keys()),
+                                 [os.path.join(src, "a.js"),
+                                  os.path.join(src, "sub", "b.js")])
+            self.failUnlessEqual(contents[os.path.join(src, "a.js")],
+                                 "var x=1;\n")
+            self.failUnless(os.path.exists(os.path.join(maps, "lib", "sub",
+                                                        "b.js.map")))
+            # the same, from a pool of processes
+            old = minify.MIN_PARALLEL_MINIFY
+            minify.MIN_PARALLEL_MINIFY = 1
+            try:
+                self.failUnlessEqual(minify.minify_dirs(
+                        { "lib": (src, set(["d.js"])) }, maps, processes=2),
+                                     contents)
+            finally:
+                minify.MIN_PARALLEL_MINIFY = old
+        finally:
+            shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    unittest.main()
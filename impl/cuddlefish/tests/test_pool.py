@@ -0,0 +1,147 @@
+import os
+import sys
+import threading
+import subprocess
+import unittest
+import simplejson as json
+
+from cuddlefish.pool import RuntimePool
+
+# a stand-in for a runtime serving jobs as the harness does
+FAKE_RUNTIME = """
+import os, sys, json, socket
+control = json.loads(os.environ['HARNESS_OPTIONS'])['controlChannel']
+s = socket.create_connection((control['host'], control['port']))
+def send(message):
+    message['token'] = control['token']
+    s.sendall(json.dumps(message) + '\\n')
+send({'status': 'READY'})
+for line in s.makefile():
+    job = json.loads(line)
+    if job.get('quit'):
+        break
+    options = job['options']
+    if options.get('crash'):
+        os._exit(1)
+    sys.stdout.write('%d ran %s' % (os.getpid(), options['name']))
+    sys.stdout.write('\\n%s %d\\n' % (control['token'], job['id']))
+    sys.stdout.flush()
+    send({'id': job['id'], 'status': options.get('status', 'OK'),
+          'passed': 1, 'failed': 0})
+"""
+
+class FakeRunner(object):
+    def __init__(self, process_handler):
+        self.process_handler = process_handler
+
+    def wait(self, timeout=None):
+        self.process_handler.wait()
+
+    def stop(self):
+        if self.process_handler.poll() is None:
+            self.process_handler.kill()
+        self.process_handler.wait()
+
+def start_fake(control_options, popen_kwargs):
+    env = dict(os.environ)
+    env['HARNESS_OPTIONS'] = json.dumps({'controlChannel': control_options})
+    popen = subprocess.Popen([sys.executable, "-c", FAKE_RUNTIME], env=env,
+                             **popen_kwargs)
+    return FakeRunner(popen), None
+
+class PoolTests(unittest.TestCase):
+    def setUp(self):
+        self.pools = []
+
+    def tearDown(self):
+        for pool in self.pools:
+            pool.close()
+
+    def make_pool(self, **kwargs):
+        pool = RuntimePool(start_fake, **kwargs)
+        self.pools.append(pool)
+        return pool
+
+    def run_job(self, pool, name, **options):
+        options['name'] = name
+        result, output = pool.run(options, timeout=10)
+        pid = None
+        if output:
+            pid, ran, ran_name = output.split()
+            self.failUnlessEqual(ran_name, name)
+        return result, pid
+
+    def test_reuses_runtimes(self):
+        pool = self.make_pool()
+        results = [self.run_job(pool, name) for name in "abc"]
+        for result, pid in results:
+            self.failUnlessEqual(result,
+                                 {'status': 'OK', 'passed': 1, 'failed': 0})
+        self.failUnlessEqual(len(set([pid for result, pid in results])), 1)
+        self.failUnlessEqual(pool.started, 1)
+
+    def test_recycles_after_max_runs(self):
+        pool = self.make_pool(max_runs=2)
+        pids = [self.run_job(pool, name)[1] for name in "abc"]
+        self.failUnlessEqual(pids[0], pids[1])
+        self.failIfEqual(pids[1], pids[2])
+        self.failUnlessEqual(pool.started, 2)
+
+    def test_recycles_on_failure(self):
+        pool = self.make_pool()
+        result, first = self.run_job(pool, "a", status="FAIL")
+        self.failUnlessEqual(result['status'], "FAIL")
+        result, second = self.run_job(pool, "b")
+        self.failUnlessEqual(result['status'], "OK")
+        self.failIfEqual(first, second)
+
+    def test_runtime_dies(self):
+        pool = self.make_pool()
+        result, pid = self.run_job(pool, "a", crash=True)
+        self.failUnlessEqual(result, None)
+        result, pid = self.run_job(pool, "b")
+        self.failUnlessEqual(result['status'], "OK")
+        self.failUnlessEqual(pool.started, 2)
+
+    def test_concurrent_jobs(self):
+        pool = self.make_pool(size=2)
+        results = {}
+        def run(name):
+            results[name] = self.run_job(pool, name)
+        threads = [threading.Thread(target=run, args=(name,))
+                   for name in "abcdef"]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.failUnlessEqual(sorted(results.keys()), list("abcdef"))
+        for result, pid in results.values():
+            self.failUnlessEqual(result['status'], "OK")
+        self.failUnlessEqual(len(set([pid for r, pid in results.values()])),
+                             2)
+
+    def test_failed_restart(self):
+        calls = []
+        def start(control_options, popen_kwargs):
+            calls.append(None)
+            if len(calls) > 1:
+                raise OSError("no runtime")
+            return start_fake(control_options, popen_kwargs)
+        pool = RuntimePool(start)
+        self.pools.append(pool)
+        result, pid = self.run_job(pool, "a", status="FAIL")
+        self.failUnlessEqual(result['status'], "FAIL")
+        # the runtime couldn't be replaced, so later jobs fail at once
+        for name in "bc":
+            result, output = pool.run({'name': name}, timeout=10)
+            self.failUnlessEqual(result, None)
+            self.failUnless("no runtime" in output, output)
+        self.failUnlessEqual(len(calls), 2)
+
+    def test_closed(self):
+        pool = self.make_pool()
+        pool.close()
+        self.failUnlessRaises(ValueError, pool.run, {'name': 'a'})
+
+if __name__ == '__main__':
+    unittest.main()
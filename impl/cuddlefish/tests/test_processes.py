@@ -0,0 +1,185 @@
+import os
+import sys
+import time
+import select
+import signal
+import subprocess
+import unittest
+
+import mozrunner
+from mozrunner import killableprocess
+
+# a process which starts a child of its own, then waits
+PARENT = ("import subprocess, sys, time; "
+          "subprocess.Popen([sys.executable, '-c', "
+          "'import time; time.sleep(60)', 'child-' + sys.argv[1]]); "
+          "time.sleep(60)")
+
+class ProcessIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.marker = "test-processes-%d-%s" % (os.getpid(),
+                                                self._testMethodName)
+        self.popen = None
+        self.child = None
+
+    def tearDown(self):
+        if self.popen:
+            try:
+                os.killpg(self.popen.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.popen.wait()
+        if self.child:
+            mozrunner.wait_pids([self.child], 5)
+
+    def start(self):
+        self.popen = subprocess.Popen([sys.executable, "-c",
+                                       PARENT, self.marker],
+                                      preexec_fn=lambda: os.setpgid(0, 0))
+        # wait for the child to start
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            children = mozrunner.get_pids("child-" + self.marker)
+            if children:
+                self.child = children[0]
+                return self.child
+            time.sleep(0.01)
+        self.fail("the child process didn't start")
+
+    def test_find(self):
+        index = mozrunner.ProcessIndex()
+        self.failUnless(os.getppid() in index.processes)
+        # this process is left out
+        self.failIf(os.getpid() in index.find(sys.executable))
+        child = self.start()
+        self.failUnlessEqual(mozrunner.get_pids(self.marker),
+                             sorted([self.popen.pid, child]))
+        self.failUnlessEqual(mozrunner.get_pids(self.marker, child), [])
+
+    def test_descendants(self):
+        child = self.start()
+        index = mozrunner.ProcessIndex()
+        self.failUnlessEqual(index.processes[child][0], self.popen.pid)
+        self.failUnlessEqual(index.descendants(self.popen.pid), set([child]))
+
+    def test_kill_and_wait(self):
+        child = self.start()
+        self.failUnlessEqual(mozrunner.wait_pids([child], 0.05),
+                             set([child]))
+        mozrunner.kill_pids([child])
+        started = time.time()
+        self.failUnlessEqual(mozrunner.wait_pids([child], 10), set())
+        self.failUnless(time.time() - started < 5)
+        self.failIf(mozrunner.pid_alive(child))
+
+    def test_kill_process_by_name(self):
+        self.start()
+        mozrunner.kill_process_by_name(self.marker)
+        self.popen.wait()
+        self.failUnlessEqual(mozrunner.get_pids(self.marker), [])
+
+class RunnerTests(unittest.TestCase):
+    def make_runner(self, process_handler):
+        runner = mozrunner.Runner(binary=sys.executable)
+        runner.names = ["app"]
+        runner.process_handler = process_handler
+        return runner
+
+    def test_related_pids(self):
+        class Handler(object):
+            pid = 100
+        index = mozrunner.ProcessIndex.__new__(mozrunner.ProcessIndex)
+        index.processes = {
+            100: (1, 100, "app"),
+            # restarted, and adopted by a subreaper
+            101: (50, 100, "app -restarted"),
+            102: (101, 100, "plugin"),
+            # another runner's restarted browser
+            200: (1, 200, "app -restarted"),
+            201: (200, 200, "plugin"),
+            }
+        runner = self.make_runner(Handler())
+        self.failUnlessEqual(runner.related_pids(index), set([101, 102]))
+
+    def test_wait_deadline(self):
+        # the browser exits, leaving a child behind in its group
+        code = ("import subprocess, sys, time; "
+                "subprocess.Popen([sys.executable, '-c', "
+                "'import time; time.sleep(60)']); time.sleep(0.6)")
+        popen = killableprocess.Popen([sys.executable, "-c", code],
+                                      preexec_fn=lambda: os.setpgid(0, 0))
+        try:
+            runner = self.make_runner(popen)
+            started = time.time()
+            runner.wait(1)
+            self.failUnless(time.time() - started < 1.4)
+            self.failUnlessEqual(mozrunner.wait_pids(
+                    runner.related_pids(), 5), set())
+        finally:
+            try:
+                os.killpg(popen.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+class WaitTests(unittest.TestCase):
+    def setUp(self):
+        self.processes = []
+
+    def tearDown(self):
+        for process in self.processes:
+            if process.returncode is None:
+                process.kill()
+                process.wait()
+
+    def start(self, code):
+        process = killableprocess.Popen([sys.executable, "-c", code],
+                                        preexec_fn=lambda: os.setpgid(0, 0))
+        self.processes.append(process)
+        return process
+
+    def test_returncode(self):
+        process = self.start("import sys; sys.exit(3)")
+        self.failUnlessEqual(process.wait(), 3)
+        self.failUnlessEqual(process.wait(), 3)
+        self.failIf(process.kill_called)
+
+    def test_timeout(self):
+        process = self.start("import time; time.sleep(60)")
+        started = killableprocess.monotonic()
+        self.failUnlessEqual(process.wait(timeout=0.2), -9)
+        elapsed = killableprocess.monotonic() - started
+        self.failUnless(0.2 <= elapsed < 5, elapsed)
+        self.failUnless(process.kill_called)
+        self.failIf(mozrunner.pid_alive(process.pid))
+
+    def test_exit_fd(self):
+        process = self.start("import time; time.sleep(0.1)")
+        fd = process.exit_fd()
+        if fd is None:
+            # no pidfds here
+            return
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        self.failUnlessEqual(len(poller.poll(10000)), 1)
+        self.failUnlessEqual(process.wait(), 0)
+        self.failUnlessEqual(process.exit_fd(), None)
+
+    def test_wait_any(self):
+        slow = self.start("import time; time.sleep(60)")
+        fast = self.start("import time; time.sleep(0.1)")
+        self.failUnlessEqual(killableprocess.wait_any([slow, fast], 10),
+                             [fast])
+        self.failUnlessEqual(fast.returncode, 0)
+        self.failUnlessEqual(slow.returncode, None)
+        self.failUnlessEqual(killableprocess.wait_any([slow], 0.05), [])
+
+    def test_wait_async(self):
+        process = self.start("import sys; sys.exit(2)")
+        done = []
+        thread = process.wait_async(done.append)
+        thread.join(10)
+        self.failUnlessEqual(done, [process])
+        self.failUnlessEqual(process.returncode, 2)
+
+if __name__ == '__main__':
+    unittest.main()
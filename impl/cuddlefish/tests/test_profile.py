@@ -0,0 +1,304 @@
+from __future__ import with_statement
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+import mozrunner
+
+def write(path, contents):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(contents)
+
+def read(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+class ProfileTemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.cache = tempfile.mkdtemp(prefix="profile-cache-")
+        self.profiles = []
+
+    def tearDown(self):
+        for profile in self.profiles:
+            profile.cleanup()
+        shutil.rmtree(self.cache)
+
+    def make_profile(self, **preferences):
+        profile = mozrunner.Profile(preferences=preferences,
+                                    template_cache=self.cache)
+        self.profiles.append(profile)
+        return profile
+
+    def run_app(self, profile):
+        # what an app leaves in a profile it's run with
+        write(os.path.join(profile.profile, "prefs.js"), "prefs")
+        write(os.path.join(profile.profile, "compreg.dat"), "components")
+        write(os.path.join(profile.profile, "cookies.sqlite"), "cookies")
+        write(os.path.join(profile.profile, "cookies.sqlite-journal"), "")
+        write(os.path.join(profile.profile, ".parentlock"), "")
+        write(os.path.join(profile.profile, "Cache", "0"), "cached")
+
+    def test_no_template(self):
+        profile = mozrunner.Profile(preferences={'a': 1})
+        self.profiles.append(profile)
+        self.failUnlessEqual(profile.template, None)
+        self.failUnlessEqual(os.listdir(profile.profile), ['user.js'])
+        self.failIf(profile.save_template())
+
+    def test_save_and_clone(self):
+        first = self.make_profile(a=1)
+        self.failUnlessEqual(os.listdir(first.profile), ['user.js'])
+        self.run_app(first)
+        self.failUnless(first.save_template())
+        self.failIf(os.path.exists(first.profile))
+        self.failUnlessEqual(sorted(os.listdir(first.template)),
+                             ['compreg.dat', 'prefs.js'])
+
+        second = self.make_profile(a=1)
+        self.failUnlessEqual(second.template, first.template)
+        self.failUnlessEqual(sorted(os.listdir(second.profile)),
+                             ['compreg.dat', 'prefs.js', 'user.js'])
+        self.failUnless('user_pref("a", 1);' in
+                        read(os.path.join(second.profile, 'user.js')))
+
+        # clones are copies, not links
+        write(os.path.join(second.profile, "prefs.js"), "changed")
+        self.failUnlessEqual(read(os.path.join(first.template, "prefs.js")),
+                             "prefs")
+
+        # there's a template already
+        self.run_app(second)
+        self.failIf(second.save_template())
+        second.cleanup()
+        self.failIf(os.path.exists(second.profile))
+
+    def test_template_per_preferences(self):
+        first = self.make_profile(a=1)
+        self.run_app(first)
+        first.save_template()
+        other = self.make_profile(a=2)
+        self.failIfEqual(other.template, first.template)
+        self.failUnlessEqual(os.listdir(other.profile), ['user.js'])
+
+    def test_addons_left_out(self):
+        addon = os.path.join(self.cache, "addon")
+        write(os.path.join(addon, "install.rdf"),
+              INSTALL_RDF % ("a@tests", "false"))
+        first = mozrunner.FirefoxProfile(addons=[addon],
+                                         template_cache=self.cache)
+        self.profiles.append(first)
+        installed = os.path.join(first.profile, "extensions", "a@tests")
+        self.failUnless(os.path.isdir(installed))
+        self.run_app(first)
+        # the extension manager's records, which point into this profile
+        for name in ("extensions.ini", "extensions.rdf", "extensions.cache",
+                     "extensions.sqlite", "extensions.sqlite-journal"):
+            write(os.path.join(first.profile, name), installed)
+        self.failUnless(first.save_template())
+        self.failUnlessEqual(sorted(os.listdir(first.template)),
+                             ['compreg.dat', 'prefs.js'])
+
+        second = mozrunner.FirefoxProfile(addons=[addon],
+                                          template_cache=self.cache)
+        self.profiles.append(second)
+        self.failUnlessEqual(second.template, first.template)
+        self.failUnlessEqual(sorted(os.listdir(second.profile)),
+                             ['compreg.dat', 'extensions', 'prefs.js',
+                              'user.js'])
+        self.failUnless(os.path.isfile(os.path.join(
+                    second.profile, "extensions", "a@tests", "install.rdf")))
+
+    def test_template_per_binary(self):
+        binary = os.path.join(self.cache, "bin", "app")
+        write(binary, "one")
+        first = mozrunner.Profile(binary=binary, template_cache=self.cache)
+        self.profiles.append(first)
+        write(binary, "version two")
+        second = mozrunner.Profile(binary=binary, template_cache=self.cache)
+        self.profiles.append(second)
+        self.failIfEqual(first.template, second.template)
+        other = mozrunner.Profile(template_cache=self.cache)
+        self.profiles.append(other)
+        self.failIfEqual(first.template, other.template)
+
+    def test_clone_file(self):
+        src = os.path.join(self.cache, "src")
+        dst = os.path.join(self.cache, "dst")
+        write(src, "contents" * 1000)
+        os.utime(src, (1000000000, 1000000000))
+        mozrunner.clone_file(src, dst)
+        self.failUnlessEqual(read(dst), "contents" * 1000)
+        self.failUnlessEqual(int(os.stat(dst).st_mtime), 1000000000)
+
+INSTALL_RDF = """<?xml version="1.0"?>
+<RDF xmlns="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+     xmlns:em="http://www.mozilla.org/2004/em-rdf#">
+  <Description about="urn:mozilla:install-manifest">
+    <em:id>%s</em:id>
+    <em:unpack>%s</em:unpack>
+    <em:targetApplication>
+      <Description>
+        <em:id>{ec8030f7-c20a-464f-9b0e-13a3a9e97384}</em:id>
+      </Description>
+    </em:targetApplication>
+  </Description>
+</RDF>
+"""
+
+class AddonTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="addons-")
+        self.profile = mozrunner.Profile()
+
+    def tearDown(self):
+        self.profile.cleanup()
+        shutil.rmtree(self.tmpdir)
+
+    def make_xpi(self, addon_id, unpack="false", members=()):
+        path = os.path.join(self.tmpdir, addon_id + ".xpi")
+        xpi = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED)
+        xpi.writestr("install.rdf", INSTALL_RDF % (addon_id, unpack))
+        xpi.writestr("content/", "")
+        xpi.writestr("content/main.js", "var x = 1;\n" * 1000)
+        for name in members:
+            xpi.writestr(name, "")
+        xpi.close()
+        return path
+
+    def extensions(self):
+        return os.path.join(self.profile.profile, "extensions")
+
+    def test_xpi(self):
+        self.profile.install_addon(self.make_xpi("a@tests"))
+        installed = os.path.join(self.extensions(), "a@tests")
+        self.failUnlessEqual(read(os.path.join(installed, "content",
+                                               "main.js")),
+                             "var x = 1;\n" * 1000)
+        self.failUnless(os.path.isfile(os.path.join(installed,
+                                                    "install.rdf")))
+        self.failUnlessEqual(self.profile.addons_installed, [installed])
+        self.profile.clean_addons()
+        self.failIf(os.path.exists(installed))
+
+    def test_packed_xpi(self):
+        self.profile.packed_addons = True
+        self.profile.install_addon(self.make_xpi("a@tests"))
+        self.profile.install_addon(self.make_xpi("b@tests", unpack="true"))
+        self.failUnlessEqual(sorted(os.listdir(self.extensions())),
+                             ["a@tests.xpi", "b@tests"])
+        self.profile.clean_addons()
+        self.failUnlessEqual(os.listdir(self.extensions()), [])
+
+    def test_directory(self):
+        addon = os.path.join(self.tmpdir, "addon")
+        write(os.path.join(addon, "install.rdf"),
+              INSTALL_RDF % ("c@tests", "false"))
+        write(os.path.join(addon, "main.js"), "")
+        self.profile.install_addon(addon)
+        self.failUnlessEqual(
+            sorted(os.listdir(os.path.join(self.extensions(), "c@tests"))),
+            ["install.rdf", "main.js"])
+
+    def test_unsafe_member(self):
+        xpi = self.make_xpi("d@tests", members=["../../escaped"])
+        self.failUnlessRaises(ValueError, self.profile.install_addon, xpi)
+        self.failIf(os.path.exists(os.path.join(self.profile.profile,
+                                                "escaped")))
+
+class PrefsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="prefs-")
+        self.path = os.path.join(self.tmpdir, "user.js")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parse(self):
+        write(self.path, '# comment\n'
+                         'user_pref("a", true);\n'
+                         'user_pref("b.c", "x, \\"y\\"");\n'
+                         'user_pref("d", 3);\n'
+                         'user_pref("a", false);\n'
+                         'user_pref("e", odd);\n')
+        prefs = mozrunner.PrefsFile(self.path)
+        self.failUnlessEqual(prefs.prefs, {"a": False, "b.c": 'x, "y"',
+                                           "d": 3, "e": "odd"})
+        self.failUnlessEqual(prefs.serialize(),
+                             '# comment\n'
+                             'user_pref("a", false);\n'
+                             'user_pref("b.c", "x, \\"y\\"");\n'
+                             'user_pref("d", 3);\n'
+                             'user_pref("e", odd);\n')
+
+    def test_blank_lines_and_comments(self):
+        write(self.path, '// mine\n'
+                         '\n'
+                         'user_pref("a", 1); // why a is 1\n'
+                         'user_pref("b", "x); // y");\n'
+                         '\n')
+        prefs = mozrunner.PrefsFile(self.path)
+        self.failUnlessEqual(prefs.prefs, {"a": 1, "b": "x); // y"})
+        self.failIf(prefs.write())
+        prefs["a"] = 2
+        prefs.write()
+        self.failUnlessEqual(read(self.path),
+                             '// mine\n'
+                             '\n'
+                             'user_pref("a", 2); // why a is 1\n'
+                             'user_pref("b", "x); // y");\n'
+                             '\n')
+
+    def test_write_when_changed(self):
+        prefs = mozrunner.PrefsFile(self.path)
+        prefs.update({"a": 1, "b": "two"})
+        self.failUnless(prefs.write())
+        self.failUnlessEqual(read(self.path),
+                             'user_pref("a", 1);\nuser_pref("b", "two");\n')
+        prefs = mozrunner.PrefsFile(self.path)
+        prefs.update({"b": "two"})
+        self.failIf(prefs.write())
+        prefs["a"] = 2
+        del prefs["b"]
+        self.failUnless(prefs.write())
+        self.failUnlessEqual(read(self.path), 'user_pref("a", 2);\n')
+        self.failUnlessEqual(os.listdir(self.tmpdir), ["user.js"])
+
+    def test_old_markers(self):
+        write(self.path, 'user_pref("a", 1);\n'
+                         '\n#MozRunner Prefs Start\n'
+                         'user_pref("b", 2);\n'
+                         '#MozRunner Prefs End\n'
+                         '\n#MozRunner Prefs Start\n'
+                         'user_pref("b", 3);\n'
+                         '#MozRunner Prefs End\n')
+        prefs = mozrunner.PrefsFile(self.path)
+        self.failUnlessEqual(prefs.serialize(),
+                             'user_pref("a", 1);\nuser_pref("b", 3);\n')
+
+    def test_json(self):
+        json_path = os.path.join(self.tmpdir, "prefs.json")
+        write(json_path, '{"a": true, "b": "c"}')
+        prefs = mozrunner.PrefsFile(self.path)
+        prefs.load_json(json_path)
+        self.failUnlessEqual(prefs.prefs, {"a": True, "b": "c"})
+        write(json_path, '[1]')
+        self.failUnlessRaises(ValueError, prefs.load_json, json_path)
+
+    def test_reused_profile(self):
+        write(self.path, '# mine\nuser_pref("a", 1);\n')
+        for i in range(3):
+            profile = mozrunner.Profile(profile=self.tmpdir,
+                                        preferences={"a": 2, "b": 3})
+            self.failUnlessEqual(read(self.path),
+                                 '# mine\nuser_pref("a", 2);\n'
+                                 'user_pref("b", 3);\n')
+            profile.cleanup()
+            self.failUnlessEqual(read(self.path),
+                                 '# mine\nuser_pref("a", 1);\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from xml.dom import minidom
+import simplejson as json
+
+from cuddlefish import testex
+
+class TestexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for name in ["b", "a", "untested"]:
+            os.makedirs(os.path.join(self.tmp, name))
+            if name != "untested":
+                f = open(os.path.join(self.tmp, name, "test-app.js"), "w")
+                f.write("exports.test = 1;\n")
+                f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_find_examples(self):
+        self.failUnlessEqual(testex.find_examples(self.tmp),
+                             [("a", os.path.join(self.tmp, "a", "test-app.js")),
+                              ("b", os.path.join(self.tmp, "b", "test-app.js"))])
+
+    def test_write_test_app(self):
+        out = os.path.join(self.tmp, "out")
+        os.mkdir(out)
+        testex.write_test_app("/root", "a",
+                              os.path.join(self.tmp, "a", "test-app.js"), out)
+        lines = open(os.path.join(out, "test-app.js")).read().split("\n")
+        self.failUnless(lines[0].startswith("var options = "))
+        options = json.loads(lines[0][len("var options = "):-1])
+        self.failUnlessEqual(options["staticArgs"]["browser"],
+                             os.path.join(".", "tests", "a", "index.html"))
+        self.failUnlessEqual(lines[1], "exports.test = 1;")
+
+    def test_run_examples(self):
+        ran = []
+        work_dirs = set()
+        def run_example(env_root, examples_dir, dirname, test_script,
+                        work_dir, defaults):
+            ran.append(threading.currentThread())
+            work_dirs.add(work_dir)
+            return { "name": dirname, "status": "passed", "returncode": 0,
+                     "time": 0.5, "output": u"" }
+        old = testex.run_example
+        testex.run_example = run_example
+        try:
+            seen = []
+            results = testex.run_examples(self.tmp, self.tmp, {}, jobs=2,
+                                          on_result=seen.append)
+        finally:
+            testex.run_example = old
+        self.failUnlessEqual([r["name"] for r in results], ["a", "b"])
+        self.failUnlessEqual(len(seen), 2)
+        self.failUnlessEqual(len(work_dirs), 2)
+        for work_dir in work_dirs:
+            self.failIf(os.path.exists(work_dir))
+
+    def test_run_examples_errors(self):
+        def run_example(env_root, examples_dir, dirname, test_script,
+                        work_dir, defaults):
+            raise OSError("can't run %s" % dirname)
+        old = testex.run_example
+        testex.run_example = run_example
+        try:
+            results = testex.run_examples(self.tmp, self.tmp, {}, jobs=1)
+        finally:
+            testex.run_example = old
+        self.failUnlessEqual([(r["name"], r["status"]) for r in results],
+                             [("a", "failed"), ("b", "failed")])
+        self.failUnless("can't run b" in results[1]["output"])
+
+    def test_reports(self):
+        results = [{ "name": "a", "status": "passed", "returncode": 0,
+                     "time": 1.25, "output": u"ok\n", "passed": 3,
+                     "failed": 0 },
+                   { "name": "b", "status": "failed", "returncode": 255,
+                     "time": 2.0, "output": u"<bad> \x1b[0m\u2603\n" }]
+        path = os.path.join(self.tmp, "report.xml")
+        testex.write_report(results, path)
+        suite = minidom.parse(path).documentElement
+        self.failUnlessEqual(suite.getAttribute("tests"), "2")
+        self.failUnlessEqual(suite.getAttribute("failures"), "1")
+        cases = suite.getElementsByTagName("testcase")
+        self.failUnlessEqual([c.getAttribute("name") for c in cases],
+                             ["a", "b"])
+        self.failUnlessEqual(len(cases[1].getElementsByTagName("failure")), 1)
+
+        path = os.path.join(self.tmp, "report.json")
+        testex.write_report(results, path)
+        self.failUnlessEqual(json.load(open(path))["tests"], results)
+
+if __name__ == '__main__':
+    unittest.main()
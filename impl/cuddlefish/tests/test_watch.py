@@ -0,0 +1,63 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cuddlefish import watch
+
+class WatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "result")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_later(self, contents, delay=0.1):
+        def write():
+            time.sleep(delay)
+            f = open(self.path, "w")
+            f.write(contents)
+            f.close()
+        t = threading.Thread(target=write)
+        t.start()
+        return t
+
+    def check_watcher(self, watcher):
+        try:
+            self.failIf(watcher.wait(0.05))
+            # other files changing don't count
+            f = open(os.path.join(self.tmp, "other"), "w")
+            f.write("x")
+            f.close()
+            t = self.write_later("OK")
+            started = time.time()
+            self.failUnless(watcher.wait(5))
+            self.failUnless(time.time() - started < 2)
+            t.join()
+            self.failUnlessEqual(open(self.path).read(), "OK")
+        finally:
+            watcher.close()
+
+    def test_polling(self):
+        self.check_watcher(watch.PollingWatcher([self.path]))
+
+    def test_tail(self):
+        tail = watch.FileTail(self.path)
+        try:
+            self.failUnlessEqual(tail.read(), None)
+            f = open(self.path, "w")
+            f.write("one\n")
+            f.flush()
+            self.failUnlessEqual(tail.read(), "one\n")
+            self.failUnlessEqual(tail.read(), None)
+            f.write("two\n")
+            f.close()
+            self.failUnlessEqual(tail.read(), "two\n")
+        finally:
+            tail.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import time
+
+class FileTail(object):
+    """
+    Keeps a file open, and reads whatever has been appended to it
+    since it was last read.  The file needn't exist yet.
+
+    For example:
+
+      >>> f = open('temp.txt', 'w')
+      >>> f.write('hello')
+      >>> f.flush()
+      >>> tail = FileTail('temp.txt')
+      >>> tail.read()
+      'hello'
+      >>> tail.read() is None
+      True
+      >>> f.write('there')
+      >>> f.flush()
+      >>> tail.read()
+      'there'
+      >>> f.close()
+      >>> tail.close()
+      >>> os.remove('temp.txt')
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = None
+
+    def read(self):
+        """
+        Returns the content appended to the file since the last read,
+        or None if there's none.
+        """
+
+        if self._file is None:
+            try:
+                self._file = open(self.filename, 'r')
+            except IOError:
+                return None
+        newstuff = self._file.read()
+        if not newstuff:
+            # clear eof, so that the next read picks up new content
+            self._file.seek(0, 1)
+            return None
+        return newstuff
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class PollingWatcher(object):
+    """
+    Watches files for changes by polling their size and modification
+    time.  Polling starts out frequent, and backs off while nothing
+    changes.
+    """
+
+    MIN_INTERVAL = 0.01
+    MAX_INTERVAL = 0.5
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self._interval = self.MIN_INTERVAL
+        self._stats = self._stat()
+
+    def _stat(self):
+        stats = []
+        for path in self.paths:
+            try:
+                st = os.stat(path)
+                stats.append((st.st_size, st.st_mtime))
+            except OSError:
+                stats.append(None)
+        return stats
+
+    def wait(self, timeout=None):
+        """
+        Waits until one of the files changes, or timeout seconds have
+        passed.  Returns whether a file changed.
+        """
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            interval = self._interval
+            if deadline is not None:
+                interval = min(interval, max(deadline - time.time(), 0))
+            time.sleep(interval)
+            stats = self._stat()
+            if stats != self._stats:
+                self._stats = stats
+                self._interval = self.MIN_INTERVAL
+                return True
+            self._interval = min(self._interval * 2, self.MAX_INTERVAL)
+            if deadline is not None and time.time() >= deadline:
+                return False
+
+    def close(self):
+        pass
@@ -0,0 +1,295 @@
+# The downloader is responsible for pulling a (large) file over http,
+# resuming partial downloads with range requests and, where the server
+# supports it, splitting the file into several segments that are fetched
+# concurrently.  The md5 of the file is computed as data arrives, so the
+# caller needn't reread the file once it's written.
+
+import os
+import sys
+import time
+import hashlib
+import threading
+import urllib2
+import simplejson as json
+
+# how much we read from the network at a time
+CHUNK_SIZE = 1024 * 64
+# don't bother splitting downloads into segments smaller than this
+MIN_SEGMENT_SIZE = 1024 * 1024
+# how often (in seconds, per segment) we persist download progress
+CHECKPOINT_INTERVAL = 5
+
+# flush what's been written through fd to disk
+def _sync(fd):
+    if hasattr(os, "fdatasync"):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+class _Segment(object):
+    # a byte range [start, end) of the file, of which [start, pos) has been
+    # written, and [start, saved) is known to be on disk.  end is None when
+    # the size of the file is unknown.
+    def __init__(self, start, end, pos=None):
+        self.start = start
+        self.end = end
+        if pos is None:
+            pos = start
+        self.pos = pos
+        self.saved = pos
+
+    def done(self):
+        return self.end is not None and self.pos >= self.end
+
+class Downloader(object):
+    def __init__(self, url, path, segments=4, progress=None):
+        self._url = url
+        self._path = path
+        # data is written here until the download is complete, the state
+        # file records how much of each segment made it to disk
+        self._partPath = path + ".part"
+        self._statePath = path + ".part.json"
+        self._maxSegments = max(1, segments)
+        self._progress = progress
+        self._lock = threading.Lock()
+        self._size = None
+        self._ranges = None
+        self._segments = []
+        self._md5 = hashlib.md5()
+        self._hashed = 0
+        self._done = 0
+
+    # discover the size of the file and whether the server honors range
+    # requests.  returns the size, which may be None if the server won't
+    # tell us.
+    def probe(self):
+        if self._ranges is not None:
+            return self._size
+        u = urllib2.urlopen(urllib2.Request(self._url,
+                                            headers={"Range": "bytes=0-0"}))
+        try:
+            self._ranges = False
+            if u.getcode() == 206:
+                total = u.info().get("content-range", "").rpartition("/")[2]
+                if total.isdigit():
+                    self._size = int(total)
+                    self._ranges = True
+            if not self._ranges:
+                length = u.info().get("content-length")
+                if length is not None and length.isdigit():
+                    self._size = int(length)
+        finally:
+            u.close()
+        return self._size
+
+    def _load_state(self):
+        try:
+            f = open(self._statePath, 'r')
+            try:
+                return json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+    # record how far each segment has gotten on disk.  called with
+    # self._lock held.  should the state be lost in a crash, we start
+    # over, so it isn't synced itself.
+    def _checkpoint(self):
+        state = {
+            "url": self._url,
+            "size": self._size,
+            "segments": [[s.start, s.end, s.saved] for s in self._segments]
+        }
+        tmp = self._statePath + ".tmp"
+        f = open(tmp, 'w')
+        try:
+            f.write(json.dumps(state))
+        finally:
+            f.close()
+        if os.path.exists(self._statePath) and sys.platform == 'win32':
+            os.remove(self._statePath)
+        os.rename(tmp, self._statePath)
+
+    # decide how to split up the file, picking up where a previous attempt
+    # left off if we can.
+    def _plan(self):
+        state = self._load_state()
+        if (self._ranges and state and os.path.isfile(self._partPath) and
+            state.get("url") == self._url and state.get("size") == self._size and
+            os.path.getsize(self._partPath) == self._size):
+            self._segments = [_Segment(*s) for s in state["segments"]]
+            return
+
+        count = 1
+        if self._ranges and self._size:
+            count = max(1, min(self._maxSegments, self._size // MIN_SEGMENT_SIZE))
+        if count == 1:
+            self._segments = [_Segment(0, self._size)]
+        else:
+            step = self._size // count
+            bounds = [i * step for i in range(count)] + [self._size]
+            self._segments = [_Segment(bounds[i], bounds[i + 1])
+                              for i in range(count)]
+
+        # start from an empty file, preallocated (sparsely) when we know
+        # how big it's going to be so segments can be written in place
+        f = open(self._partPath, 'wb')
+        try:
+            if self._size:
+                f.truncate(self._size)
+        finally:
+            f.close()
+        if os.path.exists(self._statePath):
+            os.remove(self._statePath)
+
+    def _segment_at(self, offset):
+        for s in self._segments:
+            if s.start <= offset and (s.end is None or offset < s.end):
+                return s
+        return None
+
+    # fold into the digest any data which has been written to disk ahead of
+    # the point we've hashed up to, and which is now contiguous with it.
+    # called with self._lock held.
+    def _catch_up(self):
+        f = None
+        try:
+            while True:
+                s = self._segment_at(self._hashed)
+                if s is None or s.pos <= self._hashed:
+                    break
+                if f is None:
+                    f = open(self._partPath, 'rb')
+                f.seek(self._hashed)
+                while self._hashed < s.pos:
+                    data = f.read(min(CHUNK_SIZE, s.pos - self._hashed))
+                    if not data:
+                        raise RuntimeError("short read from " + self._partPath)
+                    self._md5.update(data)
+                    self._hashed += len(data)
+        finally:
+            if f is not None:
+                f.close()
+
+    # called by segment threads once data has been written at segment.pos
+    def _written(self, segment, data):
+        self._lock.acquire()
+        try:
+            offset = segment.pos
+            segment.pos += len(data)
+            self._done += len(data)
+            if offset == self._hashed:
+                self._md5.update(data)
+                self._hashed += len(data)
+            self._catch_up()
+            if self._progress is not None:
+                self._progress(self._done, self._size)
+        finally:
+            self._lock.release()
+
+    # get what segment has written through fd onto disk, without holding
+    # up the other segments, then note that it's there
+    def _save(self, segment, fd, checkpoint=True):
+        pos = segment.pos
+        _sync(fd)
+        self._lock.acquire()
+        try:
+            segment.saved = pos
+            if checkpoint:
+                self._checkpoint()
+        finally:
+            self._lock.release()
+
+    def _fetch_segment(self, segment):
+        headers = {}
+        if self._ranges:
+            headers["Range"] = "bytes=%d-%d" % (segment.pos, segment.end - 1)
+        u = urllib2.urlopen(urllib2.Request(self._url, headers=headers))
+        try:
+            if self._ranges and u.getcode() != 206:
+                raise RuntimeError("server ignored range request for " + self._url)
+            fd = os.open(self._partPath, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+            try:
+                last_checkpoint = time.time()
+                while not segment.done():
+                    want = CHUNK_SIZE
+                    if segment.end is not None:
+                        want = min(want, segment.end - segment.pos)
+                    data = u.read(want)
+                    if not data:
+                        break
+                    os.lseek(fd, segment.pos, 0)
+                    written = 0
+                    while written < len(data):
+                        written += os.write(fd, data[written:])
+                    self._written(segment, data)
+                    if (self._ranges and
+                        time.time() - last_checkpoint >= CHECKPOINT_INTERVAL):
+                        self._save(segment, fd)
+                        last_checkpoint = time.time()
+            finally:
+                try:
+                    self._save(segment, fd, checkpoint=False)
+                finally:
+                    os.close(fd)
+        finally:
+            u.close()
+        if segment.end is not None and not segment.done():
+            raise RuntimeError("connection closed early while fetching " + self._url)
+
+    # download the file, returning its md5 hexdigest
+    def run(self):
+        self.probe()
+        self._plan()
+        self._done = sum([s.pos - s.start for s in self._segments])
+        self._lock.acquire()
+        try:
+            self._catch_up()
+        finally:
+            self._lock.release()
+
+        errors = []
+        def worker(segment):
+            try:
+                self._fetch_segment(segment)
+            except Exception, e:
+                errors.append(e)
+
+        threads = []
+        for s in self._segments:
+            if s.done():
+                continue
+            t = threading.Thread(target=worker, args=(s,))
+            t.setDaemon(True)
+            t.start()
+            threads.append(t)
+        try:
+            for t in threads:
+                # join with a timeout so that ^C is delivered promptly
+                while t.isAlive():
+                    t.join(0.5)
+        finally:
+            if self._ranges:
+                self._lock.acquire()
+                try:
+                    self._checkpoint()
+                finally:
+                    self._lock.release()
+        if errors:
+            raise errors[0]
+
+        self._lock.acquire()
+        try:
+            self._catch_up()
+        finally:
+            self._lock.release()
+        if self._size is not None and self._hashed != self._size:
+            raise RuntimeError("incomplete download of " + self._url)
+
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        os.rename(self._partPath, self._path)
+        if os.path.exists(self._statePath):
+            os.remove(self._statePath)
+        return self._md5.hexdigest()
@@ -5,16 +5,67 @@ import sys
 import os
 import platform
 import hashlib
-import urllib
 import urlparse
 import zipfile
 import tarfile
 import math
+import time
+import fnmatch
+import shutil
+import tempfile
+import simplejson as json
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 from . import _config
+from . import _download
+
+# the number of concurrent connections used to download xulrunner, when
+# the server supports range requests
+DOWNLOAD_SEGMENTS = 4
+
+# how much we read from an archive at a time while unpacking
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+
+# archive members which are never used at runtime, and aren't unpacked
+UNUSED_MEMBERS = [ "*/include/*", "*/idl/*", "*.idl", "*.h" ]
+
+# draws a 72 column progress bar as a download proceeds
+class _ProgressBar(object):
+    WIDTH = 72
+
+    def __init__(self, descriptor):
+        self._descriptor = descriptor
+        self._dots = 0
+
+    def _draw(self, upto):
+        while self._dots < upto:
+            self._descriptor.write(("*","|")[self._dots == 0 or self._dots == self.WIDTH])
+            self._dots += 1
+        self._descriptor.flush()
+
+    def start(self):
+        if self._descriptor != None:
+            print >>self._descriptor, "| 0%                                                               100% |"
+
+    def update(self, done, size):
+        if self._descriptor != None and size:
+            self._draw(int(math.floor((float(done) / size) * self.WIDTH)))
+
+    def finish(self):
+        if self._descriptor != None:
+            self._draw(self.WIDTH + 1)
+            print >>self._descriptor, ""
 
 class Fetcher(object):
-    def __init__(self, buildDir):
+    # sharedCache, if provided, is a directory (which may be shared by many
+    # checkouts) where downloaded tarballs and unpacked runtimes are kept,
+    # keyed by the md5 of the tarball.  the build directory then only
+    # receives a link to the shared runtime.
+    def __init__(self, buildDir, sharedCache=None):
         # ensure that the top level directory into which we'll install
         # xulrunner exists
         self._check_build_dir(buildDir)
@@ -24,11 +75,20 @@ class Fetcher(object):
         # maybe we want to move this cache dir into a dot directory in the users
         # system?  would this be horrible, or helpful?
         self._cacheDir = os.path.join(self._buildDir, "cache")
+        self._sharedEntry = None
+        if sharedCache and self._config["md5"]:
+            sharedCache = os.path.abspath(os.path.expanduser(sharedCache))
+            self._sharedEntry = os.path.join(sharedCache, self._config["md5"])
+            if not os.path.isdir(self._sharedEntry):
+                os.makedirs(self._sharedEntry)
+            self._cacheDir = self._sharedEntry
+        # a record of the stat() fingerprint and digest of files we've
+        # already hashed, so that we needn't rehash xulrunner on every launch
+        self._verifyFile = os.path.join(self._buildDir, "verified.json")
+        # how long (in seconds) each phase of the last run() took
+        self._timings = {}
         return
 
-    def _md5_match(self, path, want):
-        return self._calc_md5(path) == want
-
     def _calc_md5(self, path):
         try:
             fp = open(path, 'rb')
@@ -44,14 +104,84 @@ class Fetcher(object):
         except IOError:
             return 'error'
 
-    def needs_fetch(self):
+    def _stat_fingerprint(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return {
+            "size": st.st_size,
+            "mtime": st.st_mtime,
+            "inode": st.st_ino
+        }
+
+    def _load_verify_records(self):
+        try:
+            f = open(self._verifyFile, 'r')
+            try:
+                records = json.loads(f.read())
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+        if type(records) is not dict:
+            return {}
+        return records
+
+    def _save_verify_records(self, records):
+        # write to a temporary file and rename it into place so that a
+        # concurrent or interrupted launch never sees a partial record
+        tmp = "%s.%d.tmp" % (self._verifyFile, os.getpid())
+        try:
+            f = open(tmp, 'w')
+            try:
+                f.write(json.dumps(records, indent=4))
+            finally:
+                f.close()
+            if os.path.exists(self._verifyFile) and sys.platform == 'win32':
+                os.remove(self._verifyFile)
+            os.rename(tmp, self._verifyFile)
+        except (IOError, OSError):
+            # failing to persist the record only costs us a rehash next time
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    # calculate the md5 of a file, unless the file's size, mtime and inode
+    # match those recorded the last time we hashed it, in which case the
+    # recorded digest is returned.  verify=True forces a full rehash.
+    def _fingerprinted_md5(self, path, verify=False):
+        fingerprint = self._stat_fingerprint(path)
+        if fingerprint is None:
+            return 'error'
+        records = self._load_verify_records()
+        record = records.get(path)
+        if (not verify and record is not None and
+            all(record.get(k) == fingerprint[k] for k in fingerprint)):
+            return record.get("digest")
+        digest = self._calc_md5(path)
+        if digest != 'error':
+            self._record_fingerprint(path, digest, records)
+        return digest
+
+    # remember that the file at path, as it is now, has the given digest
+    def _record_fingerprint(self, path, digest, records=None):
+        fingerprint = self._stat_fingerprint(path)
+        if fingerprint is None:
+            return
+        if records is None:
+            records = self._load_verify_records()
+        fingerprint["digest"] = digest
+        records[path] = fingerprint
+        self._save_verify_records(records)
+
+    def needs_fetch(self, verify=False):
         want = self._config["bin"]["sig"]
         path = os.path.join(self._buildDir, self._config["bin"]["path"])
         if os.path.exists(path) and not want:
             print 'No bin/sig setting for %s' % path
             print 'Hash:'
             print '  %s' % self._calc_md5(path)
-        return not self._md5_match(path, want)
+        return self._fingerprinted_md5(path, verify) != want
 
     def _check_build_dir(self, buildDir):
         if not os.path.isdir(buildDir):
@@ -63,7 +193,7 @@ class Fetcher(object):
             print >>descriptor, string
 
     # actually go out and fetch the tarball, store it under build/cache
-    def _fetch(self, descriptor = None):
+    def _fetch(self, descriptor = None, segments = DOWNLOAD_SEGMENTS):
         url = self._config["url"]
         if not os.path.isdir(self._cacheDir):
             os.mkdir(self._cacheDir)
@@ -71,76 +201,211 @@ class Fetcher(object):
         # if the tarball has already been downloaded and md5 checks out, don't go fetch it
         # again.
         if os.path.exists(self._tarball):
-            if self._md5_match(self._tarball, self._config['md5']):
+            if self._fingerprinted_md5(self._tarball) == self._config['md5']:
                 return
             else:
                 os.remove(self._tarball)
-        # now go fetch
-        u = urllib.urlopen(url)
-        size = int(u.info()['content-length'])
-        rd = 0
+        # now go fetch.  an interrupted download leaves a partial file
+        # behind which the downloader will resume.
+        bar = _ProgressBar(descriptor)
+        downloader = _download.Downloader(url, self._tarball, segments=segments,
+                                          progress=bar.update)
+        size = downloader.probe()
         self._print(descriptor, "Fetching xulrunner, " + str(size) + " bytes from " + urlparse.urlparse(url).netloc)
-        f = open(self._tarball, "wb+")
-        self._print(descriptor, "| 0%                                                               100% |")
-        dots = 0
-        while (True):
-            d = u.read(1024 * 10)
-            if (len(d) == 0):
-                break
-            rd += len(d)
-            # should we print?
-            shouldHave = int(math.floor((float(rd) / size) * 72))
-            if (descriptor != None):
-                while (shouldHave > dots):
-                    descriptor.write(("*","|")[dots == 0 or dots == 72])
-                    descriptor.flush()
-                    dots += 1
-            f.write(d)
-        if (descriptor != None):
-            while (dots <= 72):
-                descriptor.write(("*","|")[dots == 0 or dots == 72])
-                dots += 1
-            print ("")
-        f.close()
-        u.close()
+        bar.start()
+        start = time.time()
+        digest = downloader.run()
+        self._timings["fetch"] = time.time() - start
+        bar.finish()
         if not self._config['md5']:
-            descriptor.write('No md5 listed in _config; for the record:\n')
-            descriptor.write('    %s\n' % self._calc_md5(self._tarball))
-        elif not self._md5_match(self._tarball, self._config['md5']):
+            self._print(descriptor, 'No md5 listed in _config; for the record:')
+            self._print(descriptor, '    %s' % digest)
+        elif digest != self._config['md5']:
             os.remove(self._tarball)
             raise RuntimeError("download failure!  md5 mismatch!")
+        else:
+            self._record_fingerprint(self._tarball, digest)
         return
 
-    # unpack the tarball (or zipfile) into the build directory
-    def _unpack(self,descriptor,path):
+    def _skip_member(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in UNUSED_MEMBERS)
+
+    # the path at which an archive member should be written, refusing
+    # members which would land outside of dest
+    def _member_path(self, dest, name):
+        target = os.path.normpath(os.path.join(dest, name))
+        if target != dest and not target.startswith(os.path.join(dest, "")):
+            raise RuntimeError("refusing to extract '" + name + "' outside of " + dest)
+        return target
+
+    # copy a member's data out of the archive, hashing it as it goes by if
+    # it's the file whose signature we must check
+    def _write_member(self, src, target, hasher):
+        parent = os.path.dirname(target)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        out = open(target, 'wb')
+        try:
+            while True:
+                chunk = src.read(EXTRACT_CHUNK_SIZE)
+                if not chunk: break
+                if hasher is not None:
+                    hasher.update(chunk)
+                out.write(chunk)
+        finally:
+            out.close()
+
+    # stream a tarball's members to disk in a single pass
+    def _extract_tar(self, path, dest, binName, stats):
+        sig = None
+        f = tarfile.open(path, "r|*", bufsize=EXTRACT_CHUNK_SIZE)
+        try:
+            for member in f:
+                if self._skip_member(member.name):
+                    stats["skipped"] += 1
+                    continue
+                target = self._member_path(dest, member.name)
+                if member.isfile():
+                    hasher = None
+                    if member.name == binName:
+                        sig = hasher = hashlib.md5()
+                    self._write_member(f.extractfile(member), target, hasher)
+                    f.chmod(member, target)
+                    f.utime(member, target)
+                else:
+                    f.extract(member, dest)
+                stats["files"] += 1
+        finally:
+            f.close()
+        return sig
+
+    # stream a zipfile's members to disk in a single pass
+    def _extract_zip(self, path, dest, binName, stats):
+        sig = None
+        f = zipfile.ZipFile(path)
+        try:
+            for info in f.infolist():
+                if self._skip_member(info.filename):
+                    stats["skipped"] += 1
+                    continue
+                target = self._member_path(dest, info.filename)
+                if info.filename.endswith("/"):
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                else:
+                    hasher = None
+                    if info.filename == binName:
+                        sig = hasher = hashlib.md5()
+                    src = f.open(info)
+                    try:
+                        self._write_member(src, target, hasher)
+                    finally:
+                        src.close()
+                    # preserve unix permissions, if the archive recorded them
+                    mode = (info.external_attr >> 16) & 0777
+                    if mode:
+                        os.chmod(target, mode)
+                stats["files"] += 1
+        finally:
+            f.close()
+        return sig
+
+    # unpack the tarball (or zipfile) into the build directory (or dest),
+    # returning the signature of the unpacked xulrunner binary.  the binary
+    # is hashed as it's written, members we never use are skipped.
+    def _unpack(self, descriptor, path, dest=None):
+        if dest is None:
+            dest = self._buildDir
+        dest = os.path.abspath(dest)
         if not os.path.isfile(path):
             raise RuntimeError("path doesn't exist, cannot unpack: " + path)
+        binName = self._config["bin"]["path"]
+        stats = { "files": 0, "skipped": 0 }
+        start = time.time()
         if (any(path.endswith(ext) for ext in (".tgz",".tar.gz",".tbz2",".tar.bz2"))):
             self._print(descriptor, "extracting " + os.path.basename(path))
-            f = tarfile.open(path)
-            try:
-                f.extractall(self._buildDir)
-            finally:
-                f.close()
+            sig = self._extract_tar(path, dest, binName, stats)
         elif (path.endswith(".zip")):
             self._print(descriptor, "extracting " + os.path.basename(path))
-            f = zipfile.ZipFile(path)
-            try:
-                f.extractall(self._buildDir)
-            finally:
-                f.close()
+            sig = self._extract_zip(path, dest, binName, stats)
         else:
             raise RuntimeError("I don't know how to extract '" + os.path.basename(path) + "'")
+        self._timings["extract"] = time.time() - start
+        self._print(descriptor, "extracted %d files (skipped %d)" %
+                    (stats["files"], stats["skipped"]))
         # if after all that we still think we need to fetch the thing,
         # that means unpacked bits don't match expected signatures.
         # safest to purge them from disk and/or refuse to run
-        if self.needs_fetch():
+        digest = sig and sig.hexdigest()
+        if digest != self._config["bin"]["sig"]:
             raise RuntimeError("Signature mismatch in unpacked xulrunner contents.  Eep!")
-        return
+        return digest
+
+    # serialize work on a shared cache entry between processes (where we
+    # can), so concurrent checkouts don't download or unpack over each other
+    def _lock_shared_entry(self):
+        f = open(os.path.join(self._sharedEntry, ".lock"), 'w')
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def _unlock_shared_entry(self, f):
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+    # make sure the shared cache entry holds a verified, unpacked runtime,
+    # returning the path to it and the signature of its xulrunner binary
+    def _populate_shared_runtime(self, descriptor, segments):
+        runtime = os.path.join(self._sharedEntry, "runtime")
+        lock = self._lock_shared_entry()
+        try:
+            digest = self._calc_md5(os.path.join(runtime, self._config["bin"]["path"]))
+            if digest == self._config["bin"]["sig"]:
+                return runtime, digest
+            self._fetch(descriptor, segments)
+            # unpack beside the final location and move it into place once
+            # it's verified, so that an unpacked runtime is always complete
+            tmp = tempfile.mkdtemp(prefix="runtime.", dir=self._sharedEntry)
+            try:
+                digest = self._unpack(descriptor, self._tarball, tmp)
+                if os.path.exists(runtime):
+                    shutil.rmtree(runtime)
+                os.rename(tmp, runtime)
+            except:
+                shutil.rmtree(tmp, True)
+                raise
+            return runtime, digest
+        finally:
+            self._unlock_shared_entry(lock)
+
+    # point the build directory at a runtime unpacked in the shared cache
+    def _link_shared_runtime(self, descriptor, runtime):
+        top = self._config["bin"]["path"].split("/")[0]
+        dst = os.path.join(self._buildDir, top)
+        if os.path.islink(dst):
+            os.remove(dst)
+        elif os.path.isdir(dst):
+            shutil.rmtree(dst)
+        self._print(descriptor, "linking " + top + " from " + runtime)
+        os.symlink(os.path.join(runtime, top), dst)
 
-    def run(self, descriptor=sys.stdout):
-        self._fetch(descriptor)
-        self._unpack(descriptor, self._tarball)
+    def run(self, descriptor=sys.stdout, segments=DOWNLOAD_SEGMENTS):
+        start = time.time()
+        self._timings = {}
+        # without symlinks we can only share the tarball, each build
+        # directory gets its own unpacked copy
+        if self._sharedEntry is not None and hasattr(os, "symlink"):
+            runtime, digest = self._populate_shared_runtime(descriptor, segments)
+            self._link_shared_runtime(descriptor, runtime)
+        else:
+            self._fetch(descriptor, segments)
+            digest = self._unpack(descriptor, self._tarball)
+        self._record_fingerprint(self.xulrunner_path(), digest)
+        self._timings["total"] = time.time() - start
+        self._print(descriptor, "xulrunner ready (%s)" % ", ".join(
+            ["%s: %.2fs" % (phase, self._timings[phase])
+             for phase in ("fetch", "extract", "total") if phase in self._timings]))
 
     def xulrunner_path(self):
         return os.path.join(self._buildDir, self._config["bin"]["path"])
@@ -38,8 +38,13 @@
 # ***** END LICENSE BLOCK *****
 
 import os
+import re
 import sys
 import copy
+import errno
+import shutil
+import fnmatch
+import hashlib
 import tempfile
 import signal
 import commands
@@ -49,6 +54,7 @@ import killableprocess
 import subprocess
 from xml.etree import ElementTree
 from distutils import dir_util
+import time
 from time import sleep
 
 try:
@@ -97,6 +103,126 @@ def getoutput(l):
     os.remove(tmp)
     return r
 
+class ProcessIndex(object):
+    """A snapshot of the running processes (on posix systems): each one's
+    parent, process group and command line.  They're read from /proc where
+    there is one, and otherwise from a single run of ps."""
+
+    def __init__(self):
+        # pid -> (ppid, pgid, command line)
+        self.processes = {}
+        if os.path.isdir('/proc/self'):
+            self._read_proc()
+        else:
+            self._read_ps()
+
+    def _read_proc(self):
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                f = open('/proc/%s/stat' % entry, 'r')
+                try:
+                    stat = f.read()
+                finally:
+                    f.close()
+                f = open('/proc/%s/cmdline' % entry, 'r')
+                try:
+                    cmdline = f.read()
+                finally:
+                    f.close()
+            except IOError:
+                # it's gone already
+                continue
+            # the command name is in parentheses, and may hold anything
+            name = stat[stat.find('(') + 1:stat.rfind(')')]
+            fields = stat[stat.rfind(')') + 2:].split()
+            command = cmdline.replace('\0', ' ').strip() or '[%s]' % name
+            self.processes[int(entry)] = (int(fields[1]), int(fields[2]),
+                                          command)
+
+    def _read_ps(self):
+        ps = subprocess.Popen(['ps', '-A', '-o', 'pid=,ppid=,pgid=,args='],
+                              stdout=subprocess.PIPE)
+        for line in ps.communicate()[0].splitlines():
+            fields = line.split(None, 3)
+            if len(fields) < 3:
+                continue
+            command = ''
+            if len(fields) == 4:
+                command = fields[3]
+            self.processes[int(fields[0])] = (int(fields[1]), int(fields[2]),
+                                              command)
+
+    def find(self, name, minimum_pid=0):
+        """The pids (above minimum_pid) of the processes whose command lines
+        contain name, other than this one."""
+        return sorted([pid for pid, (ppid, pgid, command)
+                       in self.processes.items()
+                       if name in command and pid > minimum_pid and
+                       pid != os.getpid()])
+
+    def descendants(self, pid):
+        """The pids of the processes started by pid, and by them, and so on,
+        and those in pid's process group."""
+        children = {}
+        found = set()
+        for child, (ppid, pgid, command) in self.processes.items():
+            children.setdefault(ppid, []).append(child)
+            if pgid == pid and child != pid:
+                found.add(child)
+        todo = [pid] + list(found)
+        while todo:
+            for child in children.get(todo.pop(), []):
+                if child not in found and child != pid:
+                    found.add(child)
+                    todo.append(child)
+        return found
+
+def pid_alive(pid):
+    """Whether the process pid is running (and isn't a zombie)."""
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    try:
+        f = open('/proc/%d/stat' % pid, 'r')
+        try:
+            stat = f.read()
+        finally:
+            f.close()
+        return stat[stat.rfind(')') + 2:].split()[0] != 'Z'
+    except (IOError, IndexError):
+        return True
+
+def kill_pids(pids, kill_signal=signal.SIGKILL):
+    """Send kill_signal to each of pids which is still running."""
+    for pid in pids:
+        try:
+            os.kill(pid, kill_signal)
+        except OSError:
+            pass
+
+def wait_pids(pids, timeout=None):
+    """Wait until none of pids is running, or timeout seconds have passed,
+    returning the set of those still running."""
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    interval = .01
+    while True:
+        running = set([pid for pid in pids if pid_alive(pid)])
+        if not running:
+            return running
+        if deadline is not None and time.time() >= deadline:
+            return running
+        if deadline is None:
+            sleep(interval)
+        else:
+            sleep(max(min(interval, deadline - time.time()), 0))
+        interval = min(interval * 2, .25)
+        pids = running
+
 def get_pids(name, minimun_pid=0):
 
     """Get all the pids matching name, exclude any pids below minimum_pid."""
@@ -104,17 +230,9 @@ def get_pids(name, minimun_pid=0):
         import wpk
 
         pids = wpk.get_pids(name)
+        return [m for m in pids if m > minimun_pid]
 
-    else:
-        # get_pids_cmd = ['ps', 'ax']
-        # h = killableprocess.runCommand(get_pids_cmd, stdout=subprocess.PIPE, universal_newlines=True)
-        # h.wait(group=False)
-        # data = h.stdout.readlines()
-        data = getoutput(['ps', 'ax']).splitlines()
-        pids = [int(line.split()[0]) for line in data if line.find(name) is not -1]
-
-    matching_pids = [m for m in pids if m > minimun_pid]
-    return matching_pids
+    return ProcessIndex().find(name, minimun_pid)
 
 def kill_process_by_name(name):
     """Find and kill all processes containing a certain name"""
@@ -128,19 +246,12 @@ def kill_process_by_name(name):
             wpk.kill_pid(p)
 
     else:
-        for pid in pids:
-            
-            try:
-                os.kill(pid, signal.SIGTERM)
-            except OSError: pass
-            sleep(.5)
-            if len(get_pids(name)) is not 0:
-                try:
-                    os.kill(pid, signal.SIGKILL)
-                except OSError: pass
-                sleep(.5)
-                if len(get_pids(name)) is not 0:
-                    logger.error('Could not kill process')
+        kill_pids(pids, signal.SIGTERM)
+        running = wait_pids(pids, .5)
+        if running:
+            kill_pids(running, signal.SIGKILL)
+            if wait_pids(running, .5):
+                logger.error('Could not kill process')
 
 def makedirs(name):
 
@@ -159,127 +270,429 @@ def makedirs(name):
     except:
         pass
 
+def read_prefs_json(path):
+    """Read a set of preferences from a JSON file, of an object mapping
+    preference names to values."""
+    f = open(path, 'r')
+    try:
+        prefs = simplejson.load(f)
+    finally:
+        f.close()
+    if not isinstance(prefs, dict):
+        raise ValueError('%s does not hold an object of preferences' % path)
+    return prefs
+
+class RawPref(str):
+    """A preference value, as written in a prefs file, which couldn't be
+    read as JSON; it's written back just as it was."""
+
+class PrefsFile(object):
+    """The preferences in a user.js or prefs.js file, keyed by name.  Lines
+    which aren't preferences (comments, mostly) are kept where they were, as
+    are comments at the ends of preferences' lines.
+    Setting a preference which is set already changes it in place, so the
+    file doesn't grow as it's updated, and it's only written when what
+    would be written differs from what's there."""
+
+    pref_re = re.compile(r'^\s*user_pref\(\s*("(?:[^"\\]|\\.)*")\s*,'
+                         r'\s*("(?:[^"\\]|\\.)*"|[^"]*?)\s*\)\s*;'
+                         r'\s*(//.*)?$')
+
+    # what earlier versions of mozrunner marked the preferences they
+    # appended with
+    old_markers = ['#MozRunner Prefs Start', '#MozRunner Prefs End']
+
+    def __init__(self, path):
+        self.path = path
+        self.prefs = {}
+        # ('line', text) and ('pref', name) entries, in order
+        self._entries = []
+        # the comments at the ends of preferences' lines, by name
+        self._comments = {}
+        self._contents = None
+        if os.path.isfile(path):
+            f = open(path, 'r')
+            try:
+                self._contents = f.read()
+            finally:
+                f.close()
+            self._parse(self._contents)
+
+    def _parse(self, contents):
+        for line in contents.splitlines():
+            m = self.pref_re.match(line)
+            if m:
+                try:
+                    name = simplejson.loads(m.group(1))
+                except ValueError:
+                    m = None
+            if not m:
+                if line.strip() in self.old_markers:
+                    # along with the blank line written before each
+                    if self._entries and self._entries[-1] == ('line', ''):
+                        self._entries.pop()
+                else:
+                    self._entries.append(('line', line))
+                continue
+            try:
+                value = simplejson.loads(m.group(2))
+            except ValueError:
+                value = RawPref(m.group(2))
+            self[name] = value
+            if m.group(3):
+                self._comments[name] = m.group(3)
+
+    def __contains__(self, name):
+        return name in self.prefs
+
+    def __getitem__(self, name):
+        return self.prefs[name]
+
+    def __setitem__(self, name, value):
+        if name not in self.prefs:
+            self._entries.append(('pref', name))
+        self.prefs[name] = value
+
+    def __delitem__(self, name):
+        del self.prefs[name]
+        self._comments.pop(name, None)
+        self._entries.remove(('pref', name))
+
+    def update(self, prefs):
+        for name in sorted(prefs.keys()):
+            self[name] = prefs[name]
+
+    def load_json(self, path):
+        """Set the preferences in a JSON file (see read_prefs_json)."""
+        self.update(read_prefs_json(path))
+
+    def serialize(self):
+        lines = []
+        for kind, value in self._entries:
+            if kind == 'line':
+                lines.append(value)
+            else:
+                pref = self.prefs[value]
+                if not isinstance(pref, RawPref):
+                    pref = simplejson.dumps(pref)
+                line = 'user_pref(%s, %s);' % (simplejson.dumps(value), pref)
+                if value in self._comments:
+                    line += ' ' + self._comments[value]
+                lines.append(line)
+        return ''.join([line + '\n' for line in lines])
+
+    def write(self):
+        """Write the preferences back to the file, if they've changed.
+        The file is replaced whole, so nothing reading it sees it half
+        written.  Returns whether it was written."""
+        contents = self.serialize()
+        if contents == self._contents:
+            return False
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=dirname,
+                                   prefix='.' + os.path.basename(self.path))
+        try:
+            f = os.fdopen(fd, 'w')
+            try:
+                f.write(contents)
+            finally:
+                f.close()
+            if os.name == 'nt' and os.path.exists(self.path):
+                # rename doesn't replace files on windows
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._contents = contents
+        return True
+
+RDF_NS = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+EM_NS = '{http://www.mozilla.org/2004/em-rdf#}'
+
+def read_install_rdf(f):
+    """Read an addon's install.rdf from the file object f, returning the
+    addon's id, and whether it asks to be unpacked to be installed."""
+    tree = ElementTree.ElementTree(file=f)
+
+    desc = tree.find('.//' + RDF_NS + 'Description')
+    apps = desc.findall('.//' + EM_NS + 'targetApplication')
+    for app in apps:
+        desc.remove(app)
+    if len(desc) and desc.attrib.has_key(EM_NS + 'id'):
+        addon_id = desc.attrib[EM_NS + 'id']
+    elif len(desc) and desc.find('.//' + EM_NS + 'id') is not None:
+        addon_id = desc.find('.//' + EM_NS + 'id').text
+    else:
+        about = [e for e in tree.findall('.//' + RDF_NS + 'Description') if
+                 e.get(RDF_NS + 'about') == 'urn:mozilla:install-manifest']
+        if len(about) == 0:
+            addon_element = tree.find('.//' + EM_NS + 'id')
+            addon_id = addon_element.text
+        else:
+            addon_id = about[0].get(EM_NS + 'id')
+
+    unpack = desc.get(EM_NS + 'unpack')
+    if unpack is None and desc.find(EM_NS + 'unpack') is not None:
+        unpack = desc.find(EM_NS + 'unpack').text
+    return addon_id, (unpack or '').strip() == 'true'
+
+def extract_zip(compressed_file, dest):
+    """Extract the members of the open zipfile compressed_file into dest,
+    streaming each straight to its place."""
+    dest = os.path.abspath(dest)
+    for info in compressed_file.infolist():
+        path = os.path.normpath(os.path.join(dest, info.filename))
+        if path != dest and not path.startswith(os.path.join(dest, '')):
+            raise ValueError('zip member outside of the zip: %s' %
+                             info.filename)
+        if info.filename.endswith('/'):
+            makedirs(path)
+            continue
+        if not os.path.isdir(os.path.dirname(path)):
+            makedirs(os.path.dirname(path))
+        member = compressed_file.open(info)
+        try:
+            f = open(path, 'wb')
+            try:
+                shutil.copyfileobj(member, f, 1024 * 1024)
+            finally:
+                f.close()
+        finally:
+            member.close()
+
+# ioctl to make a file share the blocks of another (a reflink), on Linux
+FICLONE = 0x40049409
+
+def clone_file(src, dst):
+    """Copy the file src to dst, as a reflink (sharing blocks until either
+    is written to) where the filesystem supports it."""
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(dst, 'wb')
+        try:
+            cloned = False
+            if sys.platform.startswith('linux'):
+                try:
+                    import fcntl
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                    cloned = True
+                except (ImportError, IOError, OSError):
+                    pass
+            if not cloned:
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+    shutil.copystat(src, dst)
+
+def clone_tree(src, dst):
+    """Clone the directory src into dst (which may exist already), file by
+    file with clone_file."""
+    makedirs(dst)
+    for name in os.listdir(src):
+        srcname = os.path.join(src, name)
+        dstname = os.path.join(dst, name)
+        if os.path.islink(srcname):
+            os.symlink(os.readlink(srcname), dstname)
+        elif os.path.isdir(srcname):
+            clone_tree(srcname, dstname)
+        else:
+            clone_file(srcname, dstname)
+
 class Profile(object):
     """Handles all operations regarding profile. Created new profiles, installs extensions,
-    sets preferences and handles cleanup."""
+    sets preferences and handles cleanup.
+
+    Given a template_cache directory, new profiles are cloned from a template
+    there: a profile which the application has already run with, and so has
+    set up, with the same preferences and addons.  Once a profile has been
+    run with, save_template() makes it the template, if there isn't one yet.
+    """
+
+    # Entries of a profile which hold what a run did rather than how the
+    # profile was set up, and so are left out of templates (as are their
+    # "-journal" and the like).  Addons and user.js are left out too, since
+    # they're installed and written for each profile cloned, as is the
+    # extension manager's record of addons, which holds paths into the
+    # profile it was made in.
+    template_exclude = ['extensions', 'extensions.*', 'user.js', 'lock',
+                        '.parentlock',
+                        'parent.lock', 'sessionstore.js', 'sessionstore.bak',
+                        'cookies.sqlite', 'webappsstore.sqlite',
+                        'formhistory.sqlite', 'downloads.sqlite',
+                        'places.sqlite', 'Cache', 'OfflineCache',
+                        'minidumps', 'crashes']
+
+    # whether the application can run addons from .xpi files left packed
+    # (as Gecko 2 and later can)
+    packed_addons = False
 
     def __init__(self, binary=None, profile=None, addons=None,
-                 preferences=None):
+                 preferences=None, template_cache=None):
 
         self.binary = binary
-
-        self.create_new = not(bool(profile))
-        if profile:
-            self.profile = profile
-        else:
-            self.profile = self.create_new_profile(self.binary)
-
         self.addons_installed = []
-        self.addons = addons
+        # the preferences set, mapped to what they were before (None if
+        # they weren't set)
+        self.preferences_set = {}
+        self.addons = addons or []
 
         ### set preferences from class preferences
-        prefereneces = preferences or {}
+        preferences = preferences or {}
         if hasattr(self.__class__, 'preferences'):
             self.preferences = self.__class__.preferences.copy()
         else:
             self.preferences = {}
         self.preferences.update(preferences)
 
-        for addon in addons:
+        self.template_cache = template_cache
+        self.template = None
+        self.create_new = not(bool(profile))
+        if profile:
+            self.profile = profile
+        else:
+            if template_cache:
+                self.template = os.path.join(template_cache,
+                                             self.template_key())
+            self.profile = self.create_new_profile(self.binary)
+
+        for addon in self.addons:
             self.install_addon(addon)
 
         self.set_preferences(self.preferences)
 
+    def template_key(self):
+        """The name of the template for profiles like this one."""
+        binary = None
+        if self.binary:
+            # a different build of the application, even at the same path,
+            # may not take to a profile another set up
+            binary = os.path.realpath(self.binary)
+            if os.path.exists(binary):
+                st = os.stat(binary)
+                binary = [binary, st.st_size, int(st.st_mtime)]
+        key = simplejson.dumps({'class': self.__class__.__name__,
+                                'binary': binary,
+                                'preferences': self.preferences,
+                                'addons': [os.path.abspath(addon)
+                                           for addon in self.addons]},
+                               sort_keys=True)
+        return hashlib.sha1(key).hexdigest() + '.template'
+
     def create_new_profile(self, binary):
-        """Create a new clean profile in tmp which is a simple empty folder"""
-        profile = tempfile.mkdtemp(suffix='.mozrunner')
+        """Create a new clean profile in tmp which is a simple empty folder,
+        or, given a template, a clone of the template"""
+        if not self.template:
+            return tempfile.mkdtemp(suffix='.mozrunner')
+        # profiles are made in the cache, so that they can be moved into
+        # place as templates
+        makedirs(self.template_cache)
+        profile = tempfile.mkdtemp(suffix='.mozrunner', dir=self.template_cache)
+        if os.path.isdir(self.template):
+            clone_tree(self.template, profile)
         return profile
 
+    def save_template(self):
+        """Make this profile, as the application has left it, the template
+        for profiles like it, if there isn't one yet.  The profile is used
+        up doing so.  Returns whether it was."""
+        if (not self.template or not self.create_new or
+            os.path.exists(self.template) or not os.path.isdir(self.profile)):
+            return False
+        for name in os.listdir(self.profile):
+            if [x for x in self.template_exclude
+                if (fnmatch.fnmatchcase(name, x) or
+                    name.startswith(x + '-'))]:
+                path = os.path.join(self.profile, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        try:
+            # templates appear whole, or not at all
+            os.rename(self.profile, self.template)
+        except OSError, e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # another run got there first
+            return False
+        return True
+
     def install_addon(self, addon):
-        """Installs the given addon in the profile."""
-        tmpdir = None
+        """Installs the given addon, an .xpi or a directory, in the profile.
+        An .xpi is extracted straight into place, member by member, unless
+        packed_addons is set and the addon doesn't ask to be unpacked, in
+        which case the .xpi itself is put in place."""
         if addon.endswith('.xpi'):
-            tmpdir = tempfile.mkdtemp(suffix = "." + os.path.split(addon)[-1])
             compressed_file = zipfile.ZipFile(addon, "r")
-            for name in compressed_file.namelist():
-                if name.endswith('/'):
-                    makedirs(os.path.join(tmpdir, name))
+            try:
+                install_rdf = compressed_file.open('install.rdf')
+                try:
+                    addon_id, unpack = read_install_rdf(install_rdf)
+                finally:
+                    install_rdf.close()
+                extensions_dir = os.path.join(self.profile, 'extensions')
+                makedirs(extensions_dir)
+                if self.packed_addons and not unpack:
+                    addon_path = os.path.join(extensions_dir, addon_id + '.xpi')
+                    shutil.copyfile(addon, addon_path)
                 else:
-                    if not os.path.isdir(os.path.dirname(os.path.join(tmpdir, name))):
-                        makedirs(os.path.dirname(os.path.join(tmpdir, name)))
-                    data = compressed_file.read(name)
-                    f = open(os.path.join(tmpdir, name), 'wb')
-                    f.write(data) ; f.close()
-            addon = tmpdir
-
-        tree = ElementTree.ElementTree(file=os.path.join(addon, 'install.rdf'))
-        # description_element =
-        # tree.find('.//{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description/')
-
-        desc = tree.find('.//{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description')
-        apps = desc.findall('.//{http://www.mozilla.org/2004/em-rdf#}targetApplication')
-        for app in apps:
-          desc.remove(app)
-        if len(desc) and desc.attrib.has_key('{http://www.mozilla.org/2004/em-rdf#}id'):
-            addon_id = desc.attrib['{http://www.mozilla.org/2004/em-rdf#}id']
-        elif len(desc) and desc.find('.//{http://www.mozilla.org/2004/em-rdf#}id') is not None:
-            addon_id = desc.find('.//{http://www.mozilla.org/2004/em-rdf#}id').text
+                    addon_path = os.path.join(extensions_dir, addon_id)
+                    extract_zip(compressed_file, addon_path)
+            finally:
+                compressed_file.close()
         else:
-            about = [e for e in tree.findall(
-                        './/{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description') if
-                         e.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about') ==
-                         'urn:mozilla:install-manifest'
-                    ]
-
-            x = e.find('.//{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description')
-
-            if len(about) == 0:
-                addon_element = tree.find('.//{http://www.mozilla.org/2004/em-rdf#}id')
-                addon_id = addon_element.text
-            else:
-                addon_id = about[0].get('{http://www.mozilla.org/2004/em-rdf#}id')
-
-        addon_path = os.path.join(self.profile, 'extensions', addon_id)
-        copytree(addon, addon_path, preserve_symlinks=1)
+            install_rdf = open(os.path.join(addon, 'install.rdf'), 'rb')
+            try:
+                addon_id, unpack = read_install_rdf(install_rdf)
+            finally:
+                install_rdf.close()
+            addon_path = os.path.join(self.profile, 'extensions', addon_id)
+            copytree(addon, addon_path, preserve_symlinks=1)
         self.addons_installed.append(addon_path)
 
     def set_preferences(self, preferences):
         """Adds preferences dict to profile preferences"""
-        prefs_file = os.path.join(self.profile, 'user.js')
-        # Ensure that the file exists first otherwise create an empty file
-        if os.path.isfile(prefs_file):
-            f = open(prefs_file, 'a+')
-        else:
-            f = open(prefs_file, 'w')
-
-        f.write('\n#MozRunner Prefs Start\n')
-
-        pref_lines = ['user_pref(%s, %s);' %
-                      (simplejson.dumps(k), simplejson.dumps(v) ) for k, v in
-                       preferences.items()]
-        for line in pref_lines:
-            f.write(line+'\n')
-        f.write('#MozRunner Prefs End\n')
-        f.flush() ; f.close()
+        prefs = PrefsFile(os.path.join(self.profile, 'user.js'))
+        for name in preferences:
+            if name not in self.preferences_set:
+                # remember what was there before, for clean_preferences
+                self.preferences_set[name] = prefs.prefs.get(name, None)
+        prefs.update(preferences)
+        prefs.write()
+
+    def load_preferences(self, path):
+        """Adds the preferences in a JSON file (of an object mapping their
+        names to their values) to profile preferences"""
+        self.set_preferences(read_prefs_json(path))
 
     def clean_preferences(self):
         """Removed preferences added by mozrunner."""
-        lines = open(os.path.join(self.profile, 'user.js'), 'r').read().splitlines()
-        s = lines.index('#MozRunner Prefs Start') ; e = lines.index('#MozRunner Prefs End')
-        cleaned_prefs = '\n'.join(lines[:s] + lines[e+1:])
-        f = open(os.path.join(self.profile, 'user.js'), 'w')
-        f.write(cleaned_prefs) ; f.flush() ; f.close()
+        prefs = PrefsFile(os.path.join(self.profile, 'user.js'))
+        for name, value in self.preferences_set.items():
+            if value is not None:
+                prefs[name] = value
+            elif name in prefs:
+                del prefs[name]
+        prefs.write()
+        self.preferences_set = {}
 
     def clean_addons(self):
         """Cleans up addons in the profile."""
         for addon in self.addons_installed:
             if os.path.isdir(addon):
                 rmtree(addon)
+            elif os.path.isfile(addon):
+                os.remove(addon)
 
     def cleanup(self):
         """Cleanup operations on the profile."""
         if self.create_new:
-            rmtree(self.profile)
+            if os.path.isdir(self.profile):
+                rmtree(self.profile)
         else:
             self.clean_preferences()
             self.clean_addons()
@@ -438,24 +851,40 @@ class Runner(object):
             self.profile = self.profile_class()
         self.process_handler = run_command(self.command+self.cmdargs, self.env, **self.kp_kwargs)
 
+    def related_pids(self, index=None):
+        """The pids of the processes the browser started, from the given
+        ProcessIndex, or a fresh one.  The browser is started at the head of
+        a process group of its own, so that includes any instance of itself
+        it restarted as, even once that's been orphaned (or adopted by a
+        subreaper), but not other runners' browsers."""
+        if index is None:
+            index = ProcessIndex()
+        return index.descendants(self.process_handler.pid)
+
     def wait(self, timeout=None):
-        """Wait for the browser to exit."""
+        """Wait for the browser, and whatever it started, to exit, killing
+        whatever's still running once timeout seconds are up."""
+        deadline = None
+        if timeout is not None and timeout != -1:
+            deadline = time.time() + timeout
         self.process_handler.wait(timeout=timeout)
 
         if sys.platform != 'win32':
-            for name in self.names:
-                for pid in get_pids(name, self.process_handler.pid):
-                    self.process_handler.pid = pid
-                    self.process_handler.wait(timeout=timeout)
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+            running = wait_pids(self.related_pids(), remaining)
+            if running:
+                kill_pids(running)
 
     def kill(self, kill_signal=signal.SIGTERM):
         """Kill the browser"""
         if sys.platform != 'win32':
+            # once the browser's gone its children are orphaned, so find
+            # them first
+            related = self.related_pids()
             self.process_handler.kill()
-            for name in self.names:
-                for pid in get_pids(name, self.process_handler.pid):
-                    self.process_handler.pid = pid
-                    self.process_handler.kill()
+            kill_pids(related)
         else:
             try:
                 self.process_handler.kill(group=True)
@@ -42,6 +42,13 @@ processes that launch subprocesses to be reliably killed on Windows (via the Pop
 It also adds a timeout argument to Wait() for a limited period of time before
 forcefully killing the process.
 
+On Linux, waiting is done on a pidfd (where the kernel has pidfd_open), which
+becomes readable when the process exits, rather than by blocking in waitpid();
+elsewhere on posix it's done by polling waitpid() with WNOHANG.  Either way
+deadlines are kept on a monotonic clock.  A process's exit_fd() can go in a
+select() or poll() of your own, wait_async() calls back once a process exits,
+and wait_any() waits on any number of processes at once.
+
 Note: On Windows, this module requires Windows 2000 or higher (no support for
 Windows 95, 98, or NT 4.0). It also requires ctypes, which is bundled with
 Python 2.5+ or available from http://python.net/crew/theller/ctypes/
@@ -51,7 +58,9 @@ import subprocess
 import sys
 import os
 import time
-import datetime
+import errno
+import select
+import threading
 import types
 import exceptions
 
@@ -98,6 +107,112 @@ if not mswindows:
     def DoNothing(*args):
         pass
 
+def _load_clock_gettime():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    except (ImportError, OSError, AttributeError):
+        return None
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+_clock_gettime_monotonic = _load_clock_gettime()
+
+def monotonic():
+    """Seconds on a clock which doesn't jump when the system time is set,
+    where there's one to be had, otherwise time.time()."""
+    if _clock_gettime_monotonic:
+        return _clock_gettime_monotonic()
+    return time.time()
+
+# pidfd_open has the same number on every architecture listed
+NR_PIDFD_OPEN = 434
+_PIDFD_MACHINES = ('x86_64', 'i386', 'i686', 'aarch64', 'armv6l', 'armv7l',
+                   'ppc64le', 's390x', 'riscv64')
+
+_pidfd_unsupported = False
+
+def pidfd_open(pid):
+    """A file descriptor which becomes readable when the process pid exits,
+    or None where the kernel can't provide one."""
+    global _pidfd_unsupported
+    if _pidfd_unsupported or not sys.platform.startswith('linux'):
+        return None
+    if os.uname()[4] not in _PIDFD_MACHINES:
+        _pidfd_unsupported = True
+        return None
+    try:
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.syscall(NR_PIDFD_OPEN, pid, 0)
+    except (ImportError, OSError, AttributeError):
+        _pidfd_unsupported = True
+        return None
+    if fd < 0:
+        if ctypes.get_errno() in (errno.ENOSYS, errno.EPERM):
+            # no pidfds here (or they're filtered out, as by some sandboxes)
+            _pidfd_unsupported = True
+        return None
+    return fd
+
+def _deadline(timeout):
+    if timeout is None or timeout == -1:
+        return None
+    return monotonic() + timeout
+
+def _remaining(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - monotonic(), 0)
+
+def wait_any(processes, timeout=None):
+    """Wait until at least one of processes (killableprocess.Popen instances,
+    on posix) has exited, or timeout seconds have passed.  Returns those
+    which have exited; their returncodes are set.  Unlike wait(), this never
+    kills anything."""
+    deadline = _deadline(timeout)
+    interval = .001
+    while True:
+        exited = [p for p in processes if p._poll_exit()]
+        if exited:
+            return exited
+        remaining = _remaining(deadline)
+        if remaining == 0:
+            return []
+        fds = [p.exit_fd() for p in processes]
+        if None in fds:
+            # can't be woken for every process, so poll
+            wait = min(interval, .05)
+            if remaining is not None:
+                wait = min(wait, remaining)
+            time.sleep(wait)
+            interval *= 2
+            continue
+        poller = select.poll()
+        for fd in fds:
+            poller.register(fd, select.POLLIN)
+        try:
+            if remaining is None:
+                poller.poll()
+            else:
+                poller.poll(remaining * 1000)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
 class Popen(subprocess.Popen):
     kill_called = False
     if mswindows:
@@ -170,80 +285,142 @@ class Popen(subprocess.Popen):
             if group:
                 try:
                     os.killpg(self.pid, signal.SIGKILL)
-                except: pass
+                except OSError:
+                    # it isn't a group leader, or is gone already
+                    try:
+                        os.kill(self.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
             else:
                 os.kill(self.pid, signal.SIGKILL)
             self.returncode = -9
 
+    _pidfd = None
+
+    def exit_fd(self):
+        """A file descriptor which becomes readable when the process exits,
+        for use in select() or poll(), or None if there can't be one (on
+        platforms other than Linux, or older kernels).  It's closed once the
+        process has been waited for."""
+        if mswindows or self.returncode is not None:
+            return None
+        if self._pidfd is None:
+            self._pidfd = pidfd_open(self.pid)
+        return self._pidfd
+
+    def _close_exit_fd(self):
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+
+    def _poll_exit(self):
+        """Reap the process if it's exited, without blocking, returning
+        whether it has."""
+        if self.returncode is not None:
+            self._close_exit_fd()
+            return True
+        try:
+            pid, sts = os.waitpid(self.pid, os.WNOHANG)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                return False
+            if e.errno != errno.ECHILD:
+                raise
+            # someone else has waited for it; as subprocess does, take it
+            # that it exited cleanly
+            pid, sts = self.pid, 0
+        if pid != self.pid:
+            return False
+        self._handle_exitstatus(sts)
+        self._close_exit_fd()
+        return True
+
+    def _wait_posix(self, deadline):
+        """Wait for the process to exit, until deadline (on the monotonic
+        clock), returning whether it did."""
+        while True:
+            exited = wait_any([self], _remaining(deadline))
+            if exited:
+                return True
+            if deadline is not None and monotonic() >= deadline:
+                return False
+
+    def _wait_group(self, deadline):
+        """Wait for the rest of the process's group to exit, until
+        deadline, returning whether it did."""
+        interval = .01
+        while True:
+            try:
+                os.killpg(self.pid, 0)
+            except OSError:
+                return True
+            remaining = _remaining(deadline)
+            if remaining == 0:
+                return False
+            wait = min(interval, .25)
+            if remaining is not None:
+                wait = min(wait, remaining)
+            time.sleep(wait)
+            interval *= 2
+
     def wait(self, timeout=None, group=True):
         """Wait for the process to terminate. Returns returncode attribute.
         If timeout seconds are reached and the process has not terminated,
         it will be forcefully killed. If timeout is -1, wait will not
         time out."""
-        
-        if timeout is not None:
-            timeout = timeout * 1000
 
         if self.returncode is not None:
+            self._close_exit_fd()
             return self.returncode
 
-        starttime = datetime.datetime.now()
+        deadline = _deadline(timeout)
 
         if mswindows:
-            if timeout is None:
-                timeout = -1
-            rc = winprocess.WaitForSingleObject(self._handle, timeout)
-            
-            if rc != winprocess.WAIT_TIMEOUT: 
-                while (starttime - datetime.datetime.now()).microseconds < timeout or ( winprocess.QueryInformationJobObject(self._job, 8)['BasicInfo']['ActiveProcesses'] > 0 ):
-                    time.sleep(.5)            
-            
-            if (starttime - datetime.datetime.now()).microseconds > timeout:
+            if deadline is None:
+                rc = winprocess.WaitForSingleObject(self._handle, -1)
+            else:
+                rc = winprocess.WaitForSingleObject(self._handle,
+                                                    int(timeout * 1000))
+
+            if rc != winprocess.WAIT_TIMEOUT and group:
+                # wait for the rest of the job's processes too
+                while (winprocess.QueryInformationJobObject(self._job, 8)['BasicInfo']['ActiveProcesses'] > 0 and
+                       _remaining(deadline) != 0):
+                    time.sleep(.05)
+
+            if rc == winprocess.WAIT_TIMEOUT or _remaining(deadline) == 0:
                 self.kill(group)
             else:
                 self.returncode = winprocess.GetExitCodeProcess(self._handle)
-        else:
-            if (sys.platform == 'linux2') or (sys.platform in ('sunos5', 'solaris')):
-                def group_wait(timeout):
-                    try:
-                        os.waitpid(self.pid, 0)
-                    except OSError, e:
-                        pass # If wait has already been called on this pid, bad things happen
-                    return self.returncode
-            elif sys.platform == 'darwin':
-                def group_wait(timeout):
-                    try:
-                        count = 0
-                        if timeout is None and self.kill_called:
-                            timeout = 10 # Have to set some kind of timeout or else this could go on forever                
-                        if timeout is None:
-                            while 1:
-                                os.killpg(self.pid, signal.SIG_DFL)
-                        while ((count * 2) <= timeout):
-                            os.killpg(self.pid, signal.SIG_DFL)
-                            time.sleep(.5); count += .5
-                    except exceptions.OSError:
-                        return self.returncode
-                        
-            if timeout is None:
-                if group is True:
-                    return group_wait(timeout)
-                else:
-                    subprocess.Popen.wait(self)
-                    return self.returncode
-
-            returncode = False
-
-            while (starttime - datetime.datetime.now()).microseconds < timeout or ( returncode is False ):
-                if group is True:
-                    return group_wait(timeout)
-                else:
-                    if subprocess.poll() is not None:
-                        returncode = self.returncode
-                time.sleep(.5)
-            return self.returncode        
-                
+            return self.returncode
+
+        if not self._wait_posix(deadline):
+            self.kill(group)
+            # reap it, now that it's been killed
+            try:
+                os.waitpid(self.pid, 0)
+            except OSError:
+                pass
+            self._close_exit_fd()
+        elif group and sys.platform == 'darwin':
+            # on darwin, the app we started may hand off to others in its
+            # group; wait for them too
+            if not self._wait_group(deadline):
+                self.kill(group)
         return self.returncode
+
+    def wait_async(self, callback, timeout=None, group=True):
+        """Wait for the process to terminate (as wait() does, killing it if
+        timeout seconds pass first) without blocking, calling callback with
+        the process once it has.  Returns the thread doing the waiting."""
+        def waiter():
+            self.wait(timeout, group)
+            callback(self)
+        thread = threading.Thread(target=waiter)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
     # We get random maxint errors from subprocesses __del__
     __del__ = lambda self: None        
         
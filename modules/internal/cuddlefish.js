@@ -149,8 +149,21 @@
        manifestChecker = makeManifestChecker(options.packaging);
      }
 
+     // Bundles carry the source of many modules, keyed by URL, so that
+     // they needn't be found and read one by one.
+     var bundle = undefined;
+     if (options.bundles && options.bundles.length) {
+       bundle = {};
+       options.bundles.forEach(function(url) {
+         var modules = JSON.parse(localFS.getFile(url).contents).modules;
+         for (var path in modules)
+           bundle[path] = modules[path];
+       });
+     }
+
      var loaderOptions = {rootPath: options.rootPath,
                           rootPaths: options.rootPaths,
+                          bundle: bundle,
                           fs: options.fs,
                           defaultPrincipal: "system",
                           globals: globals,
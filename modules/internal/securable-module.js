@@ -168,7 +168,7 @@
        if (rootPaths) {
          if (rootPaths.constructor.name != "Array")
            rootPaths = [rootPaths];
-         var fses = [new exports.LocalFileSystem(path)
+         var fses = [new exports.LocalFileSystem(path, options.bundle)
                      for each (path in rootPaths)];
          options.fs = new exports.CompositeFileSystem(fses);
        } else
@@ -304,7 +304,9 @@
      }
    };
 
-   exports.LocalFileSystem = function LocalFileSystem(root) {
+   // bundle, if given, maps module URLs to their contents.  Modules found
+   // there are neither looked for nor read.
+   exports.LocalFileSystem = function LocalFileSystem(root, bundle) {
      if (root === undefined) {
        if (!baseURI)
          throw new Error("Need a root path for module filesystem");
@@ -320,6 +322,7 @@
      this.root = root.spec;
      this._rootURI = root;
      this._rootURIDir = getRootDir(root.spec);
+     this._bundle = bundle || null;
    };
 
    exports.LocalFileSystem.prototype = {
@@ -333,6 +336,8 @@
          baseURI = ios.newURI(base, null, null);
        var newURI = ios.newURI(path, null, baseURI);
        if (newURI.spec.indexOf(this._rootURIDir) == 0) {
+         if (this._bundle && this._bundle.hasOwnProperty(newURI.spec))
+           return newURI.spec;
          var channel = ios.newChannelFromURI(newURI);
          try {
            channel.open().close();
@@ -344,6 +349,8 @@
        return null;
      },
      getFile: function getFile(path) {
+       if (this._bundle && this._bundle.hasOwnProperty(path))
+         return {contents: this._bundle[path]};
        var channel = ios.newChannel(path, null, null);
        var iStream = channel.open();
        var ciStream = Cc["@mozilla.org/intl/converter-input-stream;1"].
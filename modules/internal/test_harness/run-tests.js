@@ -49,15 +49,16 @@ function runTests(dirs, iterations, filter, profileMemory, verbose, rootPaths, q
 
   function onDone(tests) {
     window.close();
+    var counts = {passed: tests.passed, failed: tests.failed};
     if (tests.passed > 0 && tests.failed == 0) {
-      quit("OK");
+      quit("OK", counts);
     } else {
       if (tests.passed == 0) {
         print("No tests were run\n");
       } else {
         printFailedTests(tests, verbose, print);
       }
-      quit("FAIL");
+      quit("FAIL", counts);
     }
   };
 